@@ -9,10 +9,13 @@ logger.addHandler(ch)
 
 import autodiff.utils
 import autodiff.optimize
+import autodiff.fmin_sgd
 
-from autodiff.symbolic import Symbolic, Tracer, Function, Gradient, HessianVector
+from autodiff.symbolic import (Symbolic, Tracer, Function, Gradient,
+    HessianVector, Jacobian, Hessian)
 from autodiff.decorators import (function, gradient, hessian_vector,
-    as_symbolic, theanify)
+    jacobian, hessian, as_symbolic, theanify)
 from autodiff.functions import escape, tag, escaped_call, shadow
+from autodiff.stats import Stats
 from autodiff.context import get_ast, print_ast, print_source
 
@@ -0,0 +1,70 @@
+"""
+Call overhead
+=============
+
+This script measures the time autodiff adds to each call of a compiled
+`Function` -- binding the arguments, building the cache key and looking up the
+compiled function -- by comparing it to calling the underlying Theano function
+directly. The dispatch used before argument binders were precomputed
+(`inspect.getcallargs` and `np.asarray` for every argument) is timed as well.
+
+Run with:
+
+    python -m autodiff.benchmarks.call_overhead
+
+"""
+import timeit
+import numpy as np
+
+import autodiff.utils as utils
+from autodiff import Function
+
+
+def loss(w, x, b=0.0):
+    return np.dot(x, w) + b
+
+
+def legacy_dispatch(f, *args, **kwargs):
+    all_args = utils.expandedcallargs(f.symfn, *args, **kwargs)
+    key = tuple((np.asarray(a).ndim, np.asarray(a).dtype) for a in all_args)
+    return all_args, key
+
+
+def fast_dispatch(f, *args, **kwargs):
+    all_args = f.bind_args(args, kwargs)
+    key = f.get_cache_key(all_args)
+    f.cache.lookup(key)
+    return all_args, key
+
+
+def time_per_call(stmt, number):
+    # best of several repeats, in microseconds
+    return min(timeit.repeat(stmt, number=number, repeat=5)) / number * 1e6
+
+
+def main(number=20000):
+    w = np.random.random(3)
+    x = np.random.random(3)
+
+    f = Function(loss)
+    f(w, x)
+    compiled = f.cache[f.get_cache_key(f.bind_args((w, x), {}))]
+
+    results = [
+        ('theano function', time_per_call(lambda: compiled(w, x, 0.0), number)),
+        ('autodiff Function', time_per_call(lambda: f(w, x), number)),
+        ('dispatch (legacy)',
+         time_per_call(lambda: legacy_dispatch(f, w, x), number)),
+        ('dispatch (fast path)',
+         time_per_call(lambda: fast_dispatch(f, w, x), number)),
+    ]
+
+    for name, usec in results:
+        print('{0:<24}{1:8.2f} us/call'.format(name, usec))
+    print('{0:<24}{1:8.2f} us/call'.format(
+        'Function overhead', results[1][1] - results[0][1]))
+    return dict(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+fmin_cg
+=======
+
+This script fits the linear SVM of `autodiff/examples/svm.py` (on a larger
+random dataset) with `autodiff.optimize.fmin_cg`, and compares it to the
+previous implementation, which passed SciPy separately compiled functions for
+the objective and its gradient. SciPy requests both at (almost) every point,
+so the previous implementation computed the forward pass twice per point.
+
+Run with:
+
+    python -m autodiff.benchmarks.fmin_cg
+
+"""
+import time
+import numpy as np
+import scipy.optimize
+
+from autodiff.optimize import fmin_cg
+from autodiff.symbolic import VectorArg
+
+
+def make_loss(n_samples=5000, n_features=200, l2_regularization=1e-4):
+    rng = np.random.RandomState(1)
+    x = rng.rand(n_samples, n_features)
+    y = 2 * (rng.rand(n_samples) > 0.5) - 1
+
+    def loss_fn(weights, bias):
+        margin = y * (np.dot(x, weights) + bias)
+        loss = np.maximum(0, 1 - margin) ** 2
+        l2_cost = 0.5 * l2_regularization * np.dot(weights, weights)
+        return np.mean(loss) + l2_cost
+
+    init_args = (np.zeros(n_features), np.zeros(()))
+    return loss_fn, init_args
+
+
+def counted(fn, counter):
+    def wrapper(*args):
+        counter[0] += 1
+        return fn(*args)
+    return wrapper
+
+
+def separate_fmin_cg(fn, init_args, counter, **scipy_kwargs):
+    """
+    fmin_cg with separately compiled objective and gradient.
+    """
+    f = VectorArg(fn, init_args=init_args, function=True)
+    fprime = VectorArg(fn, init_args=init_args, gradient=True)
+    f.fn = counted(f.fn, counter)
+    fprime.fn = counted(fprime.fn, counter)
+    x0 = f.vector_from_args(init_args, {})
+    return scipy.optimize.fmin_cg(f=f,
+                                  x0=x0,
+                                  fprime=fprime,
+                                  disp=False,
+                                  **scipy_kwargs)
+
+
+def main(maxiter=50):
+    loss_fn, init_args = make_loss()
+
+    counter = [0]
+    t0 = time.time()
+    separate_fmin_cg(loss_fn, init_args, counter, maxiter=maxiter)
+    separate_time = time.time() - t0
+    separate_calls = counter[0]
+
+    counter = [0]
+    VectorArg.__call__, call = (
+        counted(VectorArg.__call__, counter), VectorArg.__call__)
+    try:
+        t0 = time.time()
+        fmin_cg(loss_fn, init_args, maxiter=maxiter, disp=False)
+        memo_time = time.time() - t0
+    finally:
+        VectorArg.__call__ = call
+    memo_calls = counter[0]
+
+    print('{0:<28}{1:>10}{2:>16}'.format('', 'time (s)', 'forward passes'))
+    print('{0:<28}{1:10.3f}{2:16d}'.format(
+        'separate f / fprime', separate_time, separate_calls))
+    print('{0:<28}{1:10.3f}{2:16d}'.format(
+        'memoized f + fprime', memo_time, memo_calls))
+    return dict(separate=(separate_time, separate_calls),
+                memoized=(memo_time, memo_calls))
+
+
+if __name__ == '__main__':
+    main()
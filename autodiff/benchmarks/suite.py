@@ -0,0 +1,326 @@
+"""
+Benchmark suite
+===============
+
+This script times each phase of every public entry point on the workloads of
+`autodiff.benchmarks.workloads`:
+
+transform :
+    Parsing and transforming the function's AST (`Context.recompile`), which
+    happens when a `Function` is created. The process-wide cache of
+    transformed code is cleared first, so this is the cost for a function
+    that has not been transformed before.
+
+transform_warm :
+    Creating a second `Function` for the same function, whose transformed
+    code is served from the cache.
+
+trace :
+    Calling the transformed function on the arguments (`Symbolic.trace`).
+    `VectorArg` traces when it is created, so its 'trace' includes the
+    (cold) transform.
+
+compile :
+    Compiling the traced graph with `theano.function`. For the optimizers,
+    this is the time to build a compiled `optimize.Objective`.
+
+first_call :
+    The first call of a new instance: trace, compile and evaluate. For the
+    optimizers, a complete optimization without the objective cache.
+
+call :
+    A steady-state call, once the compiled function is cached (the best of
+    `repeat` timings). For the optimizers, an optimization that reuses the
+    cached objective.
+
+The entry points are `function`, `gradient` and `hessian_vector` (the
+decorators, that is, `Function`, `Gradient` and `HessianVector`),
+`VectorArg` (function and gradient), and `fmin_l_bfgs_b`, `fmin_cg`,
+`fmin_ncg` and `fmin_l_bfgs_b_multistart` (run serially, for a fixed number of
+iterations).
+
+Run with:
+
+    python -m autodiff.benchmarks.suite -o before.json
+
+and compare two runs with:
+
+    python -m autodiff.benchmarks.suite --compare before.json after.json
+
+In comparison mode, the exit status is 1 if any phase is slower than in the
+first run by more than `--threshold` (a fraction).
+
+"""
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import numpy as np
+import theano
+
+import autodiff
+import autodiff.context as context
+import autodiff.optimize as optimize
+from autodiff.symbolic import VectorArg
+from autodiff.benchmarks.workloads import WORKLOADS
+
+PHASES = ('transform', 'transform_warm', 'trace', 'compile', 'first_call',
+          'call')
+
+
+def time_call(fn, *args, **kwargs):
+    """
+    Calls fn on args and kwargs, returning the wall time and the result.
+    """
+    t0 = time.time()
+    result = fn(*args, **kwargs)
+    return time.time() - t0, result
+
+
+def time_steady(fn, number, repeat):
+    # best of several repeats, in seconds per call
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def bench_symbolic(decorator, call_kwargs=None):
+    """
+    Returns a benchmark of the Symbolic class created by `decorator` (one of
+    autodiff's decorators). call_kwargs is a function of the arguments that
+    returns the keyword arguments of each call.
+    """
+    def bench(workload, number, repeat):
+        args = workload.init_args
+        kwargs = call_kwargs(args) if call_kwargs else {}
+        times = dict()
+
+        context.clear_code_cache()
+        times['transform'], f = time_call(decorator, workload.fn)
+        times['transform_warm'], _ = time_call(decorator, workload.fn)
+        f.context.reset()
+        times['trace'], (inputs, outputs) = time_call(f.trace, *args)
+        times['compile'], _ = time_call(f.get_theano_function,
+                                        inputs,
+                                        outputs)
+
+        g = decorator(workload.fn)
+        times['first_call'], _ = time_call(g, *args, **kwargs)
+        times['call'] = time_steady(lambda: g(*args, **kwargs),
+                                    number,
+                                    repeat)
+        return times
+    return bench
+
+
+def bench_vector_arg(workload, number, repeat):
+    args = workload.init_args
+    times = dict()
+
+    context.clear_code_cache()
+    times['trace'], va = time_call(VectorArg, workload.fn, init_args=args)
+    times['compile'], fn = time_call(va.compile, function=True, gradient=True)
+
+    x = np.array(va.vector_from_args(args, {}))
+    times['first_call'], _ = time_call(fn, x)
+    times['call'] = time_steady(lambda: fn(x), number, repeat)
+    return times
+
+
+def bench_optimizer(fmin, hessian_vector=False, **fmin_kwargs):
+    """
+    Returns a benchmark of the optimizer fmin, run with fmin_kwargs.
+    """
+    def bench(workload, number, repeat):
+        args = workload.init_args
+        times = dict()
+        times['compile'], _ = time_call(optimize.get_objective,
+                                        workload.fn,
+                                        init_args=args,
+                                        hessian_vector=hessian_vector,
+                                        use_cache=False)
+        times['first_call'], _ = time_call(fmin,
+                                           workload.fn,
+                                           args,
+                                           use_cache=False,
+                                           **fmin_kwargs)
+
+        # fill the objective cache, then time optimizations that reuse it
+        fmin(workload.fn, args, **fmin_kwargs)
+        times['call'] = time_steady(
+            lambda: fmin(workload.fn, args, **fmin_kwargs),
+            number=1,
+            repeat=min(repeat, 3))
+        return times
+    return bench
+
+
+ENTRY_POINTS = [
+    ('function', bench_symbolic(autodiff.function)),
+    ('gradient', bench_symbolic(autodiff.gradient)),
+    ('hessian_vector', bench_symbolic(autodiff.hessian_vector,
+                                      lambda args: dict(vectors=args))),
+    ('VectorArg', bench_vector_arg),
+    ('fmin_l_bfgs_b', bench_optimizer(optimize.fmin_l_bfgs_b, maxiter=20)),
+    ('fmin_cg', bench_optimizer(optimize.fmin_cg, maxiter=20, disp=False)),
+    ('fmin_ncg', bench_optimizer(optimize.fmin_ncg,
+                                 hessian_vector=True,
+                                 maxiter=20,
+                                 disp=False)),
+    ('fmin_l_bfgs_b_multistart',
+     bench_optimizer(optimize.fmin_l_bfgs_b_multistart,
+                     n_starts=2,
+                     seed=0,
+                     processes=1,
+                     maxiter=20)),
+]
+
+
+def run(workloads=None, entry_points=None, number=100, repeat=5):
+    """
+    Runs the benchmarks and returns a list of records, each a dictionary with
+    the 'workload', 'entry_point', 'phase' and 'seconds'.
+
+    Arguments
+    ---------
+
+    workloads : sequence of str
+        The names of the workloads to run (default: all).
+
+    entry_points : sequence of str
+        The names of the entry points to benchmark (default: all).
+
+    number, repeat : int
+        Steady-state calls are timed `number` times in each of `repeat`
+        repeats, and the best repeat is recorded.
+
+    """
+    workloads = workloads or list(WORKLOADS)
+    entry_points = entry_points or [name for name, _ in ENTRY_POINTS]
+    for name in workloads:
+        if name not in WORKLOADS:
+            raise ValueError('Unknown workload: {0}'.format(name))
+    benches = dict(ENTRY_POINTS)
+    for name in entry_points:
+        if name not in benches:
+            raise ValueError('Unknown entry point: {0}'.format(name))
+
+    records = []
+    for w_name in workloads:
+        workload = WORKLOADS[w_name]()
+        for e_name in entry_points:
+            times = benches[e_name](workload, number, repeat)
+            for phase in PHASES:
+                if phase in times:
+                    records.append(dict(workload=w_name,
+                                        entry_point=e_name,
+                                        phase=phase,
+                                        seconds=times[phase]))
+    return records
+
+
+def environment():
+    """
+    Returns a dictionary describing the environment of a run.
+    """
+    return dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                python=platform.python_version(),
+                platform=platform.platform(),
+                numpy=np.__version__,
+                theano=theano.__version__,
+                floatX=theano.config.floatX,
+                device=theano.config.device)
+
+
+def compare(old, new, threshold=0.1):
+    """
+    Compares the records of two runs. Returns a list of dictionaries with the
+    'workload', 'entry_point', 'phase', the 'old' and 'new' times, their
+    'ratio' (new / old) and whether the phase 'regressed' (became slower by
+    more than `threshold`, a fraction).
+    """
+    def key(record):
+        return (record['workload'], record['entry_point'], record['phase'])
+
+    old_times = dict((key(r), r['seconds']) for r in old)
+    rows = []
+    for record in new:
+        if key(record) not in old_times:
+            continue
+        old_t = old_times[key(record)]
+        new_t = record['seconds']
+        ratio = new_t / old_t if old_t > 0 else float('inf')
+        rows.append(dict(workload=record['workload'],
+                         entry_point=record['entry_point'],
+                         phase=record['phase'],
+                         old=old_t,
+                         new=new_t,
+                         ratio=ratio,
+                         regressed=ratio > 1 + threshold))
+    return rows
+
+
+def print_records(records):
+    print('{0:<10}{1:<26}{2:<16}{3:>14}'.format(
+        'workload', 'entry point', 'phase', 'time (ms)'))
+    for r in records:
+        print('{0:<10}{1:<26}{2:<16}{3:14.3f}'.format(
+            r['workload'], r['entry_point'], r['phase'], r['seconds'] * 1e3))
+
+
+def print_comparison(rows):
+    print('{0:<10}{1:<26}{2:<16}{3:>12}{4:>12}{5:>8}'.format(
+        'workload', 'entry point', 'phase', 'old (ms)', 'new (ms)', 'ratio'))
+    for r in rows:
+        print('{0:<10}{1:<26}{2:<16}{3:12.3f}{4:12.3f}{5:8.2f}{6}'.format(
+            r['workload'], r['entry_point'], r['phase'],
+            r['old'] * 1e3, r['new'] * 1e3, r['ratio'],
+            '  *' if r['regressed'] else ''))
+
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time the phases of autodiff\'s entry points.')
+    parser.add_argument('-w', '--workload', action='append',
+                        help='a workload to run (default: all of {0})'.format(
+                            ', '.join(WORKLOADS)))
+    parser.add_argument('-e', '--entry-point', action='append',
+                        help='an entry point to benchmark (default: all)')
+    parser.add_argument('-n', '--number', type=int, default=100,
+                        help='steady-state calls per repeat')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='repeats of the steady-state calls')
+    parser.add_argument('-o', '--output',
+                        help='write the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two JSON results instead of running')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='the slowdown reported as a regression')
+    options = parser.parse_args(argv)
+
+    if options.compare:
+        old, new = [load(f) for f in options.compare]
+        rows = compare(old['records'], new['records'], options.threshold)
+        print_comparison(rows)
+        return int(any(r['regressed'] for r in rows))
+
+    records = run(workloads=options.workload,
+                  entry_points=options.entry_point,
+                  number=options.number,
+                  repeat=options.repeat)
+    print_records(records)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(dict(environment=environment(), records=records),
+                      f,
+                      indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Workloads
+=========
+
+Reproducible objectives for the benchmark suite (see
+`autodiff.benchmarks.suite`). Each workload is built from a fixed random seed
+and returns a `Workload`: a scalar loss function of its parameters, and the
+initial parameters.
+
+svm :
+    The linear SVM of `autodiff/examples/svm.py`, on a larger dataset.
+
+logistic :
+    L2-regularized logistic regression.
+
+mlp :
+    A one hidden layer (tanh) regression network.
+
+tracing :
+    The chain of helper functions of `autodiff/examples/tracing.py` (a
+    global, a local and nested calls), which stresses tracing rather than
+    computation.
+
+"""
+import collections
+import numpy as np
+
+Workload = collections.namedtuple('Workload', ['name', 'fn', 'init_args'])
+
+
+def svm(n_samples=2000, n_features=50, l2_regularization=1e-4, seed=1):
+    rng = np.random.RandomState(seed)
+    x = rng.rand(n_samples, n_features)
+    y = 2 * (rng.rand(n_samples) > 0.5) - 1
+
+    def loss_fn(weights, bias):
+        margin = y * (np.dot(x, weights) + bias)
+        loss = np.maximum(0, 1 - margin) ** 2
+        l2_cost = 0.5 * l2_regularization * np.dot(weights, weights)
+        return np.mean(loss) + l2_cost
+
+    return Workload('svm', loss_fn, (np.zeros(n_features), np.zeros(())))
+
+
+def logistic(n_samples=2000, n_features=50, l2_regularization=1e-3, seed=2):
+    rng = np.random.RandomState(seed)
+    x = rng.randn(n_samples, n_features)
+    y = (np.dot(x, rng.randn(n_features)) > 0).astype('float64')
+
+    def loss_fn(weights, bias):
+        p = 1.0 / (1.0 + np.exp(-(np.dot(x, weights) + bias)))
+        p = np.clip(p, 1e-7, 1 - 1e-7)
+        nll = -np.mean(y * np.log(p) + (1 - y) * np.log(1 - p))
+        return nll + 0.5 * l2_regularization * (weights ** 2).sum()
+
+    return Workload('logistic', loss_fn,
+                    (np.zeros(n_features), np.zeros(())))
+
+
+def mlp(n_samples=1000, n_features=20, n_hidden=50, seed=3):
+    rng = np.random.RandomState(seed)
+    x = rng.randn(n_samples, n_features)
+    y = np.sin(x[:, 0]) + 0.1 * rng.randn(n_samples)
+
+    def loss_fn(w1, b1, w2, b2):
+        h = np.tanh(np.dot(x, w1) + b1)
+        out = np.dot(h, w2) + b2
+        return ((out - y) ** 2).mean()
+
+    init_args = (0.1 * rng.randn(n_features, n_hidden),
+                 np.zeros(n_hidden),
+                 0.1 * rng.randn(n_hidden),
+                 np.zeros(()))
+    return Workload('mlp', loss_fn, init_args)
+
+
+def tracing(n=10, seed=4):
+    rng = np.random.RandomState(seed)
+    y = rng.rand(n)
+
+    def f1(x):
+        return x + 2
+
+    def f2(x):
+        return x * y
+
+    def f3(x):
+        z = np.ones(n)
+        return (x + z) ** 2
+
+    def loss_fn(x):
+        return f3(f2(f1(x))).sum()
+
+    return Workload('tracing', loss_fn, (rng.rand(n),))
+
+
+WORKLOADS = collections.OrderedDict([('svm', svm),
+                                     ('logistic', logistic),
+                                     ('mlp', mlp),
+                                     ('tracing', tracing)])
@@ -0,0 +1,514 @@
+"""
+Caches for compiled Theano functions.
+"""
+
+import os
+import sys
+import glob
+import pickle
+import inspect
+import hashlib
+import types
+import weakref
+import logging
+import numpy as np
+import theano
+
+from collections import OrderedDict
+
+import autodiff.utils as utils
+
+logger = logging.getLogger('autodiff')
+
+
+# functions of these packages are translated or escaped rather than traced,
+# so they are hashed by name
+_LIBRARY_PACKAGES = ('numpy', 'scipy', 'theano', 'autodiff')
+
+
+def _hash_value(h, x, seen, refs=None):
+    """
+    Update the hash object h with a representation of the value x. Arrays are
+    hashed by content; containers, Python functions and the attributes of
+    objects are hashed recursively. seen holds the ids of the objects already
+    hashed, to stop at reference cycles.
+
+    If refs is a list, arrays are only hashed by identity and layout, and
+    Python functions by identity rather than by source; these objects are
+    appended to refs.
+    """
+    if id(x) in seen:
+        h.update(b'<seen>')
+        return
+
+    if utils.is_memmap(x) and _memmap_identity(x) is not None:
+        # memmaps are identified by their file, rather than read into memory
+        h.update(repr(_memmap_identity(x)).encode())
+    elif isinstance(x, np.ndarray) and not x.dtype.hasobject:
+        if refs is None:
+            h.update(repr((x.dtype, x.shape)).encode())
+            h.update(np.ascontiguousarray(x).reshape(-1).view(np.uint8))
+        else:
+            h.update(repr((id(x), x.dtype, x.shape, x.strides)).encode())
+            refs.append(x)
+    elif isinstance(x, (int, float, complex, bool, str, np.number)):
+        h.update(repr(x).encode())
+    elif (isinstance(x, (types.ModuleType, type))
+          or _in_library(type(x))):
+        # library objects (such as shared variables, which are inputs of the
+        # graph rather than constants) are only hashed by type and name
+        h.update(repr(type(x)).encode())
+        h.update(repr(getattr(x, '__name__', getattr(x, 'name', None)))
+                 .encode())
+    elif isinstance(x, (list, tuple, dict)):
+        seen.add(id(x))
+        h.update(repr(type(x)).encode())
+        if isinstance(x, dict):
+            x = sorted(x.items(), key=lambda item: repr(item[0]))
+        for xi in x:
+            _hash_value(h, xi, seen, refs)
+    elif isinstance(x, types.MethodType):
+        seen.add(id(x))
+        _hash_value(h, x.__func__, seen, refs)
+        _hash_value(h, x.__self__, seen, refs)
+    elif isinstance(x, types.FunctionType):
+        seen.add(id(x))
+        if _in_library(x):
+            h.update('{0}.{1}'.format(x.__module__, x.__name__).encode())
+        else:
+            _hash_function(h, x, seen, refs)
+    elif hasattr(x, '__dict__'):
+        seen.add(id(x))
+        h.update(repr(type(x)).encode())
+        _hash_value(h, vars(x), seen, refs)
+    else:
+        # objects without a stable value representation are only hashed by
+        # type; they can not affect the compiled graph's constants
+        h.update(repr(type(x)).encode())
+
+
+def _in_library(x):
+    module = getattr(x, '__module__', None) or ''
+    return module.split('.')[0] in _LIBRARY_PACKAGES
+
+
+def _hash_code(h, pyfn):
+    code = pyfn.__code__
+    try:
+        h.update(inspect.getsource(pyfn).encode())
+    except (IOError, TypeError):
+        h.update(code.co_code)
+        h.update(repr(code.co_consts).encode())
+        h.update(repr(code.co_names).encode())
+
+
+def _hash_function(h, pyfn, seen, refs=None):
+    code = pyfn.__code__
+    if refs is None:
+        _hash_code(h, pyfn)
+    else:
+        h.update(repr((id(pyfn), id(code))).encode())
+        refs.append(pyfn)
+
+    if pyfn.__defaults__:
+        _hash_value(h, pyfn.__defaults__, seen, refs)
+    if pyfn.__kwdefaults__:
+        _hash_value(h, pyfn.__kwdefaults__, seen, refs)
+    if pyfn.__closure__:
+        for name, cell in zip(code.co_freevars, pyfn.__closure__):
+            h.update(name.encode())
+            try:
+                _hash_value(h, cell.cell_contents, seen, refs)
+            except ValueError:
+                # empty cell
+                pass
+    for name in code.co_names:
+        if name in pyfn.__globals__:
+            h.update(name.encode())
+            _hash_value(h, pyfn.__globals__[name], seen, refs)
+
+
+def _memmap_identity(x):
+    """
+    Returns a tuple identifying the data of the memmap x by its file (name,
+    size and modification time) and its position and layout in the file, or
+    None if it can not be determined.
+    """
+    position = utils.memmap_position(x)
+    if position is None:
+        return None
+    try:
+        stat = os.stat(x.filename)
+    except OSError:
+        return None
+    return (x.filename, stat.st_size, stat.st_mtime,
+            position, x.shape, x.strides, x.dtype.str)
+
+
+def source_hash(pyfn):
+    """
+    Returns a hex digest identifying the code of pyfn. Tracing bakes the
+    values pyfn references into the compiled function, so the values in its
+    closure, defaults and globals are included: arrays and numbers by value,
+    the Python functions it calls by their own source hash, and other objects
+    by the values of their attributes. Functions and objects of numpy, scipy,
+    theano and autodiff are only identified by name.
+
+    Values that are not reachable this way (for example, computed by
+    properties or held by extension types) are not included; functions that
+    depend on them should not be cached.
+
+    Hashing arrays by content is expensive, so the result is reused as long
+    as pyfn refers to the same functions and array objects (with the same
+    shapes and dtypes). Changes made to those arrays inplace are not
+    detected.
+    """
+    pyfn = getattr(pyfn, '__func__', pyfn)
+    refs = []
+    h = hashlib.sha1()
+    _hash_function(h, pyfn, set([id(pyfn)]), refs)
+    fingerprint = h.hexdigest()
+    try:
+        cached_refs, digest = _source_hashes[fingerprint]
+    except KeyError:
+        cached_refs = None
+    # the fingerprint holds ids, which are only unique while the objects live
+    if cached_refs is not None and all(r() is not None for r in cached_refs):
+        return digest
+
+    h = hashlib.sha1()
+    _hash_function(h, pyfn, set([id(pyfn)]))
+    digest = h.hexdigest()
+    _source_hashes[fingerprint] = ([weakref.ref(r) for r in refs], digest)
+    return digest
+
+
+def code_hash(pyfn):
+    """
+    Returns a hex digest of the source of pyfn alone (without the values it
+    refers to).
+    """
+    pyfn = getattr(pyfn, '__func__', pyfn)
+    try:
+        return _code_hashes[pyfn.__code__]
+    except KeyError:
+        pass
+    h = hashlib.sha1()
+    _hash_code(h, pyfn)
+    digest = _code_hashes[pyfn.__code__] = h.hexdigest()
+    return digest
+
+
+def estimate_nbytes(fn):
+    """
+    Estimates the memory (in bytes) held by the compiled Theano function fn,
+    by summing the sizes of the arrays in its storage (inputs, outputs,
+    shared variables and any intermediate results it keeps alive).
+    """
+    storage = []
+    storage_map = getattr(getattr(fn, 'fn', None), 'storage_map', None)
+    if storage_map:
+        storage.extend(storage_map.values())
+    for container in (list(getattr(fn, 'input_storage', []))
+                      + list(getattr(fn, 'output_storage', []))):
+        storage.append(getattr(container, 'storage', []))
+
+    seen = set()
+    nbytes = 0
+    for cell in storage:
+        for value in cell:
+            if id(value) not in seen:
+                seen.add(id(value))
+                nbytes += getattr(value, 'nbytes', 0)
+    return nbytes
+
+
+class LRUCache(OrderedDict):
+    """
+    A dictionary that holds at most `maxsize` items. When a new item is added
+    to a full cache, the least recently used item is discarded. If `maxsize`
+    is None, the cache is unbounded.
+    """
+
+    def __init__(self, maxsize=None):
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super(LRUCache, self).__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super(LRUCache, self).__setitem__(key, value)
+        self.move_to_end(key)
+        self.evict()
+
+    def evict(self):
+        """
+        Discards the least recently used items until the cache is within its
+        bounds.
+        """
+        if self.maxsize is not None:
+            while len(self) > self.maxsize:
+                self.discard_oldest()
+
+    def discard_oldest(self):
+        return self.popitem(last=False)
+
+
+# source hashes, keyed by a fingerprint of the functions and arrays they were
+# computed from (see `source_hash`)
+_source_hashes = LRUCache(maxsize=256)
+
+# hashes of source code, keyed by code object (see `code_hash`)
+_code_hashes = LRUCache(maxsize=1024)
+
+
+class FunctionCache(LRUCache):
+    """
+    An LRUCache of compiled Theano functions, which may additionally be
+    bounded by the estimated memory held by the functions (`max_bytes`).
+
+    The cache records hits, misses and evictions, as well as the compile time,
+    estimated size and number of hits of each entry (see `info()`).
+
+    The size of each function is estimated when it is added, and once more
+    when the next function is added (intermediate results are only allocated
+    once a function has been called); the cache keeps a running total.
+    """
+
+    def __init__(self, maxsize=None, max_bytes=None):
+        super(FunctionCache, self).__init__(maxsize=maxsize)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = dict()
+        self._nbytes = 0
+        self._unsized = []
+
+    def __delitem__(self, key):
+        super(FunctionCache, self).__delitem__(key)
+        self._forget(key)
+
+    def clear(self):
+        super(FunctionCache, self).clear()
+        self.entries.clear()
+        self._nbytes = 0
+        self._unsized = []
+
+    def _forget(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self._nbytes -= entry['nbytes']
+
+    def _set_nbytes(self, key, nbytes):
+        entry = self.entries[key]
+        self._nbytes += nbytes - entry['nbytes']
+        entry['nbytes'] = nbytes
+
+    def lookup(self, key):
+        """
+        Returns the function stored for key (or None), recording a hit or miss.
+        """
+        if key in self:
+            self.hits += 1
+            self.entries[key]['hits'] += 1
+            return self[key]
+        else:
+            self.misses += 1
+            return None
+
+    def add(self, key, fn, compile_time=None, source='compiled'):
+        """
+        Stores the function fn for key. `compile_time` is the number of
+        seconds spent tracing and compiling fn, and `source` describes where
+        it came from ('compiled' or 'disk').
+        """
+        # re-estimate the functions added since the last call of add, which
+        # have been called since
+        for old_key in self._unsized:
+            if old_key in self.entries:
+                self._set_nbytes(old_key, estimate_nbytes(
+                    OrderedDict.__getitem__(self, old_key)))
+        self._unsized = [key]
+
+        self._forget(key)
+        self.entries[key] = dict(compile_time=compile_time,
+                                 nbytes=0,
+                                 hits=0,
+                                 source=source)
+        self._set_nbytes(key, estimate_nbytes(fn))
+        self[key] = fn
+
+    def nbytes(self):
+        """
+        Returns the estimated memory held by all functions in the cache.
+        """
+        return self._nbytes
+
+    def evict(self):
+        super(FunctionCache, self).evict()
+        if self.max_bytes is not None:
+            while len(self) > 1 and self._nbytes > self.max_bytes:
+                self.discard_oldest()
+
+    def discard_oldest(self):
+        key, value = super(FunctionCache, self).discard_oldest()
+        self._forget(key)
+        self.evictions += 1
+        return key, value
+
+    def info(self):
+        """
+        Returns a dictionary describing the state of the cache.
+        """
+        nbytes = self.nbytes()
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    size=len(self),
+                    maxsize=self.maxsize,
+                    nbytes=nbytes,
+                    max_bytes=self.max_bytes,
+                    entries=[dict(key=key, **self.entries[key])
+                             for key in self.keys()])
+
+
+class DiskCache(object):
+    """
+    A persistent store of compiled Theano functions.
+
+    Entries are pickled to `path` and keyed by the identity of the Python
+    function (module and qualified name), a hash of its source, and a key
+    describing the values it refers to (see `source_hash`), the call
+    signature and the compile options. Whenever an entry is stored, entries
+    for the same function with a different source are removed (entries for
+    different values, such as closures created by the same factory, are
+    kept). If the total size of the cache exceeds `max_bytes`, the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_bytes=2 ** 30):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self):
+        return 'DiskCache({0!r}, max_bytes={1})'.format(self.path,
+                                                          self.max_bytes)
+
+    @staticmethod
+    def get_identity(pyfn):
+        pyfn = getattr(pyfn, '__func__', pyfn)
+        return '{0}.{1}'.format(getattr(pyfn, '__module__', None),
+                                getattr(pyfn, '__qualname__', pyfn.__name__))
+
+    def get_filename(self, pyfn, key):
+        """
+        Returns the filename of the entry for pyfn and key.
+        """
+        id_hash = hashlib.sha1(self.get_identity(pyfn).encode()).hexdigest()
+        key_hash = hashlib.sha1(repr((key,
+                                      source_hash(pyfn),
+                                      theano.__version__,
+                                      theano.config.floatX,
+                                      theano.config.device,
+                                      sys.version_info[:2])).encode())
+        return os.path.join(self.path, '{0}-{1}-{2}.pkl'.format(
+            id_hash[:16], code_hash(pyfn)[:16], key_hash.hexdigest()))
+
+    def load(self, pyfn, key):
+        """
+        Returns the compiled function stored for pyfn and key, or None if it
+        is not available.
+        """
+        filename = self.get_filename(pyfn, key)
+        try:
+            with open(filename, 'rb') as f:
+                fn = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as err:
+            logger.warning(
+                'Could not load cached function from {0}; it will be '
+                'recompiled. The following error was raised: {1}'.format(
+                    filename, err))
+            self._remove(filename)
+            return None
+        # mark the entry as recently used
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return fn
+
+    def store(self, pyfn, key, fn):
+        """
+        Stores the compiled function fn for pyfn and key, removing stale
+        entries for pyfn and evicting entries if the cache is too large.
+        """
+        filename = self.get_filename(pyfn, key)
+        self.invalidate(pyfn, keep=filename)
+
+        tmp_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+        try:
+            with open(tmp_filename, 'wb') as f:
+                pickle.dump(fn, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filename, filename)
+        except Exception as err:
+            logger.warning(
+                'Could not store compiled function in {0}. The following '
+                'error was raised: {1}'.format(self.path, err))
+            self._remove(tmp_filename)
+            return
+
+        self.evict()
+
+    def invalidate(self, pyfn, keep=None):
+        """
+        Removes all entries for pyfn whose source does not match the source
+        of the entry keep. If keep is None, all entries for pyfn are removed.
+        """
+        id_hash = hashlib.sha1(self.get_identity(pyfn).encode()).hexdigest()
+        if keep is None:
+            src_hash = None
+        else:
+            src_hash = os.path.basename(keep).split('-')[1]
+        for filename in glob.glob(
+                os.path.join(self.path, id_hash[:16] + '-*.pkl')):
+            if os.path.basename(filename).split('-')[1] != src_hash:
+                self._remove(filename)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is smaller
+        than max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        for filename in glob.glob(os.path.join(self.path, '*.pkl')):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        total = sum(e[1] for e in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(filename)
+            total -= size
+
+    def clear(self):
+        for filename in glob.glob(os.path.join(self.path, '*.pkl')):
+            self._remove(filename)
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
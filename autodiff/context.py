@@ -1,5 +1,7 @@
+import os
 import builtins
 import logging
+import warnings
 import copy
 import meta
 from ast import *
@@ -12,6 +14,8 @@ import autodiff
 import autodiff.utils as utils
 import autodiff.functions
 import collections
+from autodiff.stats import null_timer
+from autodiff.cache import LRUCache
 
 
 logger = logging.getLogger('autodiff')
@@ -172,6 +176,132 @@ def isvar_ast(name):
     return isvar
 
 
+# the ids of Python's builtins, so they can be recognized without comparing
+# against every builtin
+_BUILTIN_IDS = frozenset(id(v) for v in builtins.__dict__.values())
+
+
+def _numpy_to_theano_table():
+    """
+    Returns a dictionary mapping the id of each NumPy function whose name is
+    also a Theano function to a tuple (NumPy function, Theano function).
+    """
+    table = dict()
+    for name in dir(np):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            func = getattr(np, name, None)
+        if type(func) is type or not callable(func):
+            continue
+        t_name = getattr(func, '__name__', None)
+        if isinstance(t_name, str) and hasattr(T, t_name):
+            table[id(func)] = (func, getattr(T, t_name))
+    return table
+
+
+_NUMPY_TO_THEANO = _numpy_to_theano_table()
+
+
+# transformed code objects shared by all contexts, keyed by the original code
+# object and the transformation options (see `Context.get_transformed_code`)
+_code_cache = LRUCache(maxsize=4096)
+
+
+def clear_code_cache():
+    """
+    Discards all cached transformed code, so that functions are parsed and
+    transformed again the next time they are recompiled.
+    """
+    _code_cache.clear()
+
+
+def strip_signature_values(func_def):
+    """
+    Removes the default values and annotations from the arguments of the
+    FunctionDef node func_def (inplace), since they are evaluated when the
+    function is defined.
+    """
+    args = func_def.args
+    args.defaults = []
+    args.kw_defaults = [None] * len(args.kwonlyargs)
+    for a in (getattr(args, 'posonlyargs', []) + args.args + args.kwonlyargs
+              + [args.vararg, args.kwarg]):
+        if isinstance(a, arg):
+            a.annotation = None
+    func_def.returns = None
+    return func_def
+
+
+def _source_mtime(f):
+    """
+    Returns the modification time of the file containing the source of f, or
+    None if it is not available.
+    """
+    try:
+        return os.stat(f.__code__.co_filename).st_mtime
+    except (OSError, AttributeError, TypeError, ValueError):
+        return None
+
+
+def closure_values(func):
+    """
+    Returns a tuple of the current contents of the closure cells of func
+    (None for an empty cell).
+    """
+    values = []
+    for cell in getattr(func, '__closure__', None) or ():
+        try:
+            values.append(cell.cell_contents)
+        except ValueError:
+            values.append(None)
+    return tuple(values)
+
+
+def recompile_key(func):
+    """
+    Returns a key identifying the recompiled version of the user function
+    func: its code object and the identity of the current contents of its
+    closure cells, its defaults and its bound object. Functions with equal
+    keys (for example, a helper defined in a loop) have the same recompiled
+    version, and a cell that is rebound during the trace gives a new key.
+    Returns None if func is not a Python function.
+    """
+    code = getattr(func, '__code__', None)
+    if not isinstance(code, types.CodeType):
+        return None
+    return (code,
+            tuple(id(v) for v in closure_values(func)),
+            id(getattr(func, '__defaults__', None)),
+            id(getattr(func, '__self__', None)))
+
+
+def dispatch_category(func):
+    """
+    Returns the kind of function func is, as dispatched by
+    `TheanoTransformer.handle_functions`. Used for statistics.
+    """
+    module = getattr(func, '__module__', None) or ''
+    if (module.startswith('autodiff')
+            or isinstance(func, autodiff.symbolic.Symbolic)):
+        return 'autodiff'
+    elif utils.isvar(getattr(func, '__self__', None)):
+        return 'tensor_method'
+    elif (module.startswith('theano')
+            or hasattr(func, '__theano_op__')
+            or isinstance(func, T.elemwise.Elemwise)):
+        return 'theano'
+    elif type(func) is type:
+        return 'type'
+    elif (module.startswith('numpy')
+            or isinstance(func, np.ufunc)
+            or inspect.getmodule(func) is np):
+        return 'numpy'
+    elif '<built-in' in str(func):
+        return 'builtin'
+    else:
+        return 'python'
+
+
 class Context(object):
 
     def __init__(self,
@@ -179,7 +309,14 @@ class Context(object):
                  force_floatX=False,
                  ignore=None,
                  infer_updates=False,
-                 escape_on_error=False):
+                 escape_on_error=False,
+                 specialize='ndim',
+                 zero_copy=False,
+                 stats=None):
+        if specialize not in ('ndim', 'broadcast', 'shape'):
+            raise ValueError(
+                '`specialize` must be one of \'ndim\', \'broadcast\' or '
+                '\'shape\'. Received: {0}'.format(specialize))
         self.sym_vars = dict()
         self.tags = dict()
         # FIXME do we need to hold on to all of these itermediates?
@@ -192,7 +329,21 @@ class Context(object):
         self.force_floatX = force_floatX
         self.ignore = utils.as_seq(ignore, tuple)
         self.escape_on_error = escape_on_error
+        self.specialize = specialize
+        self.zero_copy = zero_copy
+        # shared variables that alias traced arrays only because of zero_copy
+        self._borrowed = set()
         self.shadowed_containers = dict()
+        # an autodiff.stats.Stats instance, or None
+        self.stats = stats
+        # the results of TheanoTransformer.handle_functions, keyed by the id
+        # of the function (values are (function, result) tuples, which also
+        # keeps the ids from being reused). Recompiled user functions depend
+        # on the traced values they shadow, so they are kept separately (by
+        # `recompile_key`, with values (function, result, closure values))
+        # and only for the current trace.
+        self._dispatch_cache = dict()
+        self._recompiled = dict()
 
     def recompile(self, f, nested=False):
         """
@@ -206,16 +357,18 @@ class Context(object):
             transforming nested functions. In this case, we want to use the
             same context but keep it when calling recompile.
         """
-        transformer = TheanoTransformer(context=self)
-
-        f_ast = get_ast(f)
+        if self.stats is not None:
+            self.stats.count('recompile_nested' if nested else 'recompile')
 
         if not nested:
-            self._top_def = f_ast
             self.tags.clear()
 
-        transformed_ast = fix_missing_locations(transformer.visit(f_ast))
+        code = self.get_transformed_code(f, nested=nested)
 
+        # bind the transformed code to a new transformer and to shadowed
+        # versions of the globals and closure values it refers to. This
+        # depends on the current trace, so it is redone for every call.
+        transformer = TheanoTransformer(context=self)
         f_globals = f.__globals__.copy()
         f_globals.update(dict(_ctx__=transformer,
                               _functions__=autodiff.functions,
@@ -230,10 +383,61 @@ class Context(object):
             if name in f_globals.keys():
                 f_globals[name] = transformer.shadow(f_globals[name])
 
+        new_f = types.FunctionType(code, f_globals, code.co_name)
+
+        # add defaults, if necessary (the transformed code has none)
+        if f.__defaults__:
+            new_f.__defaults__ = utils.clean_int_args(*f.__defaults__)[0]
+        if getattr(f, '__kwdefaults__', None):
+            new_f.__kwdefaults__ = utils.clean_int_args(**f.__kwdefaults__)[1]
+
+        # recreate method, if necessary
+        if isinstance(f, types.MethodType):
+            new_f = types.MethodType(new_f, f.__self__)
+
+        return new_f
+
+    def get_transformed_code(self, f, nested=False):
+        """
+        Returns the code object of f transformed to operate on Theano objects.
+
+        The transformed code only depends on the source of f and on the
+        options of the transformation, so it is cached by the code object of
+        f (shared by every closure and every call site of a function) in a
+        cache shared by all contexts. An entry is discarded if the file
+        containing the source of f has been modified since it was
+        transformed.
+        """
+        key = (f.__code__, nested, self.infer_updates)
+        mtime = _source_mtime(f)
+        try:
+            cached = _code_cache[key]
+        except KeyError:
+            cached = None
+        if cached is not None and cached[1] == mtime:
+            if self.stats is not None:
+                self.stats.count('code_cache.hit')
+            return cached[0]
+
+        transformer = TheanoTransformer(context=self)
+
+        with self.timed('get_ast', f):
+            f_ast = get_ast(f)
+
+        if not nested:
+            self._top_def = f_ast
+
+        with self.timed('transform', f):
+            transformed_ast = fix_missing_locations(transformer.visit(f_ast))
+
+        # globals are bound by `recompile`, so the def must not evaluate
+        # anything that refers to them (`recompile` restores the defaults)
+        strip_signature_values(transformed_ast)
         try:
-            new_f = meta.decompiler.compile_func(ast_node=transformed_ast,
-                                                 filename='<Context-AST>',
-                                                 globals=f_globals)
+            with self.timed('compile_func', f):
+                new_f = meta.decompiler.compile_func(ast_node=transformed_ast,
+                                                     filename='<Context-AST>',
+                                                     globals=dict())
         except SyntaxError as err:
             if "'return' with argument inside generator" in err.message:
                 if isinstance(transformed_ast.body[-1], Return):
@@ -241,21 +445,23 @@ class Context(object):
                     new_f = meta.decompiler.compile_func(
                         ast_node=transformed_ast,
                         filename='<Context-AST>',
-                        globals=f_globals)
+                        globals=dict())
             else:
                 raise
         except:
             raise
 
-        # add defaults, if necessary (meta erases them and won't recompile!)
-        if f.__defaults__:
-            new_f.__defaults__ = utils.clean_int_args(*f.__defaults__)[0]
-
-        # recreate method, if necessary
-        if isinstance(f, types.MethodType):
-            new_f = types.MethodType(new_f, f.__self__)
+        _code_cache[key] = (new_f.__code__, mtime)
+        return new_f.__code__
 
-        return new_f
+    def timed(self, phase, function=None):
+        """
+        Returns a context manager that records the wall time of its block as
+        `phase` if statistics are collected (see `autodiff.stats.Stats`).
+        """
+        if self.stats is None:
+            return null_timer
+        return self.stats.timed(phase, function)
 
     def get_symbolic(self, x):
         """
@@ -296,12 +502,51 @@ class Context(object):
                 'it was not traced because it did not appear in the '
                 'function.'.format(x))
 
+    def copy_borrowed(self, variables):
+        """
+        Replaces the values of any shared variables in `variables` that alias
+        traced arrays because of zero-copy tracing with copies, so that the
+        compiled function does not depend on (or modify) those arrays.
+        """
+        for v in variables:
+            if v in self._borrowed:
+                v.set_value(v.get_value(borrow=True), borrow=False)
+                self._borrowed.discard(v)
+
+    def release(self, inputs=None):
+        """
+        Drops the tracing state that is only needed while a function is being
+        traced: the id-keyed symbolic variables, the objects pinned to
+        prevent id reuse and the inferred updates. Tags (and the tagged
+        function arguments) are kept, so they remain available after a
+        function has been compiled.
+
+        inputs : shared variables that compiled functions have replaced with
+            new inputs. Their (traced) values are no longer needed and are
+            replaced with empty arrays.
+        """
+        for key in [k for k in self.sym_vars if not isinstance(k, str)]:
+            del self.sym_vars[key]
+        self._nogc = []
+        self._borrowed.clear()
+        self.shadowed_containers.clear()
+        self._recompiled.clear()
+        self.updates = collections.OrderedDict()
+
+        for i in utils.as_seq(inputs):
+            if isinstance(i, T.sharedvar.TensorSharedVariable):
+                empty = np.empty(tuple(1 if b else 0 for b in i.broadcastable),
+                                 dtype=i.dtype)
+                i.set_value(empty, borrow=True)
+
     def reset(self):
         self.sym_vars.clear()
         self.tags.clear()
         self._nogc = []
+        self._borrowed.clear()
         self._top_node = None
         self.shadowed_containers.clear()
+        self._recompiled.clear()
 
 
 class TheanoTransformer(NodeTransformer):
@@ -354,9 +599,10 @@ class TheanoTransformer(NodeTransformer):
         variable and store the relationship in self.sym_vars. Otherwise return
         x.
         """
-        # try checking if x is ignored (will fail for NumPy arrays)
+        # try checking if x is ignored (will fail for NumPy arrays). Memmaps
+        # are skipped, since comparing them would read them into memory.
         try:
-            if x in self.context.ignore:
+            if not isinstance(x, np.memmap) and x in self.context.ignore:
                 return x
         except:
             pass
@@ -393,29 +639,68 @@ class TheanoTransformer(NodeTransformer):
 
                 # check if symbolic variable should be copied or borrowed
                 borrow = id_x in self.context.borrowable
-
-                # cast x if requested
-                if self.context.force_floatX:
-                    x = np.array(x, dtype=theano.config.floatX)
+                zero_copy = self.context.zero_copy and not borrow
+
+                # memory-mapped arrays are always aliased, so they are not
+                # read into memory, and are cast symbolically
+                is_memmap = utils.is_memmap(x)
+                if is_memmap:
+                    borrow = True
+                    zero_copy = False
+
+                # cast x if requested. If a new array is created, it can
+                # always be borrowed.
+                if self.context.force_floatX and not is_memmap:
+                    cast_x = np.asarray(x, dtype=theano.config.floatX)
+                    if cast_x is not x:
+                        borrow = True
+                        zero_copy = False
+                    x = cast_x
+
+                # specialize the broadcastable pattern, if requested
+                kwargs = dict()
+                if (self.context.specialize in ('broadcast', 'shape')
+                        and getattr(x, 'ndim', 0) > 0):
+                    kwargs['broadcastable'] = tuple(d == 1 for d in x.shape)
 
                 # create symbolic version
                 try:
-                    sym_x = theano.shared(x, borrow=borrow)
+                    sym_x = theano.shared(x,
+                                          borrow=borrow or zero_copy,
+                                          **kwargs)
                 except:
                     sym_x = theano.shared(x)
+                    zero_copy = False
+
+                if zero_copy:
+                    self.context._borrowed.add(sym_x)
+
+                if self.context.stats is not None:
+                    self.context.stats.count('shadowed')
 
                 # store symbolic version
                 self.context.sym_vars[id_x] = sym_x
 
                 # return symbolic version
-                return sym_x
+                return self._cast_memmap(x, sym_x)
             else:
-                return self.context.sym_vars[id(x)]
+                return self._cast_memmap(x, self.context.sym_vars[id(x)])
 
         else:
             return x
 
 
+    def _cast_memmap(self, x, sym_x):
+        """
+        Memory-mapped arrays are shadowed by shared variables of their own
+        dtype; if force_floatX is True, the traced expression casts them.
+        """
+        if (self.context.force_floatX
+                and sym_x.dtype != theano.config.floatX
+                and utils.is_memmap(x)):
+            return T.cast(sym_x, theano.config.floatX)
+        return sym_x
+
     # ==================================================
     # ==================================================
     #
@@ -533,6 +818,41 @@ class TheanoTransformer(NodeTransformer):
 
         Generally used to exchange NumPy functions for Theano equivalents.
         """
+        if self.context.stats is not None:
+            self.context.stats.count('dispatch.' + dispatch_category(func))
+
+        cached = self.context._dispatch_cache.get(id(func))
+        if cached is not None and cached[0] is func:
+            return cached[1]
+
+        key = recompile_key(func)
+        if key is not None and key in self.context._recompiled:
+            return self.context._recompiled[key][1]
+
+        result = self._handle_functions(func)
+        if ((key is None or key not in self.context._recompiled)
+                and self.is_cacheable(func)):
+            self.context._dispatch_cache[id(func)] = (func, result)
+        return result
+
+    @staticmethod
+    def is_cacheable(func):
+        """
+        Returns True if the result of `handle_functions` for func depends
+        only on func (and the context), so it can be reused every time func
+        is called. Bound methods (other than those of modules and NumPy's
+        global random state) are excluded, because they are created anew on
+        every access or depend on the state of their object, as are autodiff
+        Symbolic objects, which may be rebound.
+        """
+        if isinstance(func, autodiff.symbolic.Symbolic):
+            return False
+        func_self = getattr(func, '__self__', None)
+        return (func_self is None
+                or isinstance(func_self, types.ModuleType)
+                or func_self is getattr(np.random.uniform, '__self__', None))
+
+    def _handle_functions(self, func):
 
         # ** ======================= first handle functions defined here!
 
@@ -643,7 +963,7 @@ class TheanoTransformer(NodeTransformer):
                 return enumerate_
 
             # any other builtin function (tuple, list, set, Exception)
-            elif func in builtins.__dict__.values():
+            elif id(func) in _BUILTIN_IDS:
                 return func
 
             else:
@@ -792,6 +1112,9 @@ class TheanoTransformer(NodeTransformer):
                 return reduce_
 
             # get equivalent Theano function
+            elif id(func) in _NUMPY_TO_THEANO:
+                return _NUMPY_TO_THEANO[id(func)][1]
+
             elif hasattr(T, func.__name__):
                 return getattr(T, func.__name__)
 
@@ -923,7 +1246,7 @@ class TheanoTransformer(NodeTransformer):
 
         else:
             try:
-                return self.context.recompile(func, nested=True)
+                new_func = self.context.recompile(func, nested=True)
             except Exception as err:
                 if self.context.escape_on_error:
                     logger.warning(
@@ -931,12 +1254,19 @@ class TheanoTransformer(NodeTransformer):
                         'because escape_on_error is True.'.format(func))
                     def escapedfunc(*args, **kwargs):
                         return self.handle_escaped_call(func, *args, **kwargs)
-                    return escapedfunc
+                    new_func = escapedfunc
                 else:
                     raise ValueError(
                         'Unsupported function: {}. The following error was '
                         'raised: {}'.format(func, err))
 
+            # reuse the recompiled function for the rest of the trace
+            key = recompile_key(func)
+            if key is not None:
+                self.context._recompiled[key] = (func, new_func,
+                                                 closure_values(func))
+            return new_func
+
         # ** ======================= Catchall (shouldn't be called)
 
         raise ValueError(
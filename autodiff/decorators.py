@@ -1,4 +1,5 @@
-from autodiff.symbolic import Symbolic, Function, Gradient, HessianVector
+from autodiff.symbolic import (Symbolic, Function, Gradient, HessianVector,
+                               Jacobian, Hessian)
 import collections
 
 
@@ -92,6 +93,67 @@ def hessian_vector(fn=None, **kwargs):
         return hv_wrapper
 
 
+def jacobian(fn=None, **kwargs):
+    """
+    Wraps a function with an AutoDiff Jacobian instance, converting it to a
+    symbolic representation that returns the Jacobian of its outputs with
+    respect to either all inputs or a subset (if specified with the 'wrt'
+    keyword).
+
+    The function is compiled the first time it is called.
+    Use:
+
+        @jacobian
+        def python_function(...):
+            return do_something()
+
+        python_function(...) # returns the Jacobian of python_function
+
+    Pass keywords to Jacobian:
+
+        @jacobian(wrt='x', jacobian_method='rop')
+        def python_function(x=1, y=2):
+            return do_something()
+
+    """
+    if isinstance(fn, collections.Callable):
+        return Jacobian(fn, **kwargs)
+    else:
+        def jacobian_wrapper(pyfn):
+            return Jacobian(pyfn, **kwargs)
+        return jacobian_wrapper
+
+
+def hessian(fn=None, **kwargs):
+    """
+    Wraps a function with an AutoDiff Hessian instance, converting it to a
+    symbolic representation that returns the dense Hessian with respect to
+    either all inputs or a subset (if specified with the 'wrt' keyword).
+
+    The function is compiled the first time it is called.
+    Use:
+
+        @hessian
+        def python_function(...):
+            return do_something()
+
+        python_function(...) # returns the Hessian of python_function
+
+    Pass keywords to Hessian:
+
+        @hessian(wrt='x', jacobian_method='rop')
+        def python_function(x=1, y=2):
+            return do_something()
+
+    """
+    if isinstance(fn, collections.Callable):
+        return Hessian(fn, **kwargs)
+    else:
+        def hessian_wrapper(pyfn):
+            return Hessian(pyfn, **kwargs)
+        return hessian_wrapper
+
+
 def as_symbolic(fn=None, **kwargs):
     """
     Wraps a function with an AutoDiff Symbolic instance, meaning it will act
@@ -2,229 +2,640 @@
 Function minimization drivers based on stochastic gradient descent (SGD).
 
 """
-import gc
 import logging
-import sys
+import queue
+import threading
 import time
+from collections import OrderedDict
 
 import numpy as np
-
 import theano
+import theano.tensor as T
+from theano.ifelse import ifelse
 
-from .context import Context
-from .utils import flat_from_doc, doc_from_flat
-from .utils import post_collect
+from autodiff.symbolic import Symbolic
+import autodiff.utils as utils
 
-logger = logging.getLogger(__name__)
-info = logger.info
-warn = logger.warn
+logger = logging.getLogger('autodiff')
 
+__all__ = ['FMinSGD', 'fmin_sgd', 'StreamFeeder',
+           'sgd', 'momentum', 'adagrad', 'adam']
 
-raise NotImplementedError(
-    'fmin_sgd is a legacy file not supported in the current version of '
-    'PyAutoDiff (yet!)')
 
+#========= Update rules
+#
+# Each rule takes the (shared) parameters, their gradients and a symbolic step
+# size, and returns an OrderedDict of updates for the parameters and any
+# state the rule keeps in new shared variables.
 
-class FMinSGD(object):
+
+def _zeros_like(p):
+    value = p.get_value(borrow=True)
+    return theano.shared(np.zeros(value.shape, dtype=value.dtype),
+                         broadcastable=p.broadcastable)
+
+
+def sgd(params, grads, step_size):
+    """
+    Plain stochastic gradient descent: p <- p - step_size * g
+    """
+    updates = OrderedDict()
+    for p, g in zip(params, grads):
+        updates[p] = p - T.cast(step_size, p.dtype) * g
+    return updates
+
+
+def momentum(params, grads, step_size, momentum=0.9, nesterov=False):
+    """
+    SGD with (optionally Nesterov) momentum.
+    """
+    updates = OrderedDict()
+    for p, g in zip(params, grads):
+        v = _zeros_like(p)
+        new_v = T.cast(momentum, p.dtype) * v - T.cast(step_size, p.dtype) * g
+        updates[v] = new_v
+        if nesterov:
+            updates[p] = p + T.cast(momentum, p.dtype) * new_v \
+                - T.cast(step_size, p.dtype) * g
+        else:
+            updates[p] = p + new_v
+    return updates
+
+
+def adagrad(params, grads, step_size, epsilon=1e-6):
     """
-    An iterator implementing the stochastic gradient descent algorithm.
-    On each iteration, this function increments each of self.current_args by
-    `-step_size` times its gradient gradient wrt `fn`, and returns the current
-    [stochastic] calculation of `fn`.
+    Adagrad: steps are scaled by the inverse root of the accumulated squared
+    gradients of each parameter.
+    """
+    updates = OrderedDict()
+    for p, g in zip(params, grads):
+        acc = _zeros_like(p)
+        new_acc = acc + g ** 2
+        updates[acc] = new_acc
+        updates[p] = p - (T.cast(step_size, p.dtype) * g
+                          / (T.sqrt(new_acc) + T.cast(epsilon, p.dtype)))
+    return updates
+
 
+def adam(params, grads, step_size, beta1=0.9, beta2=0.999, epsilon=1e-8):
+    """
+    Adam: steps are based on bias-corrected running averages of the gradients
+    and squared gradients of each parameter.
     """
-    def __init__(self, fn, args, streams, step_size, loops=1,
-            step_size_backoff=0.25,
-            theano_mode=None,
-            theano_device=None,
-            rseed=12345,
-            floatX='float64',
-            ):
-        """
-        fn - a callable taking *(args + (stream[i],))
-        args - the arguments of fn, which this function will search
-        stream - a dictionary of iterables (i.e. struct of arrays)
-                 These must all have the same length, and FMinSGD will iterate
-                 through them jointly, passing the i'th element of each
-                 sequence to `fn` to get a gradient estimate.
-        step_size - a multiplier on the negative gradient used for search
-            - a float will be used for all args
-            - a tuple of floats will use each float for each arg
-            - a tuple of ndarrays will use each ndarray for each arg
-            - floats and ndarrays can both be used in a tuple here
-        theano_mode - (API leak) how to compile the underlying theano
-                function.
-        theano_device - (API leak) optional string to force cpu/gpu execution
+    updates = OrderedDict()
+    t = theano.shared(np.asarray(0, dtype='int64'))
+    new_t = t + 1
+    updates[t] = new_t
+    for p, g in zip(params, grads):
+        m = _zeros_like(p)
+        v = _zeros_like(p)
+        new_m = beta1 * m + (1 - beta1) * g
+        new_v = beta2 * v + (1 - beta2) * g ** 2
+        m_hat = new_m / (1 - beta1 ** new_t)
+        v_hat = new_v / (1 - beta2 ** new_t)
+        updates[m] = T.cast(new_m, p.dtype)
+        updates[v] = T.cast(new_v, p.dtype)
+        updates[p] = T.cast(
+            p - step_size * m_hat / (T.sqrt(v_hat) + epsilon), p.dtype)
+    return updates
+
+
+_update_rules = dict(sgd=sgd, momentum=momentum, adagrad=adagrad, adam=adam)
+
+
+#========= Data feeding
+
+
+class StreamFeeder(object):
+    """
+    Feeds minibatches from out-of-core data to `FMinSGD`.
+
+    Data is read in chunks of `chunk_batches` minibatches by a background
+    thread, which copies them into two preallocated buffers in turn: while
+    the update function runs on one buffer, the next chunk is read into the
+    other. FMinSGD swaps the buffers into its shared stream variables with
+    `set_value(borrow=True)`, so nothing is reallocated or copied again.
+
+    The background thread runs until the source is exhausted or `close` is
+    called (FMinSGD closes its feeder when it is exhausted, closed or
+    garbage collected). A feeder can also be used as a context manager.
+    """
+
+    def __init__(self, source, batch_size, chunk_batches=64, loops=1):
         """
-        self.rng = np.random.RandomState(rseed)
-        self.step_size_backoff = step_size_backoff
+        Arguments
+        ---------
 
-        ctxt = Context(device=theano_device, floatX=floatX)
+        source : dict or callable
+            Either a dict mapping stream names to arrays, memory-mapped arrays
+            or paths of .npy files (which are memory-mapped), or a callable
+            returning an iterator of dicts of arrays (chunks of rows of any
+            length). The callable is called once per loop.
 
-        s_streams0 = {} # -- symbolic element dictionary
-        streams0 = {}  # -- non-symbolic first element dictionary
-        _len = sys.maxint
-        s_stream_idx = ctxt.shared(np.asarray(0), name='stream_idx')
-        s_idxs = ctxt.shared(self.rng.randint(2, size=3), name='idxs')
-        s_idx = s_idxs[s_stream_idx]
-        for key, stream in streams.items():
-            stream0 = stream[0]
-            s_stream = ctxt.shared(stream, borrow=True)
-            s_stream_i = s_stream[s_idx]
-            assert s_stream_i.dtype == str(stream0.dtype)
-            if hasattr(stream, 'shape'):
-                # -- if stream is a tensor, then all elements have same size
-                #    so bake stream0's size into the function.
-                ctxt.shadow(stream0, s_stream_i.reshape(stream0.shape))
-            else:
-                raise NotImplementedError('non ndarray stream', stream)
-            streams0[key] = stream0
-            s_streams0[key] = s_stream_i
-            _len = min(_len, len(stream))
+        batch_size : int
+            The number of rows in a minibatch.
 
-        # -- pass params as args, streams as kwawrgs
-        cost = ctxt.call(fn, args, streams0)
+        chunk_batches : int
+            The number of minibatches in each buffer.
 
-        flat_args = flat_from_doc(args)
+        loops : int
+            The number of passes through the source.
 
-        s_args = [ctxt.svars[id(w)] for w in flat_args]
-        s_cost = ctxt.svars[id(cost)]
+        """
+        if isinstance(source, dict):
+            self._arrays = OrderedDict()
+            for key, value in sorted(source.items()):
+                if isinstance(value, str):
+                    value = np.load(value, mmap_mode='r')
+                self._arrays[key] = value
+            lengths = [len(a) for a in self._arrays.values()]
+            if not lengths or min(lengths) != max(lengths):
+                raise ValueError('source must be a non-empty dict of arrays '
+                                 'of equal length.')
+            self._source = None
+            first = self._arrays
+        elif callable(source):
+            self._arrays = None
+            self._source = source
+            self._iterator = iter(source())
+            first = next(self._iterator)
+            self._first = first
+        else:
+            raise TypeError('source must be a dict or a callable returning '
+                            'an iterator of dicts.')
 
-        # -- if step_size is a scalar, expand it out to match the args
-        try:
-            float(step_size)
-            step_size = (step_size,) * len(args)
-        except TypeError:
-            pass
+        self.batch_size = batch_size
+        self.chunk_batches = chunk_batches
+        self.loops = loops
+        self.capacity = batch_size * chunk_batches
+        self._sample = dict((k, np.array(v[:batch_size]))
+                            for k, v in first.items())
+        self.buffers = [
+            OrderedDict((k, np.empty((self.capacity,) + v.shape[1:],
+                                     dtype=v.dtype))
+                        for k, v in sorted(first.items()))
+            for i in range(2)]
+
+        self._free = queue.Queue()
+        self._free.put(0)
+        self._free.put(1)
+        self._ready = queue.Queue()
+        self._current = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def sample(self):
+        """
+        Returns the first minibatch of the source (used for tracing).
+        """
+        return self._sample
 
-        s_step_sizes = [ctxt.shared(np.asarray(step)) for step in step_size]
-        if len(s_step_sizes) != len(args):
-            raise ValueError('len of step_size tuple must match len of args')
+    def next_chunk(self):
+        """
+        Releases the current buffer and returns the next filled buffer (a
+        dict of arrays) and the number of minibatches it holds, or (None, 0)
+        if the source is exhausted or the feeder is closed.
+        """
+        if self._closed:
+            return None, 0
+        if self._current is not None:
+            self._free.put(self._current)
+            self._current = None
+        idx, rows = self._ready.get()
+        if isinstance(idx, Exception):
+            raise idx
+        elif idx is None:
+            # let later calls see the end of the source too
+            self._ready.put((None, 0))
+            return None, 0
+        self._current = idx
+        return self.buffers[idx], rows // self.batch_size
+
+    def close(self):
+        """
+        Stops the background thread. The feeder can not be used afterwards.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._free.put(None)
+        self._current = None
 
-        s_costs = ctxt.shared(np.zeros(3, dtype=s_cost.dtype), name='costs')
+    def __enter__(self):
+        return self
 
-        del ctxt
-        gc.collect()
+    def __exit__(self, *exc_info):
+        self.close()
 
-        #theano.printing.debugprint(s_cost)
+    def _chunks(self):
+        for loop in range(self.loops):
+            if self._arrays is not None:
+                n = len(next(iter(self._arrays.values())))
+                for start in range(0, n, self.capacity):
+                    yield dict((k, a[start: start + self.capacity])
+                               for k, a in self._arrays.items())
+            else:
+                if loop == 0:
+                    yield self._first
+                    iterator = self._iterator
+                    del self._first, self._iterator
+                else:
+                    iterator = iter(self._source())
+                for chunk in iterator:
+                    yield chunk
+
+    def _produce(self):
+        try:
+            idx = None
+            for chunk in self._chunks():
+                if self._closed:
+                    return
+                length = len(next(iter(chunk.values())))
+                pos = 0
+                while pos < length:
+                    if idx is None:
+                        idx = self._free.get()
+                        if idx is None:
+                            return
+                        rows = 0
+                    n = min(self.capacity - rows, length - pos)
+                    for key, buf in self.buffers[idx].items():
+                        buf[rows: rows + n] = chunk[key][pos: pos + n]
+                    rows += n
+                    pos += n
+                    if rows == self.capacity:
+                        self._ready.put((idx, rows))
+                        idx = None
+            if idx is not None and rows >= self.batch_size:
+                self._ready.put((idx, rows))
+            self._ready.put((None, 0))
+        except Exception as err:
+            self._ready.put((err, 0))
+
+
+#========= Driver
 
-        g_args = theano.tensor.grad(s_cost, s_args,
-                disconnected_inputs='warn',
-                )
 
-        # -- shared var into which we will write stream entries
-        updates = [(a, a - theano.tensor.cast(s_step, a.dtype) * g)
-                for s_step, a, g, in zip(s_step_sizes, s_args, g_args)]
+class FMinSGD(object):
+    """
+    An iterator implementing stochastic gradient descent (and its variants).
+    On each iteration, the parameters are updated with the gradient of `fn`
+    on one minibatch of the streams, and the [stochastic] value of `fn` on
+    that minibatch is returned.
+
+    The parameter updates, minibatch indexing and cost bookkeeping are all
+    compiled into a single Theano function without inputs or outputs, so that
+    `nextN` can run many iterations with one call to Theano's C virtual
+    machine.
+    """
 
-        updates += [(s_stream_idx, s_stream_idx + 1)]
-        updates += [(s_costs,
-            theano.tensor.inc_subtensor(s_costs[s_stream_idx], s_cost))]
+    def __init__(self,
+                 fn,
+                 args,
+                 streams,
+                 step_size,
+                 batch_size=None,
+                 method='sgd',
+                 method_kwargs=None,
+                 loops=None,
+                 step_size_backoff=0.25,
+                 theano_mode=None,
+                 rseed=12345,
+                 force_floatX=False,
+                 borrowable=None,
+                 ignore=None):
+        """
+        Arguments
+        ---------
+
+        fn : callable
+            A function called as fn(*args, **minibatch), where minibatch maps
+            each key of `streams` to a minibatch of that stream, returning a
+            scalar cost.
+
+        args : sequence of arrays
+            The initial values of the parameters to optimize.
+
+        streams : dict of arrays or StreamFeeder
+            The data, as a struct of arrays. The arrays must all have the same
+            length; FMinSGD iterates through them jointly along their first
+            axis. Data that does not fit in memory can be read by a
+            `StreamFeeder`, in which case `batch_size` and `loops` are taken
+            from the feeder, and each buffer it fills is visited once (in a
+            random order of minibatches).
+
+        step_size : float
+            The step size (learning rate) of the update rule.
+
+        batch_size : int
+            The number of elements of each stream in a minibatch. If None,
+            fn is passed single elements of the streams (stream[i]).
+
+        method : str or callable
+            The update rule: 'sgd', 'momentum', 'adagrad', 'adam', or a
+            function with the signature of `sgd` returning an OrderedDict of
+            shared variable updates.
+
+        method_kwargs : dict
+            Additional keyword arguments for the update rule (for example,
+            `momentum` or `beta1`).
+
+        loops : int
+            The number of passes (epochs) through the streams (default 1).
+            With a StreamFeeder, the number of passes is set by the feeder,
+            and passing `loops` raises ValueError.
+
+        step_size_backoff : float
+            The factor applied to the step size when the cost stops
+            decreasing, or when steps are skipped because the cost or the
+            updated parameters became non-finite (skipped steps leave the
+            parameters unchanged).
+
+        theano_mode :
+            The mode used to compile the update function.
 
-        update_fn = theano.function([], [],
-                updates=updates,
-                mode=theano_mode,
-                #profile=1,
-                )
+        """
+        self.rng = np.random.RandomState(rseed)
+        self.step_size_backoff = step_size_backoff
 
-        # theano.printing.debugprint(update_fn)
+        if isinstance(method, str):
+            if method not in _update_rules:
+                raise ValueError(
+                    'Unrecognized method: {0} (must be one of {1}).'.format(
+                        method, sorted(_update_rules)))
+            method = _update_rules[method]
+
+        # -- parameters are traced as (copied) shared variables
+        args = tuple(np.asarray(a) for a in utils.as_seq(args))
+
+        if isinstance(streams, StreamFeeder):
+            if loops is not None:
+                raise ValueError('The number of loops through a StreamFeeder '
+                                 'is set by the feeder.')
+            feeder = streams
+            batch_size = feeder.batch_size
+            samples = feeder.sample()
+            streams = feeder.buffers[0]
+            # -- set when the first buffer is swapped in
+            n_batches = 0
+        else:
+            feeder = None
+            if loops is None:
+                loops = 1
+            lengths = [len(stream) for stream in streams.values()]
+            if not lengths or min(lengths) != max(lengths):
+                raise ValueError('streams must be a non-empty dict of arrays '
+                                 'of equal length.')
+            if batch_size is None:
+                n_batches = lengths[0]
+                samples = dict((k, np.asarray(s[0]))
+                               for k, s in streams.items())
+            else:
+                n_batches = lengths[0] // batch_size
+                samples = dict((k, np.asarray(s[:batch_size]))
+                               for k, s in streams.items())
+            if n_batches == 0:
+                raise ValueError('streams are shorter than batch_size.')
+
+        symbolic = Symbolic(fn,
+                            force_floatX=force_floatX,
+                            borrowable=borrowable,
+                            ignore=ignore)
+        _, cost = symbolic.trace(*args, **samples)
+        s_cost = symbolic.get_symbolic(cost)
+        if s_cost.ndim != 0:
+            raise TypeError('fn must return a scalar cost.')
+        s_args = [symbolic.get_symbolic(a) for a in args]
+
+        # -- the streams live in shared variables; the minibatches are
+        #    selected by the index of the current iteration (s_pos) into a
+        #    list of minibatch offsets (s_idxs), set by nextN.
+        s_pos = theano.shared(np.asarray(0, dtype='int64'), name='pos')
+        s_idxs = theano.shared(np.zeros(1, dtype='int64'), name='idxs')
+        s_idx = s_idxs[s_pos]
+        givens = []
+        s_streams = OrderedDict()
+        for key, stream in streams.items():
+            s_stream = theano.shared(np.asarray(stream), borrow=True)
+            s_streams[key] = s_stream
+            if batch_size is None:
+                s_batch = s_stream[s_idx]
+            else:
+                s_batch = s_stream[s_idx * batch_size:
+                                   (s_idx + 1) * batch_size]
+            s_sample = symbolic.get_symbolic(samples[key])
+            givens.append((s_sample, T.cast(s_batch, s_sample.dtype)))
+
+        s_step_size = theano.shared(
+            np.asarray(step_size, dtype=theano.config.floatX),
+            name='step_size')
+        s_costs = theano.shared(np.zeros(1, dtype=s_cost.dtype), name='costs')
+
+        g_args = T.grad(s_cost, s_args, disconnected_inputs='warn')
+        updates = method(s_args,
+                         g_args,
+                         s_step_size,
+                         **utils.as_seq(method_kwargs, dict))
+
+        # -- a step that makes the cost or any updated value non-finite is
+        #    skipped, leaving the parameters and the state of the update rule
+        #    unchanged, and counted in s_skipped (so nothing needs to be
+        #    backed up to recover from it)
+        n_bad = T.isnan(s_cost) + T.isinf(s_cost)
+        for new_v in updates.values():
+            if new_v.dtype.startswith('float'):
+                n_bad = n_bad + T.isnan(new_v).sum() + T.isinf(new_v).sum()
+        ok = T.eq(n_bad, 0)
+        guarded = ifelse(ok,
+                         [v.type.filter_variable(new_v)
+                          for v, new_v in updates.items()],
+                         list(updates.keys()))
+        updates = OrderedDict(zip(updates.keys(), utils.as_seq(guarded)))
+
+        s_skipped = theano.shared(np.asarray(0, dtype='int64'),
+                                  name='skipped')
+        updates[s_skipped] = s_skipped + T.neq(n_bad, 0)
+        updates[s_pos] = s_pos + 1
+        updates[s_costs] = T.set_subtensor(s_costs[s_pos], s_cost)
+
+        update_fn = theano.function([],
+                                    [],
+                                    givens=givens,
+                                    updates=updates,
+                                    mode=theano_mode)
 
         self.args = args
         self.loops = loops
         self.streams = streams
+        self.batch_size = batch_size
+        self.symbolic = symbolic
         self.s_args = s_args
         self.s_cost = s_cost
         self.g_args = g_args
-        self.s_streams0 = s_streams0
         self.update_fn = update_fn
-        self._len = _len
-        self.s_step_sizes = s_step_sizes
-        self.s_stream_idx = s_stream_idx
+        self.n_batches = n_batches
+        self.s_step_size = s_step_size
+        self.s_pos = s_pos
         self.s_costs = s_costs
+        self.s_skipped = s_skipped
         self.s_idxs = s_idxs
+        self.s_streams = s_streams
+        self.feeder = feeder
         self.ii = 0
+        self._order = np.zeros(0, dtype='int64')
         self.cost_history = []
 
     def __iter__(self):
         return self
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Closes the StreamFeeder, if any (stopping its background thread and
+        ending the iterations).
+        """
+        feeder = getattr(self, 'feeder', None)
+        if feeder is not None:
+            feeder.close()
+            self._order = np.zeros(0, dtype='int64')
+
+    @property
+    def step_size(self):
+        return float(self.s_step_size.get_value())
+
+    def backoff(self):
+        logger.info('decreasing step size by {0}'.format(
+            self.step_size_backoff))
+        self.s_step_size.set_value(np.asarray(
+            self.s_step_size.get_value() * self.step_size_backoff,
+            dtype=self.s_step_size.dtype))
+
+    def get_batch_indices(self, N):
+        """
+        Returns the indices of the next N minibatches. Minibatches are drawn
+        in a random order without replacement within each epoch.
+        """
+        while len(self._order) < N:
+            self._order = np.concatenate(
+                [self._order, self.rng.permutation(self.n_batches)])
+        idxs, self._order = self._order[:N], self._order[N:]
+        return idxs
+
     def nextN(self, N, force=False):
-        # Theano's cvm has a really low-overhead direct call
-        # interface, which does not permit argument-passing.
-        # so we set up all the indexes we want to use in shared
-        # variables, and the s_stream_idx iterates over our list
-        # of randomly chosen indexes, and fills in the costs into
-        # self.s_costs.
-        fn = self.update_fn.fn
-        if force:
-            _N = N
-        else:
-            _N = min(N, int(self._len * self.loops) - self.ii)
-            if _N <= 0:
+        """
+        Runs N iterations (or, unless force is True, as many of them as
+        remain in the requested number of loops) and returns their costs.
+        With a StreamFeeder, the iterations end with the feeder's data, and
+        force must be False.
+        """
+        if self.feeder is not None and force:
+            raise ValueError('force can not be used with a StreamFeeder.')
+        self.s_skipped.set_value(np.asarray(0, dtype='int64'))
+
+        if self.feeder is not None:
+            # -- run through the current buffer, swapping in the next one
+            #    (filled in the background) when it is exhausted
+            rvals = []
+            while N > 0:
+                if len(self._order) == 0:
+                    buffers, self.n_batches = self.feeder.next_chunk()
+                    if buffers is None:
+                        self.feeder.close()
+                        break
+                    for key, s_stream in self.s_streams.items():
+                        s_stream.set_value(buffers[key], borrow=True)
+                    self._order = self.rng.permutation(self.n_batches)
+                idxs, self._order = self._order[:N], self._order[N:]
+                rvals.append(self.run(idxs))
+                N -= len(idxs)
+            if not rvals:
                 return []
+            rval = np.concatenate(rvals)
+        else:
+            if force:
+                _N = N
+            else:
+                _N = min(N, int(self.n_batches * self.loops) - self.ii)
+                if _N <= 0:
+                    return []
+            rval = self.run(self.get_batch_indices(_N))
 
-        idxs = self.rng.randint(self._len, size=_N)
-        self.s_stream_idx.set_value(0)
-        self.s_idxs.set_value(
-                idxs,
-                borrow=True)
-        self.s_costs.set_value(
-                np.zeros(_N, dtype=self.s_costs.dtype),
-                borrow=True)
-        args_backup = [a.get_value() for a in self.s_args]
-
-        try:
-            # when using the cvm, there is a special calling form
-            # that uses an internal for-loop
-            fn(n_calls=_N)
-        except TypeError:
-            for i in xrange(_N):
-                fn()
-        rval = self.s_costs.get_value()
-        if np.isfinite(rval[-1]):
+        if self.s_skipped.get_value() == 0:
             self.cost_history.append(np.mean(rval))
         else:
-            info('decreasing step sizes by %f' % self.step_size_backoff)
-            [s_step.set_value(s_step.get_value() * self.step_size_backoff)
-                for s_step in self.s_step_sizes]
-            [s_a.set_value(a, borrow=True)
-                    for s_a, a in zip(self.s_args, args_backup)]
+            self.backoff()
         if len(self.cost_history) > 3:
             if not (self.cost_history[-1] <= self.cost_history[-3]):
-                info('decreasing step sizes by %f' % self.step_size_backoff)
-                [s_step.set_value(s_step.get_value() * self.step_size_backoff)
-                    for s_step in self.s_step_sizes]
+                self.backoff()
         self.ii += len(rval)
         return rval
 
-    def next(self, N=None):
+    def run(self, idxs):
+        """
+        Runs one iteration on each of the minibatches with the given indices
+        and returns their costs.
+        """
+        # Theano's cvm has a really low-overhead direct call interface, which
+        # does not permit argument-passing. So the minibatch indices are set
+        # up in a shared variable, which s_pos iterates over, and the costs
+        # are written into s_costs.
+        N = len(idxs)
+        self.s_pos.set_value(np.asarray(0, dtype='int64'))
+        self.s_idxs.set_value(np.asarray(idxs, dtype='int64'), borrow=True)
+        self.s_costs.set_value(np.zeros(N, dtype=self.s_costs.dtype),
+                               borrow=True)
+        utils.call_repeatedly(self.update_fn, N)
+        return self.s_costs.get_value()
+
+    def __next__(self):
         rval = self.nextN(1)
-        if rval:
+        if len(rval):
             return rval[0]
         else:
             raise StopIteration()
 
+    next = __next__
+
     @property
     def current_args(self):
         vals = [a.get_value() for a in self.s_args]
-        rval, pos = doc_from_flat(self.args, vals, 0)
-        assert pos == len(vals)
-        return rval
+        if len(vals) == 1:
+            return vals[0]
+        return tuple(vals)
 
 
-@post_collect
+@utils.post_collect
 def fmin_sgd(*args, **kwargs):
     """
     See FMinSGD for documentation. This function creates that object, exhausts
     the iterator, and then returns the final self.current_args values.
-    """
-    print_interval = kwargs.pop('print_interval', sys.maxint)
-    obj = FMinSGD(*args, **kwargs)
-    while True:
-        t = time.time()
-        vals = obj.nextN(print_interval)
-        if len(vals):
-            print 'Value', np.mean(vals), 'time', (time.time() - t)
-        else:
-            break
-    return obj.current_args
 
+    The mean cost is logged every `print_interval` iterations (by default,
+    once per epoch).
+    """
+    print_interval = kwargs.pop('print_interval', None)
+    with FMinSGD(*args, **kwargs) as obj:
+        if print_interval is None:
+            if obj.feeder is not None:
+                print_interval = obj.feeder.chunk_batches
+            else:
+                print_interval = obj.n_batches
+        while True:
+            t = time.time()
+            vals = obj.nextN(print_interval)
+            if len(vals):
+                logger.info('Value {0} time {1}'.format(np.mean(vals),
+                                                        time.time() - t))
+            else:
+                break
+        return obj.current_args
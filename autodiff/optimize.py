@@ -2,87 +2,234 @@
 SciPy-based function optimization
 """
 
+import time
+import multiprocessing
 import numpy as np
 import scipy
 
+from autodiff.cache import LRUCache, source_hash
 from autodiff.symbolic import VectorArg
 import autodiff.utils as utils
 
-__all__ = ['fmin_cg', 'fmin_ncg', 'fmin_l_bfgs_b']
+__all__ = ['fmin_cg', 'fmin_ncg', 'fmin_l_bfgs_b', 'fmin_l_bfgs_b_multistart',
+           'DataParallelObjective']
 
 
-def fmin_cg(fn, init_args=None, init_kwargs=None, **scipy_kwargs):
+# compiled objectives, keyed by function and argument layout
+_objective_cache = LRUCache(maxsize=32)
+
+
+class Objective(object):
+    """
+    Serves SciPy's separate objective, gradient and Hessian-vector product
+    callbacks from a single trace of fn.
+
+    The function and gradient are compiled into one Theano function (so they
+    share their forward pass), and its results are cached for the last point
+    evaluated; SciPy usually requests f and fprime at the same point, so the
+    second request is served from memory. The Hessian-vector product is
+    compiled from the same trace if `hessian_vector` is True.
+
+    `data` is an optional dictionary of arrays passed to fn as keyword
+    arguments, which are inputs of the compiled functions rather than
+    parameters (see `VectorArg`).
+
+    The tracing state is released once the functions are compiled, so an
+    objective only holds its compiled functions and the current data.
+    """
+
+    def __init__(self,
+                 fn,
+                 init_args=None,
+                 init_kwargs=None,
+                 data=None,
+                 hessian_vector=False):
+        self.f_df = VectorArg(fn,
+                              init_args=init_args,
+                              init_kwargs=init_kwargs,
+                              data=data,
+                              function=True,
+                              gradient=True)
+        if hessian_vector:
+            self.hv = self.f_df.compile(hessian_vector=True)
+        else:
+            self.hv = None
+        self.f_df.release()
+        self.set_data(data)
+
+    def set_data(self, data):
+        """
+        Sets the data the objective is evaluated on, discarding the cached
+        results. If data is None, the references to the current data are
+        dropped (the objective can not be evaluated until data is set).
+        """
+        if data is None:
+            self.data = None
+        else:
+            data = utils.as_seq(data, dict)
+            self.data = tuple(data[k] for k in self.f_df.data_names)
+        self.x = None
+        self.value = None
+        self.grad = None
+
+    def evaluate(self, x):
+        """
+        Returns the value and gradient of the function at x, computing them
+        only if x differs from the last point evaluated.
+        """
+        if self.x is None or not np.array_equal(x, self.x):
+            value, grad = self.f_df(x, *self.data)
+            # SciPy may modify x inplace, so keep a copy
+            self.x = np.array(x, copy=True)
+            self.value = value
+            self.grad = grad
+        return self.value, self.grad
+
+    def f(self, x):
+        return self.evaluate(x)[0]
+
+    def fprime(self, x):
+        return self.evaluate(x)[1]
+
+    def fhess_p(self, x, p):
+        return self.hv(x, *(self.data + (p,)))
+
+    def vector_from_args(self, args, kwargs):
+        return self.f_df.vector_from_args(args, kwargs)
+
+    def args_from_vector(self, vector):
+        return self.f_df.args_from_vector(vector)
+
+
+def get_objective(fn,
+                  init_args=None,
+                  init_kwargs=None,
+                  data=None,
+                  hessian_vector=False,
+                  use_cache=True):
+    """
+    Returns an `Objective` for fn. If use_cache is True, objectives are reused
+    across calls with the same function (by identity and `source_hash`) and
+    the same argument layout (the shapes and dtypes of the initial arguments,
+    and the names, dimensions and dtypes of the data), so that only the first
+    call traces and compiles fn.
+
+    The source hash includes the values fn refers to, so rebinding them (for
+    example, assigning a new array to a name in fn's closure or globals)
+    compiles a new objective. The hash of an array is computed once and
+    reused for as long as fn refers to the same array object, so arrays that
+    are modified inplace are compiled into the objective as they were when
+    it was traced. Data that changes between calls should be passed through
+    `data` or optimized with use_cache=False.
+    """
+    init_args = utils.as_seq(init_args, tuple)
+    init_kwargs = utils.as_seq(init_kwargs, dict)
+    data = utils.as_seq(data, dict)
+
+    if not use_cache:
+        return Objective(fn,
+                         init_args=init_args,
+                         init_kwargs=init_kwargs,
+                         data=data,
+                         hessian_vector=hessian_vector)
+
+    all_args = utils.expandedcallargs(fn,
+                                      *init_args,
+                                      **dict(init_kwargs, **data))
+    key = (fn,
+           source_hash(fn),
+           tuple((np.shape(a), np.asarray(a).dtype.str) for a in all_args
+                 if not any(a is d for d in data.values())),
+           tuple((k, np.ndim(data[k]), np.asarray(data[k]).dtype.str)
+                 for k in sorted(data)))
+    try:
+        objective = _objective_cache[key]
+        objective.set_data(data)
+    except KeyError:
+        objective = Objective(fn,
+                              init_args=init_args,
+                              init_kwargs=init_kwargs,
+                              data=data,
+                              hessian_vector=hessian_vector)
+        _objective_cache[key] = objective
+
+    if hessian_vector and objective.hv is None:
+        objective.hv = objective.f_df.compile(hessian_vector=True)
+    return objective
+
+
+def fmin_cg(fn,
+            init_args=None,
+            init_kwargs=None,
+            use_cache=True,
+            **scipy_kwargs):
     """
     Minimize a scalar valued function using SciPy's nonlinear conjugate
     gradient algorithm. The initial parameter guess is 'init_args'.
 
+    If use_cache is True, the compiled objective is reused by later calls
+    with the same function and argument shapes (see `get_objective`).
+
     """
 
     init_args = utils.as_seq(init_args, tuple)
     init_kwargs = utils.as_seq(init_kwargs, dict)
 
-    f = VectorArg(fn,
-                  init_args=init_args,
-                  init_kwargs=init_kwargs,
-                  function=True)
+    objective = get_objective(fn,
+                              init_args=init_args,
+                              init_kwargs=init_kwargs,
+                              use_cache=use_cache)
 
-    fprime = VectorArg(fn,
-                       init_args=init_args,
-                       init_kwargs=init_kwargs,
-                       gradient=True)
-
-    x0 = f.vector_from_args(init_args, init_kwargs)
+    x0 = objective.vector_from_args(init_args, init_kwargs)
 
     x_opt = scipy.optimize.fmin_cg(
-        f=f,
+        f=objective.f,
         x0=x0,
-        fprime=fprime,
+        fprime=objective.fprime,
         full_output=False,
         **scipy_kwargs)
 
-    x_reshaped = f.args_from_vector(x_opt)
+    x_reshaped = objective.args_from_vector(x_opt)
     if len(x_reshaped) == 1:
         x_reshaped = x_reshaped[0]
 
     return x_reshaped
 
 
-def fmin_ncg(fn, init_args=None, init_kwargs=None, **scipy_kwargs):
+def fmin_ncg(fn,
+             init_args=None,
+             init_kwargs=None,
+             use_cache=True,
+             **scipy_kwargs):
     """
     Minimize a scalar valued function using SciPy's Newton-CG algorithm. The
     initial parameter guess is 'init_args'.
 
+    If use_cache is True, the compiled objective is reused by later calls
+    with the same function and argument shapes (see `get_objective`).
+
     """
 
     init_args = utils.as_seq(init_args, tuple)
     init_kwargs = utils.as_seq(init_kwargs, dict)
 
-    f = VectorArg(fn,
-                  init_args=init_args,
-                  init_kwargs=init_kwargs,
-                  function=True)
-
-    fprime = VectorArg(fn,
-                       init_args=init_args,
-                       init_kwargs=init_kwargs,
-                       gradient=True)
+    objective = get_objective(fn,
+                              init_args=init_args,
+                              init_kwargs=init_kwargs,
+                              hessian_vector=True,
+                              use_cache=use_cache)
 
-    fhess_p = VectorArg(fn,
-                        init_args=init_args,
-                        init_kwargs=init_kwargs,
-                        hessian_vector=True)
-
-    x0 = f.vector_from_args(init_args, init_kwargs)
+    x0 = objective.vector_from_args(init_args, init_kwargs)
 
     x_opt = scipy.optimize.fmin_ncg(
-        f=f,
+        f=objective.f,
         x0=x0,
-        fprime=fprime,
-        fhess_p=fhess_p,
+        fprime=objective.fprime,
+        fhess_p=objective.fhess_p,
         full_output=False,
         **scipy_kwargs)
 
-    x_reshaped = f.args_from_vector(x_opt)
+    x_reshaped = objective.args_from_vector(x_opt)
     if len(x_reshaped) == 1:
         x_reshaped = x_reshaped[0]
 
@@ -94,46 +241,407 @@ def fmin_l_bfgs_b(fn,
                   init_kwargs=None,
                   scalar_bounds=None,
                   return_info=False,
+                  use_cache=True,
+                  data=None,
+                  processes=1,
+                  data_reduction='sum',
                   **scipy_kwargs):
     """
     Minimize a scalar valued function using SciPy's L-BFGS-B algorithm. The
     initial parameter guess is 'init_args'.
 
+    If use_cache is True, the compiled objective is reused by later calls
+    with the same function and argument shapes (see `get_objective`).
+
+    Arguments
+    ---------
+
+    data : dict
+        Arrays (for example, memory-mapped training examples) passed to fn as
+        keyword arguments, which are not optimized. They must follow the
+        parameters in fn's signature, and their first axis must index the
+        examples.
+
+    processes : int
+        The number of processes that evaluate the objective. If greater than
+        1, the rows of the data are split into one shard per process, and the
+        values and gradients of the shards are combined in the calling
+        process (see `DataParallelObjective`). If None, the number of CPUs is
+        used.
+
+    data_reduction : 'sum' or 'mean'
+        How fn reduces over the rows of the data, which determines how the
+        results of the shards are combined.
+
     """
 
     init_args = utils.as_seq(init_args, tuple)
     init_kwargs = utils.as_seq(init_kwargs, dict)
+    data = utils.as_seq(data, dict)
 
-    f_df = VectorArg(fn,
-                     init_args=init_args,
-                     init_kwargs=init_kwargs,
-                     function=True,
-                     gradient=True)
+    objective = get_objective(fn,
+                              init_args=init_args,
+                              init_kwargs=init_kwargs,
+                              data=data,
+                              use_cache=use_cache)
+    # the data are passed to the optimizer, so don't keep them in the cache
+    objective.set_data(None)
+    f_df = objective.f_df
 
     x0 = f_df.vector_from_args(init_args, init_kwargs)
 
+    scipy_kwargs = _l_bfgs_b_kwargs(len(x0), scalar_bounds, scipy_kwargs)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if data and processes > 1:
+        with DataParallelObjective(f_df.fn,
+                                   data=[data[k] for k in f_df.data_names],
+                                   processes=processes,
+                                   reduction=data_reduction) as objective:
+            x_opt, f_opt, info = scipy.optimize.fmin_l_bfgs_b(
+                func=objective,
+                x0=x0,
+                approx_grad=False,
+                **scipy_kwargs)
+    else:
+        x_opt, f_opt, info = scipy.optimize.fmin_l_bfgs_b(
+            func=f_df,
+            x0=x0,
+            args=tuple(data[k] for k in f_df.data_names),
+            approx_grad=False,
+            **scipy_kwargs)
+
+    x_reshaped = f_df.args_from_vector(x_opt)
+    if len(x_reshaped) == 1:
+        x_reshaped = x_reshaped[0]
+
+    if return_info:
+        return x_reshaped, {'f_opt': f_opt, 'info': info}
+    else:
+        return x_reshaped
+
+
+def fmin_l_bfgs_b_multistart(fn,
+                             init_args=None,
+                             init_kwargs=None,
+                             n_starts=8,
+                             starts=None,
+                             scale=1.0,
+                             seed=None,
+                             processes=None,
+                             scalar_bounds=None,
+                             use_cache=True,
+                             **scipy_kwargs):
+    """
+    Minimize a scalar valued function using SciPy's L-BFGS-B algorithm from
+    several starting points, in parallel, and return the best result.
+
+    The objective is compiled once (see `get_objective`) and the compiled
+    Theano function is pickled to a pool of worker processes (started with
+    the 'forkserver' method where available, or 'spawn').
+
+    Arguments
+    ---------
+
+    init_args, init_kwargs :
+        The initial parameter guess (a warm start), which is always the first
+        starting point.
+
+    n_starts : int
+        The total number of starting points, including the initial guess and
+        `starts`. The remaining points are drawn by adding Gaussian noise
+        (with standard deviation `scale`) to the initial guess, clipped to
+        `scalar_bounds`.
+
+    starts : sequence
+        Additional starting points, each given as the positional arguments of
+        fn (like `init_args`). At most n_starts - 1 may be given.
+
+    seed : int
+        The seed for random starting points.
+
+    processes : int
+        The number of worker processes. If None, the number of CPUs is used.
+        If 1, all starts run in the calling process.
+
+    Returns
+    -------
+
+    x_opt :
+        The best parameters found, shaped like the arguments of fn.
+
+    info : dict
+        'f_opt' is the best value, 'best' is the index of the best start and
+        'starts' is a list with a dictionary for each start, containing its
+        initial and final parameter vectors ('x0' and 'x_opt'), final value
+        ('f_opt'), SciPy's diagnostic information ('info') and wall time
+        ('time').
+
+    """
+
+    init_args = utils.as_seq(init_args, tuple)
+    init_kwargs = utils.as_seq(init_kwargs, dict)
+
+    f_df = get_objective(fn,
+                         init_args=init_args,
+                         init_kwargs=init_kwargs,
+                         use_cache=use_cache).f_df
+
+    starts = utils.as_seq(starts)
+    if len(starts) >= n_starts:
+        raise ValueError('Received {0} starts for n_starts={1} (which '
+                         'includes the initial guess).'.format(len(starts),
+                                                               n_starts))
+
+    x0s = [np.array(f_df.vector_from_args(init_args, init_kwargs))]
+    for start in starts:
+        x0s.append(np.array(
+            f_df.vector_from_args(utils.as_seq(start, tuple), {})))
+
+    rng = np.random.RandomState(seed)
+    while len(x0s) < n_starts:
+        x0 = x0s[0] + scale * rng.randn(len(x0s[0]))
+        if scalar_bounds is not None:
+            x0 = np.clip(x0, *scalar_bounds)
+        x0s.append(x0)
+
+    scipy_kwargs = _l_bfgs_b_kwargs(len(x0s[0]), scalar_bounds, scipy_kwargs)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(x0s))
+    jobs = [(x0, scipy_kwargs) for x0 in x0s]
+
+    if processes > 1:
+        pool = _get_mp_context().Pool(processes=processes,
+                                      initializer=_init_multistart_worker,
+                                      initargs=(f_df.fn,))
+        try:
+            results = pool.map(_run_worker_start, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_run_start(f_df.fn, job) for job in jobs]
+
+    best = int(np.argmin([r['f_opt'] for r in results]))
+
+    x_reshaped = f_df.args_from_vector(results[best]['x_opt'])
+    if len(x_reshaped) == 1:
+        x_reshaped = x_reshaped[0]
+
+    return x_reshaped, {'f_opt': results[best]['f_opt'],
+                        'best': best,
+                        'starts': results}
+
+
+class DataParallelObjective(object):
+    """
+    Evaluates a compiled function and gradient of the form fn(x, *data) on
+    shards of the data in parallel.
+
+    The rows (first axis) of the data are split into one contiguous shard per
+    worker process, and each worker holds a copy of fn and its shard for its
+    whole lifetime. The workers are started with the 'forkserver' method
+    where available (or 'spawn'), rather than forked from a process whose
+    threads and BLAS may be in use, so fn and the shards are pickled. Shards
+    of memory-mapped data are sent as a reference to their file and mapped
+    by the worker, so they are never read by the calling process. Calling
+    the objective sends x to every worker and returns the combined value and
+    gradient.
+
+    Arguments
+    ---------
+
+    fn : callable
+        A function returning the value and gradient at x, such as the
+        compiled function of a function and gradient `VectorArg`.
+
+    data : sequence of arrays
+        The data, which must all have the same number of rows.
+
+    processes : int
+        The number of worker processes (at most the number of rows).
+
+    reduction : 'sum' or 'mean'
+        How fn reduces over the rows of the data. If 'sum', the results of the
+        shards are summed; if 'mean', they are averaged, weighted by the
+        number of rows in each shard.
+
+    """
+
+    def __init__(self, fn, data, processes=None, reduction='sum'):
+        if reduction not in ('sum', 'mean'):
+            raise ValueError('`reduction` must be \'sum\' or \'mean\'. '
+                             'Received: {0}'.format(reduction))
+
+        data = utils.as_seq(data, tuple)
+        n_rows = set(len(d) for d in data)
+        if len(n_rows) != 1:
+            raise ValueError('All data must have the same number of rows.')
+        n_rows = n_rows.pop()
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = max(1, min(processes, n_rows))
+
+        bounds = np.linspace(0, n_rows, processes + 1).astype(int)
+        if reduction == 'mean':
+            self.weights = np.diff(bounds) / float(n_rows)
+        else:
+            self.weights = np.ones(processes)
+
+        mp_context = _get_mp_context()
+        self.connections = []
+        self.workers = []
+        try:
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                conn, worker_conn = mp_context.Pipe()
+                shard = tuple(_shard_reference(d[start:stop]) for d in data)
+                worker = mp_context.Process(target=_data_parallel_worker,
+                                            args=(worker_conn, fn, shard))
+                worker.daemon = True
+                worker.start()
+                worker_conn.close()
+                self.connections.append(conn)
+                self.workers.append(worker)
+        except:
+            self.close()
+            raise
+
+    def __call__(self, x):
+        x = np.asarray(x)
+        for conn in self.connections:
+            conn.send(x)
+
+        # collect every result before raising, so the workers stay in sync
+        results = [conn.recv() for conn in self.connections]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        value = sum(w * r[0] for w, r in zip(self.weights, results))
+        grad = sum(w * r[1] for w, r in zip(self.weights, results))
+        return value, grad
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Stops the worker processes.
+        """
+        for conn in self.connections:
+            try:
+                conn.send(None)
+                conn.close()
+            except (OSError, EOFError):
+                pass
+        for worker in self.workers:
+            worker.join()
+        self.connections = []
+        self.workers = []
+
+
+def _get_mp_context():
+    """
+    Returns the multiprocessing context of worker processes. Forking a
+    process whose threads (or BLAS) are in use can deadlock the child, so
+    workers are started by a fork server where available, or spawned.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _shard_reference(shard):
+    """
+    Returns a picklable reference to the rows shard of the data: contiguous
+    memmaps are described by their file (see `_open_shard`), other arrays are
+    returned as they are.
+    """
+    position = utils.memmap_position(shard)
+    if position is not None and shard.flags.c_contiguous:
+        return ('memmap', shard.filename, shard.dtype.str, position,
+                shard.shape)
+    return ('array', shard)
+
+
+def _open_shard(reference):
+    if reference[0] == 'memmap':
+        _, filename, dtype, position, shape = reference
+        return np.memmap(filename,
+                         dtype=dtype,
+                         mode='r',
+                         offset=position,
+                         shape=shape)
+    return reference[1]
+
+
+def _data_parallel_worker(conn, fn, shard):
+    shard = tuple(_open_shard(reference) for reference in shard)
+    while True:
+        try:
+            x = conn.recv()
+        except EOFError:
+            break
+        if x is None:
+            break
+        try:
+            value, grad = fn(x, *shard)
+            conn.send((float(value), np.array(grad, dtype='float64')))
+        except Exception as err:
+            conn.send(err)
+    conn.close()
+
+
+def _l_bfgs_b_kwargs(size, scalar_bounds, scipy_kwargs):
+    """
+    Returns the keyword arguments for scipy.optimize.fmin_l_bfgs_b, adding
+    bounds for a parameter vector of the given size from scalar_bounds.
+    """
+    scipy_kwargs = dict(scipy_kwargs)
     if 'approx_grad' in scipy_kwargs:
         raise TypeError('duplicate argument: approx_grad')
     if scalar_bounds is not None:
         lb, ub = scalar_bounds
-        bounds = np.empty((len(x0), 2))
+        bounds = np.empty((size, 2))
         bounds[:, 0] = lb
         bounds[:, 1] = ub
         if 'bounds' in scipy_kwargs:
             raise TypeError('duplicate argument: bounds')
         scipy_kwargs['bounds'] = bounds
+    return scipy_kwargs
+
+
+# the compiled objective of a multistart worker process
+_multistart_fn = None
+
+
+def _init_multistart_worker(fn):
+    global _multistart_fn
+    _multistart_fn = fn
+
 
+def _run_worker_start(job):
+    return _run_start(_multistart_fn, job)
+
+
+def _run_start(fn, job):
+    x0, scipy_kwargs = job
+    t0 = time.time()
     x_opt, f_opt, info = scipy.optimize.fmin_l_bfgs_b(
-        func=f_df,
+        func=fn,
         x0=x0,
         approx_grad=False,
         **scipy_kwargs)
-
-    x_reshaped = f_df.args_from_vector(x_opt)
-    if len(x_reshaped) == 1:
-        x_reshaped = x_reshaped[0]
-
-    if return_info:
-        return x_reshaped, {'f_opt': f_opt, 'info': info}
-    else:
-        return x_reshaped
+    return {'x0': x0,
+            'x_opt': x_opt,
+            'f_opt': float(f_opt),
+            'info': info,
+            'time': time.time() - t0}
@@ -0,0 +1,143 @@
+"""
+Instrumentation of tracing and compilation.
+"""
+
+import time
+import contextlib
+import collections
+
+import autodiff.utils as utils
+
+
+class Stats(object):
+    """
+    Collects statistics about how functions are transformed, traced and
+    compiled. Pass an instance as the `stats` keyword of a `Context`,
+    `Symbolic` or `Function` (several objects may share one instance).
+
+    The following are recorded:
+
+        phases : the number of calls and total wall time of each phase:
+            'get_ast' (reading and parsing the source), 'transform'
+            (`TheanoTransformer.visit`), 'compile_func' (compiling the
+            transformed AST), 'trace' (calling the transformed function) and
+            'theano_function' (compiling the Theano graph). Phases may be
+            nested: nested functions are recompiled while tracing.
+
+        counts : event counters, including 'shadowed' (the number of shared
+            variables created for traced objects), 'recompile' and
+            'recompile_nested', dispatches of `handle_functions` by the kind
+            of function ('dispatch.numpy', 'dispatch.builtin', ...) and
+            compiled function cache lookups ('cache.hit', 'cache.miss' and
+            'cache.disk_hit').
+
+        graphs : for each compiled Theano function, the name of the Python
+            function and the number of nodes in its graph before and after
+            Theano's optimizations.
+
+    Arguments
+    ---------
+
+    callbacks : callable or sequence of callables
+        Called with each phase and graph record (see `records`) as it is
+        recorded. Counters are only aggregated, since they are updated in the
+        innermost loops of tracing.
+
+    """
+
+    def __init__(self, callbacks=None):
+        self.callbacks = list(utils.as_seq(callbacks))
+        self.reset()
+
+    def __repr__(self):
+        return 'Stats(phases={0}, counts={1}, graphs={2})'.format(
+            dict(self.phases), dict(self.counts), len(self.graphs))
+
+    def reset(self):
+        self.phases = collections.OrderedDict()
+        self.counts = collections.Counter()
+        self.graphs = []
+
+    @contextlib.contextmanager
+    def timed(self, phase, function=None):
+        """
+        A context manager that records the wall time of its block as a call
+        of `phase` (for the Python function `function`, if given).
+        """
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(phase, time.time() - t0, function=function)
+
+    def add_phase(self, phase, seconds, function=None):
+        totals = self.phases.setdefault(phase, dict(calls=0, seconds=0.0))
+        totals['calls'] += 1
+        totals['seconds'] += seconds
+        self.emit(dict(type='phase',
+                       name=phase,
+                       function=get_name(function),
+                       seconds=seconds))
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def add_graph(self, function, nodes_before, nodes_after):
+        record = dict(type='graph',
+                      name='theano_function',
+                      function=get_name(function),
+                      nodes_before=nodes_before,
+                      nodes_after=nodes_after)
+        self.graphs.append(record)
+        self.emit(record)
+
+    def emit(self, record):
+        for callback in self.callbacks:
+            callback(record)
+
+    def records(self):
+        """
+        Returns the statistics as a list of flat dictionaries, each with a
+        'type' ('phase', 'count' or 'graph') and a 'name':
+
+            phase : 'calls' and 'seconds' (totals for the phase)
+            count : 'value'
+            graph : 'function', 'nodes_before' and 'nodes_after' (one record
+                per compiled function)
+
+        """
+        records = [dict(type='phase', name=name, **totals)
+                   for name, totals in self.phases.items()]
+        records.extend(dict(type='count', name=name, value=value)
+                       for name, value in sorted(self.counts.items()))
+        records.extend(dict(r) for r in self.graphs)
+        return records
+
+
+class _NullTimer(object):
+    """
+    A context manager that does nothing, used in place of `Stats.timed` when
+    statistics are not collected.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+null_timer = _NullTimer()
+
+
+def get_name(function):
+    """
+    Returns a readable name for the Python function `function`.
+    """
+    if function is None or isinstance(function, str):
+        return function
+    function = getattr(function, '__func__', function)
+    return '{0}.{1}'.format(
+        getattr(function, '__module__', None),
+        getattr(function, '__qualname__',
+                getattr(function, '__name__', repr(function))))
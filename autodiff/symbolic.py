@@ -1,13 +1,19 @@
 import numpy as np
 import theano
 import theano.tensor as T
+import time
 import inspect
 import collections
 from collections import OrderedDict
 
 from autodiff.context import Context
+from autodiff.cache import DiskCache, FunctionCache
 import autodiff.utils as utils
-from autodiff.functions import escape, escaped_call
+from autodiff.functions import escaped_call
+
+
+# used to build cache keys for Python floats
+_float_array = np.asarray(0.0)
 
 
 class Symbolic(object):
@@ -24,7 +30,10 @@ class Symbolic(object):
                  borrowable=None,
                  ignore=None,
                  infer_updates=False,
-                 escape_on_error=False):
+                 escape_on_error=False,
+                 specialize='ndim',
+                 zero_copy=False,
+                 stats=None):
         """
         Arguments
         ---------
@@ -35,6 +44,24 @@ class Symbolic(object):
             memory location. This means that *inplace* operations on the Python
             (likely NumPy) object will affect the symbolic function.
 
+        specialize : 'ndim', 'broadcast' or 'shape'
+            Controls how closely compiled functions are specialized to the
+            traced arguments. 'ndim' (the default) only fixes the number of
+            dimensions; 'broadcast' also fixes which dimensions have length 1;
+            'shape' fixes the full shape of the inputs.
+
+        zero_copy : bool
+            If True, traced arrays are not copied: their symbolic
+            representations alias them while tracing. When a function is
+            compiled, only the arrays it retains as constants (that is, arrays
+            other than its inputs) are copied.
+
+        stats : autodiff.stats.Stats
+            If provided, the time spent in each phase of transforming,
+            tracing and compiling the function, as well as counts of traced
+            objects, dispatched functions and cache lookups, are recorded in
+            it.
+
         """
 
         if context is None:
@@ -42,7 +69,10 @@ class Symbolic(object):
                               ignore=utils.as_seq(ignore, tuple),
                               force_floatX=force_floatX,
                               infer_updates=infer_updates,
-                              escape_on_error=escape_on_error)
+                              escape_on_error=escape_on_error,
+                              specialize=specialize,
+                              zero_copy=zero_copy,
+                              stats=stats)
         assert isinstance(context, Context)
         self.context = context
 
@@ -81,6 +111,10 @@ class Symbolic(object):
     def cache(self):
         return self._cache
 
+    @property
+    def stats(self):
+        return self.context.stats
+
     @property
     def sym_vars(self):
         return self.context.sym_vars
@@ -101,7 +135,8 @@ class Symbolic(object):
         c_args, c_kwargs = utils.clean_int_args(*args, **kwargs)
 
         # call the symfn
-        results = self.symfn(*c_args, **c_kwargs)
+        with self.context.timed('trace', self.pyfn):
+            results = self.symfn(*c_args, **c_kwargs)
 
         # get a tuple of the symbolic inputs
         # but avoid 'self' and 'cls' bound arguments
@@ -130,11 +165,19 @@ class Symbolic(object):
                                   inputs,
                                   outputs,
                                   wrt=None,
-                                  reduction=None):
+                                  reduction=None,
+                                  per_example=False,
+                                  jacobian_method='scan'):
         """
         Helper function: given the symbolic inputs and outputs, as well as
         a theano graph and wrt/reduction info, return the appropriate arguments
         for theano.function to compile a gradient.
+
+        If per_example is True, each output is treated as a vector of
+        per-example losses (a reduction, if provided, is applied over any
+        trailing axes) and the gradient of every example is returned: an array
+        of shape (n_examples,) + wrt.shape for each wrt variable. See
+        `get_jacobian` for the available `jacobian_method`s.
         """
         wrt = utils.as_seq(wrt)
 
@@ -144,9 +187,18 @@ class Symbolic(object):
         if isinstance(reduction, collections.Callable):
             if 'numpy' in reduction.__module__:
                 reduction = getattr(theano.tensor, reduction.__name__)
-            outputs = [reduction(o) if o.ndim > 0 else o for o in outputs]
-
-        if any([o.ndim != 0 for o in outputs]):
+            if per_example:
+                outputs = [reduction(o.flatten(2), axis=1) if o.ndim > 1
+                           else o for o in outputs]
+            else:
+                outputs = [reduction(o) if o.ndim > 0 else o for o in outputs]
+
+        if per_example:
+            if any([o.ndim != 1 for o in outputs]):
+                raise TypeError('Per-example gradients require either vector '
+                                'outputs (one loss per example) or a '
+                                'reduction over their trailing axes.')
+        elif any([o.ndim != 0 for o in outputs]):
             raise TypeError('Gradient requires either scalar outputs or a '
                             'reduction that returns a scalar.')
 
@@ -156,10 +208,130 @@ class Symbolic(object):
         else:
             wrt = [self.get_symbolic(w) for w in wrt]
 
-        grads = utils.flatten([T.grad(o, wrt=wrt) for o in outputs])
+        if per_example:
+            grads = utils.flatten([self.get_jacobian(o, wrt, jacobian_method)
+                                   for o in outputs])
+        else:
+            grads = utils.flatten([T.grad(o, wrt=wrt) for o in outputs])
 
         return dict(inputs=inputs, outputs=utils.as_seq(grads, tuple))
 
+    def get_jacobian(self, expression, wrt, method='scan'):
+        """
+        Helper function: return a list of the Jacobians of the expression with
+        respect to each variable in wrt. The Jacobian with respect to w has
+        shape expression.shape + w.shape.
+
+        method : 'scan' or 'rop'
+            'scan' computes one row of the Jacobian per element of the
+            expression by backpropagation (reverse mode) inside `theano.scan`;
+            it is efficient when the expression has fewer elements than wrt.
+            'rop' computes one column per element of each wrt variable with
+            the R-operator (forward mode); it is efficient when wrt is small
+            compared to the expression (for example, many examples and few
+            parameters).
+        """
+        if method not in ('scan', 'rop'):
+            raise ValueError('Unrecognized Jacobian method: {0} (must be '
+                             '\'scan\' or \'rop\').'.format(method))
+
+        vector = expression.flatten()
+        if method == 'scan':
+            rows = utils.as_seq(
+                theano.gradient.jacobian(vector, wrt=list(wrt)), list)
+        else:
+            rows = []
+            for w in wrt:
+                basis = T.eye(w.size, dtype=w.dtype)
+                columns, _ = theano.scan(
+                    lambda e: T.Rop(vector, w, e.reshape(w.shape,
+                                                         ndim=w.ndim)),
+                    sequences=basis)
+                rows.append(columns.T)
+
+        jacobians = []
+        for w, r in zip(wrt, rows):
+            shape = ([expression.shape[i] for i in range(expression.ndim)]
+                     + [w.shape[i] for i in range(w.ndim)])
+            jacobians.append(r.reshape(shape, ndim=expression.ndim + w.ndim))
+        return jacobians
+
+    def get_jacobian_compile_args(self,
+                                  inputs,
+                                  outputs,
+                                  wrt=None,
+                                  jacobian_method='scan'):
+        """
+        Helper function: given the symbolic inputs and outputs, as well as
+        wrt info, return the appropriate arguments for theano.function to
+        compile the Jacobian of each output with respect to each wrt variable
+        (see `get_jacobian`).
+        """
+        wrt = utils.as_seq(wrt)
+
+        # get wrt variables. If none were specified, use inputs.
+        if len(wrt) == 0:
+            wrt = [i for i in inputs]
+        else:
+            wrt = [self.get_symbolic(w) for w in wrt]
+
+        jacobians = utils.flatten([
+            self.get_jacobian(o, wrt, jacobian_method) for o in outputs])
+
+        return dict(inputs=inputs, outputs=utils.as_seq(jacobians, tuple))
+
+    def get_hessian_compile_args(self,
+                                 inputs,
+                                 outputs,
+                                 wrt=None,
+                                 reduction=None,
+                                 jacobian_method='scan'):
+        """
+        Helper function: given the symbolic inputs and outputs, as well as
+        wrt/reduction info, return the appropriate arguments for
+        theano.function to compile the dense Hessian of each (scalar) output
+        with respect to the wrt variables. The Hessian is returned in blocks:
+        for each output, the block of each pair of wrt variables (v, w),
+        ordered by v then w, has shape v.shape + w.shape (so the Hessian with
+        respect to a single variable w has shape w.shape + w.shape).
+
+        The Hessian is the Jacobian of the gradient (of all wrt variables,
+        flattened and concatenated): 'scan' computes it one row at a time by
+        backpropagating each element of the gradient, while 'rop' computes it
+        one column at a time by applying the R-operator to the gradient
+        (forward-over-reverse).
+        """
+        g_args = self.get_gradient_compile_args(inputs=inputs,
+                                                outputs=outputs,
+                                                wrt=wrt,
+                                                reduction=reduction)
+
+        wrt = utils.as_seq(wrt)
+        if len(wrt) == 0:
+            wrt = [i for i in inputs]
+        else:
+            wrt = [self.get_symbolic(w) for w in wrt]
+
+        # gradients are ordered by output, then by wrt variable
+        grads = g_args['outputs']
+        offsets = [0]
+        for w in wrt:
+            offsets.append(offsets[-1] + w.size)
+
+        hessians = []
+        for k in range(len(utils.as_seq(outputs))):
+            grad = T.concatenate(
+                [g.flatten() for g in grads[k * len(wrt):(k + 1) * len(wrt)]])
+            columns = self.get_jacobian(grad, wrt, jacobian_method)
+            for i, v in enumerate(wrt):
+                for w, c in zip(wrt, columns):
+                    shape = ([v.shape[d] for d in range(v.ndim)]
+                             + [w.shape[d] for d in range(w.ndim)])
+                    block = c[offsets[i]:offsets[i + 1]]
+                    hessians.append(block.reshape(shape, ndim=v.ndim + w.ndim))
+
+        return dict(inputs=inputs, outputs=tuple(hessians))
+
     def get_hessian_vector_compile_args(self,
                                         inputs,
                                         outputs,
@@ -192,31 +364,40 @@ class Symbolic(object):
 
         grads = utils.flatten([T.grad(o, wrt=wrt) for o in outputs])
 
-        sym_vectors = tuple(T.TensorType(
-            dtype=w.dtype, broadcastable=[False] * w.ndim)()
-            for w in wrt)
+        sym_vectors = tuple(w.type() for w in wrt)
         hessian_vectors = utils.as_seq(T.Rop(grads, wrt, sym_vectors), tuple)
 
         return dict(inputs=inputs + sym_vectors, outputs=hessian_vectors)
 
-    def compile(self,
-                function=False,
-                gradient=False,
-                hessian_vector=False,
-                inputs=None,
-                outputs=None,
-                wrt=None,
-                reduction=None,
-                allow_input_downcast=True):
+    def get_compile_graph(self,
+                          function=False,
+                          gradient=False,
+                          hessian_vector=False,
+                          jacobian=False,
+                          hessian=False,
+                          inputs=None,
+                          outputs=None,
+                          wrt=None,
+                          reduction=None,
+                          per_example=False,
+                          jacobian_method='scan'):
+        """
+        Helper function: given the traced inputs and outputs, return a tuple
+        of the symbolic inputs and a tuple of the symbolic outputs of the
+        function that `compile` would build.
+        """
 
         assert isinstance(function, bool)
         assert isinstance(gradient, bool)
         assert isinstance(hessian_vector, bool)
+        assert isinstance(jacobian, bool)
+        assert isinstance(hessian, bool)
 
-        if not (function or gradient or hessian_vector):
+        if not (function or gradient or hessian_vector or jacobian or hessian):
             raise ValueError(
-                'At least one of `function`, `gradient`, or `hessian_vector` '
-                'must be True when calling `compile()`.')
+                'At least one of `function`, `gradient`, `hessian_vector`, '
+                '`jacobian`, or `hessian` must be True when calling '
+                '`compile()`.')
 
         sym_inputs = tuple(
           self.get_symbolic(i) for i in utils.as_seq(inputs))
@@ -232,10 +413,13 @@ class Symbolic(object):
             fn_outputs += fn_args['outputs']
 
         if gradient:
-            g_args = self.get_gradient_compile_args(inputs=sym_inputs,
-                                                    outputs=sym_outputs,
-                                                    wrt=wrt,
-                                                    reduction=reduction)
+            g_args = self.get_gradient_compile_args(
+                inputs=sym_inputs,
+                outputs=sym_outputs,
+                wrt=wrt,
+                reduction=reduction,
+                per_example=per_example,
+                jacobian_method=jacobian_method)
             fn_outputs += g_args['outputs']
 
         if hessian_vector:
@@ -246,23 +430,103 @@ class Symbolic(object):
             fn_inputs = hv_args['inputs']
             fn_outputs += hv_args['outputs']
 
-        if len(fn_outputs) == 1:
-            fn_outputs = fn_outputs[0]
-
-        new_inputs = tuple(i.type() for i in fn_inputs)
-        givens = dict(zip(fn_inputs, new_inputs))
-
+        if jacobian:
+            j_args = self.get_jacobian_compile_args(
+                inputs=sym_inputs,
+                outputs=sym_outputs,
+                wrt=wrt,
+                jacobian_method=jacobian_method)
+            fn_outputs += j_args['outputs']
+
+        if hessian:
+            h_args = self.get_hessian_compile_args(
+                inputs=sym_inputs,
+                outputs=sym_outputs,
+                wrt=wrt,
+                reduction=reduction,
+                jacobian_method=jacobian_method)
+            fn_outputs += h_args['outputs']
+
+        return fn_inputs, fn_outputs
+
+    def get_compile_updates(self, inputs, outputs):
+        """
+        Helper function: return the updates for a function of the symbolic
+        inputs and outputs. If tracing was zero-copy, any borrowed arrays
+        retained by the function (other than its inputs) are copied.
+        """
         if self.context.infer_updates:
             updates = self.context.updates
         else:
             updates = collections.OrderedDict()
 
-        fn = theano.function(inputs=new_inputs,
-                             outputs=fn_outputs,
-                             givens=givens,
-                             updates=updates,
-                             on_unused_input='ignore',
-                             allow_input_downcast=allow_input_downcast)
+        if self.context.zero_copy:
+            self.context.copy_borrowed(
+                v for v in theano.gof.graph.inputs(
+                    utils.as_seq(outputs, list)
+                    + list(updates.keys())
+                    + list(updates.values()))
+                if v not in inputs)
+
+        return updates
+
+    def compile(self,
+                function=False,
+                gradient=False,
+                hessian_vector=False,
+                jacobian=False,
+                hessian=False,
+                inputs=None,
+                outputs=None,
+                wrt=None,
+                reduction=None,
+                per_example=False,
+                jacobian_method='scan',
+                allow_input_downcast=True):
+
+        fn_inputs, fn_outputs = self.get_compile_graph(
+            function=function,
+            gradient=gradient,
+            hessian_vector=hessian_vector,
+            jacobian=jacobian,
+            hessian=hessian,
+            inputs=inputs,
+            outputs=outputs,
+            wrt=wrt,
+            reduction=reduction,
+            per_example=per_example,
+            jacobian_method=jacobian_method)
+
+        if len(fn_outputs) == 1:
+            fn_outputs = fn_outputs[0]
+
+        new_inputs = tuple(i.type() for i in fn_inputs)
+        if self.context.specialize == 'shape':
+            givens = dict(
+                (i, T.specify_shape(n, i.get_value(borrow=True).shape))
+                if isinstance(i, theano.compile.SharedVariable) else (i, n)
+                for i, n in zip(fn_inputs, new_inputs))
+        else:
+            givens = dict(zip(fn_inputs, new_inputs))
+
+        updates = self.get_compile_updates(fn_inputs, fn_outputs)
+
+        with self.context.timed('theano_function', self.pyfn):
+            fn = theano.function(inputs=new_inputs,
+                                 outputs=fn_outputs,
+                                 givens=givens,
+                                 updates=updates,
+                                 on_unused_input='ignore',
+                                 allow_input_downcast=allow_input_downcast)
+
+        if self.stats is not None:
+            graph_outputs = (utils.as_seq(fn_outputs, list)
+                             + list(updates.values()))
+            nodes_before = len(theano.gof.graph.ops(
+                theano.gof.graph.inputs(graph_outputs), graph_outputs))
+            self.stats.add_graph(self.pyfn,
+                                 nodes_before=nodes_before,
+                                 nodes_after=len(fn.maker.fgraph.apply_nodes))
 
         return fn
 
@@ -286,6 +550,8 @@ class Symbolic(object):
                          outputs=None,
                          wrt=None,
                          reduction=None,
+                         per_example=False,
+                         jacobian_method='scan',
                          allow_input_downcast=True):
         """
         Based on traced variables, compile a Theano function of the
@@ -293,6 +559,10 @@ class Symbolic(object):
         If wrt is None, it is assumed to be all of the inputs. A reduction may
         be specified (since gradients are defined with respect to scalars); if
         None is supplied, it is assumed to be 'sum'.
+
+        If per_example is True, the outputs are vectors of per-example losses
+        and the gradient of each example is returned, stacked along the first
+        axis (see `get_gradient_compile_args`).
         """
         fn = self.compile(
             gradient=True,
@@ -300,6 +570,8 @@ class Symbolic(object):
             outputs=outputs,
             wrt=wrt,
             reduction=reduction,
+            per_example=per_example,
+            jacobian_method=jacobian_method,
             allow_input_downcast=allow_input_downcast)
         return fn
 
@@ -327,6 +599,49 @@ class Symbolic(object):
             allow_input_downcast=allow_input_downcast)
         return fn
 
+    def compile_jacobian(self,
+                         inputs=None,
+                         outputs=None,
+                         wrt=None,
+                         jacobian_method='scan',
+                         allow_input_downcast=True):
+        """
+        Based on traced variables, compile a Theano function of the inputs
+        that returns the Jacobian of each output with respect to wrt. If wrt
+        is None, it is assumed to be all of the inputs.
+        """
+        fn = self.compile(
+            jacobian=True,
+            inputs=inputs,
+            outputs=outputs,
+            wrt=wrt,
+            jacobian_method=jacobian_method,
+            allow_input_downcast=allow_input_downcast)
+        return fn
+
+    def compile_hessian(self,
+                        inputs=None,
+                        outputs=None,
+                        wrt=None,
+                        reduction=None,
+                        jacobian_method='scan',
+                        allow_input_downcast=True):
+        """
+        Based on traced variables, compile a Theano function of the inputs
+        that returns the dense Hessian of the outputs with respect to each wrt
+        variable. If wrt is None, it is assumed to be all of the inputs. A
+        reduction may be specified (since Hessians are defined for scalars).
+        """
+        fn = self.compile(
+            hessian=True,
+            inputs=inputs,
+            outputs=outputs,
+            wrt=wrt,
+            reduction=reduction,
+            jacobian_method=jacobian_method,
+            allow_input_downcast=allow_input_downcast)
+        return fn
+
 
 class Tracer(Symbolic):
     """
@@ -367,35 +682,503 @@ class Function(Symbolic):
                  ignore=None,
                  infer_updates=False,
                  escape_on_error=False,
-                 use_cache=True):
+                 use_cache=True,
+                 disk_cache=None,
+                 specialize='ndim',
+                 cache_size=None,
+                 cache_bytes=None,
+                 zero_copy=False,
+                 batch_axis=None,
+                 chunk_args=None,
+                 chunk_size=10000,
+                 chunk_reduction='mean',
+                 stats=None):
+        """
+        Arguments
+        ---------
+
+        use_cache : bool
+            If True, compiled functions are cached by the dimensions and dtypes
+            of their arguments (and, depending on `specialize`, their
+            broadcastable patterns or shapes).
+
+        disk_cache : str or DiskCache
+            If provided (and use_cache is True), compiled functions are also
+            stored on disk, so that new processes can skip tracing and
+            compilation. A string is interpreted as the path of the cache
+            directory.
+
+        specialize : 'ndim', 'broadcast' or 'shape'
+            See `Symbolic`.
+
+        zero_copy : bool
+            See `Symbolic`.
+
+        cache_size : int
+            The maximum number of compiled functions to keep in memory. When
+            the limit is reached, the least recently used function is
+            discarded. If None, the number is unbounded.
+
+        cache_bytes : int
+            The maximum (estimated) memory held by the compiled functions kept
+            in memory. When it is exceeded, the least recently used functions
+            are discarded. If None, the memory is unbounded.
+
+        batch_axis : int or dict
+            If provided, the function is treated as a function of a single
+            sample and evaluated over a batch of samples stacked along
+            `batch_axis` of each argument. It is traced once (on the first
+            sample) and compiled into a single `theano.scan` over the batch;
+            outputs are stacked along their first axis. If an int, every
+            argument is batched; if a dict, it maps argument names to their
+            batch axes, and arguments that are not listed (or map to None) are
+            shared by all samples.
+
+        chunk_args : str or sequence of str
+            If provided, the named arguments are treated as datasets of rows
+            (for example, memory-mapped arrays larger than memory), and each
+            call evaluates the function over chunks of `chunk_size` rows,
+            combining the results with `chunk_reduction` ('mean' or 'sum').
+            The function (and so its gradient) must be a mean or sum over the
+            rows. See `reduce_chunks`.
+
+        chunk_size : int
+            The number of rows in each chunk.
+
+        chunk_reduction : 'mean' or 'sum'
+            How the results of the chunks are combined.
+
+        stats : autodiff.stats.Stats
+            See `Symbolic`.
+
+        """
         super(Function, self).__init__(pyfn=pyfn,
                                        context=context,
                                        force_floatX=force_floatX,
                                        borrowable=borrowable,
                                        ignore=ignore,
                                        infer_updates=infer_updates,
-                                       escape_on_error=escape_on_error)
+                                       escape_on_error=escape_on_error,
+                                       specialize=specialize,
+                                       zero_copy=zero_copy,
+                                       stats=stats)
 
-        self._cache = dict()
+        self._cache = FunctionCache(maxsize=cache_size, max_bytes=cache_bytes)
+        self._binders = dict()
+        self._binders_symfn = None
         self.use_cache = use_cache
+        if isinstance(disk_cache, str):
+            disk_cache = DiskCache(disk_cache)
+        self.disk_cache = disk_cache
+        self.batch_axis = batch_axis
+        if chunk_reduction not in ('sum', 'mean'):
+            raise ValueError('Unrecognized reduction: {0} (must be \'sum\' '
+                             'or \'mean\').'.format(chunk_reduction))
+        self.chunk_args = utils.as_seq(chunk_args, tuple)
+        self.chunk_size = chunk_size
+        self.chunk_reduction = chunk_reduction
 
     def __call__(self, *args, **kwargs):
+        if self.chunk_args:
+            return self.reduce_chunks(args,
+                                      kwargs,
+                                      chunk_args=self.chunk_args,
+                                      chunk_size=self.chunk_size,
+                                      reduction=self.chunk_reduction)
+        return self.evaluate(*args, **kwargs)
+
+    def evaluate(self, *args, **kwargs):
+        """
+        Calls the compiled function on args and kwargs (without splitting
+        them into chunks).
+        """
+        all_args = self.bind_args(args, kwargs)
+        key = self.get_cache_key(all_args)
+        fn = self.get_cached_function(key, *args, **kwargs)
+        if self.batch_axis is not None:
+            # Theano's scan can not run for zero steps
+            self.get_batch_axes(args, kwargs)
+        return fn(*all_args)
+
+    def bind_args(self, args, kwargs):
+        """
+        Returns a flat tuple of the arguments of a call, ordered by their
+        position in the function signature (see `utils.expandedcallargs`),
+        excluding any bound 'self' or 'cls' argument.
+
+        Calls with only positional arguments to functions without varargs are
+        bound by a precomputed binder for each number of arguments, avoiding
+        the cost of `inspect.getcallargs`.
+        """
+        if not kwargs:
+            if self._binders_symfn is not self.symfn:
+                self._binders = dict()
+                self._binders_symfn = self.symfn
+            try:
+                binder = self._binders[len(args)]
+            except KeyError:
+                binder = self._binders[len(args)] = self._get_binder(len(args))
+            if binder is not None:
+                all_args = binder(args)
+                # containers are flattened, as by `utils.expandedcallargs`
+                if any(isinstance(a, (list, tuple, dict)) for a in all_args):
+                    all_args = tuple(utils.flatten(all_args))
+                if len(all_args) > 0 and type(all_args[0]) is type:
+                    all_args = all_args[1:]
+                return all_args
+
         all_args = utils.expandedcallargs(self.symfn, *args, **kwargs)
         if (inspect.ismethod(self.pyfn) or
            (len(all_args) > 0 and type(all_args[0]) is type)):
             all_args = all_args[1:]
+        return all_args
+
+    def _get_binder(self, nargs):
+        """
+        Returns a function mapping a tuple of `nargs` positional arguments to
+        the full tuple of arguments (including defaults), or None if the
+        signature is not simple enough to bind without `getcallargs`.
+        """
+        fn = getattr(self.symfn, '__func__', self.symfn)
+        code = getattr(fn, '__code__', None)
+        if (code is None
+                or code.co_kwonlyargcount > 0
+                or code.co_flags & (inspect.CO_VARARGS
+                                    | inspect.CO_VARKEYWORDS)):
+            return None
 
-        key = tuple(
-            (np.asarray(a).ndim, np.asarray(a).dtype) for a in all_args)
-        if key not in self.cache or not self.use_cache:
+        argcount = code.co_argcount - int(inspect.ismethod(self.symfn))
+        defaults = fn.__defaults__ or ()
+        if not argcount - len(defaults) <= nargs <= argcount:
+            return None
+
+        missing = tuple(defaults[len(defaults) - (argcount - nargs):])
+        if missing:
+            return lambda args: args + missing
+        else:
+            return lambda args: args
+
+    def get_cache_key(self, all_args):
+        """
+        Returns a key identifying the compiled function for the given
+        arguments. Each argument is described by its ndim and dtype, plus its
+        broadcastable pattern or shape if the function is specialized.
+        """
+        key = []
+        for a in all_args:
+            # avoid np.asarray for the most common argument types; arrays
+            # (including memmaps) are described without touching their data
+            if type(a) is float:
+                a = _float_array
+            elif not isinstance(a, np.ndarray):
+                a = np.asarray(a)
+            if self.context.specialize == 'ndim':
+                key.append((a.ndim, a.dtype))
+            elif self.context.specialize == 'broadcast':
+                key.append((a.ndim, a.dtype, tuple(d == 1 for d in a.shape)))
+            else:
+                key.append((a.ndim, a.dtype, a.shape))
+        return tuple(key)
+
+    def get_cached_function(self, key, *args, **kwargs):
+        """
+        Returns the compiled function for the given cache key, loading it from
+        the disk cache or tracing and compiling it as necessary.
+        """
+        if self.use_cache:
+            fn = self.cache.lookup(key)
+            if self.stats is not None:
+                self.stats.count('cache.miss' if fn is None else 'cache.hit')
+            if fn is not None:
+                return fn
+
+        t0 = time.time()
+        disk_key = self.get_disk_cache_key(key)
+        fn = None
+        if disk_key is not None:
+            fn = self.disk_cache.load(self.pyfn, disk_key)
+        if fn is None:
+            source = 'compiled'
             self.context.reset()
-            inputs, outputs = self.trace(*args, **kwargs)
-            self.cache[key] = self.get_theano_function(inputs, outputs)
-        fn = self.cache[key]
-        return fn(*all_args)
+            if self.batch_axis is None:
+                inputs, outputs = self.trace(*args, **kwargs)
+                fn = self.get_theano_function(inputs, outputs)
+            else:
+                args, kwargs, axes = self.get_batch_sample(args, kwargs)
+                inputs, outputs = self.trace(*args, **kwargs)
+                fn = self.get_batched_theano_function(inputs, outputs, axes)
+            self.context.release(inputs)
+            if disk_key is not None:
+                self.disk_cache.store(self.pyfn, disk_key, fn)
+        else:
+            source = 'disk'
+            if self.stats is not None:
+                self.stats.count('cache.disk_hit')
+        self.cache.add(key, fn, compile_time=time.time() - t0, source=source)
+        return fn
+
+    def bind(self, *args, **kwargs):
+        """
+        Returns a `BoundFunction` that evaluates this function repeatedly on
+        the given arguments, with the loop running inside Theano.
+        """
+        return BoundFunction(self, *args, **kwargs)
+
+    def cache_info(self):
+        """
+        Returns a dictionary with the number of cache hits, misses and
+        evictions, the estimated memory held by the cached functions, and the
+        compile time, size and hits of each cached function.
+        """
+        return self.cache.info()
+
+    def reduce_chunks(self,
+                      args=(),
+                      kwargs=None,
+                      chunk_args=(),
+                      chunk_size=10000,
+                      reduction='sum'):
+        """
+        Evaluates the function on consecutive chunks of rows of the arguments
+        named in `chunk_args` (for example, memory-mapped datasets that do
+        not fit in memory) and combines the results, so that only one chunk
+        is in memory at a time. The other arguments are passed unchanged.
+
+        The function should be a sum or mean over the rows of the chunked
+        arguments (this applies to `Gradient`s as well). With reduction
+        'sum', the results of the chunks are added; with 'mean', they are
+        averaged, weighted by the number of rows in each chunk.
+
+        Arguments
+        ---------
+
+        args, kwargs :
+            The arguments of the function.
+
+        chunk_args : str or sequence of str
+            The names of the arguments to split into chunks along their first
+            axis. They must all have the same length.
+
+        chunk_size : int
+            The number of rows in each chunk. All chunks but the last have
+            the same shape, so they share one compiled function.
+
+        reduction : 'sum' or 'mean'
+            How the results of the chunks are combined.
+
+        """
+        if reduction not in ('sum', 'mean'):
+            raise ValueError('Unrecognized reduction: {0} (must be \'sum\' '
+                             'or \'mean\').'.format(reduction))
+        chunk_args = utils.as_seq(chunk_args, tuple)
+        bound = inspect.signature(self.pyfn).bind(*args,
+                                                  **utils.as_seq(kwargs, dict))
+        lengths = [len(bound.arguments[name]) for name in chunk_args]
+        if not lengths or min(lengths) != max(lengths):
+            raise ValueError('chunk_args must name at least one argument, and '
+                             'the named arguments must have the same length.')
+        n_rows = lengths[0]
+
+        data = dict((name, bound.arguments[name]) for name in chunk_args)
+        total = None
+        for start in range(0, n_rows, chunk_size):
+            for name in chunk_args:
+                bound.arguments[name] = data[name][start: start + chunk_size]
+            result = self.evaluate(*bound.args, **bound.kwargs)
+            if reduction == 'mean':
+                weight = min(chunk_size, n_rows - start)
+            else:
+                weight = 1
+            flat = [weight * np.asarray(r) for r in utils.flatten(result)]
+            if total is None:
+                structure = result
+                total = flat
+            else:
+                total = [t + f for t, f in zip(total, flat)]
+
+        if total is None:
+            raise ValueError('Can not reduce over arguments with no rows.')
+        if reduction == 'mean':
+            total = [t / n_rows for t in total]
+        return utils.unflatten(structure, total)
+
+    def get_disk_cache_key(self, key):
+        """
+        Returns a key identifying the compiled function in the disk cache, or
+        None if it can not be stored there. Bound methods, compile options
+        that refer to objects by identity (rather than by tag) and borrowed
+        objects (which a loaded function would no longer alias) are not
+        supported.
+        """
+        if (not self.use_cache
+                or self.disk_cache is None
+                or inspect.ismethod(self.pyfn)
+                or not hasattr(self.pyfn, '__code__')
+                or self.context.borrowable):
+            return None
+
+        options = []
+        for name, value in sorted(self.get_compile_options().items()):
+            if name == 'wrt':
+                if not all(isinstance(w, str) for w in value):
+                    return None
+            elif name == 'reduction' and value is not None:
+                if not isinstance(value, str):
+                    value = '{0}.{1}'.format(getattr(value, '__module__', ''),
+                                             value.__name__)
+            options.append((name, value))
+
+        if isinstance(self.batch_axis, dict):
+            batch_axis = tuple(sorted(self.batch_axis.items()))
+        else:
+            batch_axis = self.batch_axis
+
+        # ignored functions and types are escaped rather than traced; other
+        # ignored objects are only known by identity
+        ignore = []
+        for i in self.context.ignore:
+            if not hasattr(i, '__qualname__'):
+                return None
+            ignore.append('{0}.{1}'.format(getattr(i, '__module__', ''),
+                                           i.__qualname__))
+
+        return (type(self).__name__,
+                tuple((k[0], str(k[1])) + tuple(k[2:]) for k in key),
+                tuple(options),
+                batch_axis,
+                self.context.infer_updates,
+                self.context.force_floatX,
+                self.context.specialize,
+                self.context.zero_copy,
+                self.context.escape_on_error,
+                tuple(ignore))
+
+    def get_compile_options(self):
+        """
+        Returns the keyword arguments passed to `compile` (in addition to the
+        inputs and outputs).
+        """
+        return dict(function=True)
 
     def get_theano_function(self, inputs, outputs):
-        fn = self.compile_function(inputs=inputs, outputs=outputs)
+        fn = self.compile(inputs=inputs,
+                          outputs=outputs,
+                          **self.get_compile_options())
+        return fn
+
+    def get_batch_axes(self, args, kwargs):
+        """
+        Returns the batch axis of each of args and each of kwargs (a tuple and
+        a dictionary; None for arguments that are not batched). Raises
+        ValueError if any batch is empty.
+        """
+        params = inspect.signature(self.pyfn).parameters.values()
+        names = [p.name for p in params
+                 if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+        varargs = [p.name for p in params if p.kind == p.VAR_POSITIONAL]
+        varargs = varargs[0] if varargs else None
+
+        def get_axis(name, value):
+            if isinstance(self.batch_axis, dict):
+                axis = self.batch_axis.get(name)
+            else:
+                axis = self.batch_axis
+            if axis is not None:
+                for v in utils.flatten(value):
+                    if np.shape(v)[axis] == 0:
+                        raise ValueError(
+                            'Batched functions can not be called with an '
+                            'empty batch (batch axis {0} of an argument with '
+                            'shape {1}).'.format(axis, np.shape(v)))
+            return axis
+
+        arg_axes = tuple(
+            get_axis(names[i] if i < len(names) else varargs, a)
+            for i, a in enumerate(args))
+        kwarg_axes = dict((k, get_axis(k, v)) for k, v in kwargs.items())
+        return arg_axes, kwarg_axes
+
+    def get_batch_sample(self, args, kwargs):
+        """
+        Given batched args and kwargs, returns the args and kwargs of the first
+        sample, as well as a tuple of the batch axis of each (flattened)
+        argument of the sample (None for arguments that are not batched).
+        """
+        arg_axes, kwarg_axes = self.get_batch_axes(args, kwargs)
+        axes = dict()
+
+        def take_sample(value, axis):
+            if axis is None:
+                return value
+            sample = []
+            for v in utils.flatten(value):
+                v_sample = np.take(np.asarray(v), 0, axis=axis)
+                axes[id(v_sample)] = axis
+                sample.append(v_sample)
+            return utils.unflatten(value, sample)
+
+        s_args = tuple(take_sample(a, axis)
+                       for a, axis in zip(args, arg_axes))
+        s_kwargs = dict(
+            (k, take_sample(v, kwarg_axes[k])) for k, v in kwargs.items())
+
+        s_axes = tuple(axes.get(id(a))
+                       for a in self.bind_args(s_args, s_kwargs))
+        return s_args, s_kwargs, s_axes
+
+    def get_batched_theano_function(self, inputs, outputs, axes):
+        """
+        Compiles a function that maps the function traced for a single sample
+        (with the given inputs and outputs) over a batch with `theano.scan`.
+        `axes` gives the batch axis of each input (or None if the input is not
+        batched). Updates are applied after each sample, as if the function
+        were called on the samples in turn.
+        """
+        fn_inputs, fn_outputs = self.get_compile_graph(
+            inputs=inputs,
+            outputs=outputs,
+            **self.get_compile_options())
+        updates = self.get_compile_updates(fn_inputs, fn_outputs)
+        axes = tuple(axes) + (None,) * (len(fn_inputs) - len(axes))
+
+        new_inputs = []
+        sequences = []
+        non_sequences = []
+        for i, axis in zip(fn_inputs, axes):
+            if axis is None:
+                new_i = i.type()
+                non_sequences.append(new_i)
+            else:
+                broadcastable = list(i.broadcastable)
+                broadcastable.insert(axis, False)
+                new_i = T.TensorType(dtype=i.dtype,
+                                     broadcastable=broadcastable)()
+                # scan iterates over the first axis
+                dims = list(range(i.ndim + 1))
+                dims.insert(0, dims.pop(axis))
+                sequences.append(new_i.dimshuffle(*dims))
+            new_inputs.append(new_i)
+
+        batched = [i for i, a in zip(fn_inputs, axes) if a is not None]
+        shared = [i for i, a in zip(fn_inputs, axes) if a is None]
+
+        def step(*step_inputs):
+            replace = dict(zip(batched + shared, step_inputs))
+            step_graph = theano.clone(
+                list(fn_outputs) + list(updates.values()), replace=replace)
+            step_updates = collections.OrderedDict(
+                zip(updates.keys(), step_graph[len(fn_outputs):]))
+            return step_graph[:len(fn_outputs)], step_updates
+
+        results, scan_updates = theano.scan(fn=step,
+                                            sequences=sequences,
+                                            non_sequences=non_sequences)
+
+        fn = theano.function(inputs=new_inputs,
+                             outputs=results,
+                             updates=scan_updates,
+                             on_unused_input='ignore',
+                             allow_input_downcast=True)
         return fn
 
 
@@ -410,7 +1193,48 @@ class Gradient(Function):
                  ignore=None,
                  escape_on_error=False,
                  context=None,
-                 use_cache=True):
+                 use_cache=True,
+                 disk_cache=None,
+                 specialize='ndim',
+                 cache_size=None,
+                 cache_bytes=None,
+                 zero_copy=False,
+                 batch_axis=None,
+                 per_example=False,
+                 jacobian_method='scan',
+                 chunk_args=None,
+                 chunk_size=10000,
+                 chunk_reduction='mean',
+                 stats=None):
+        """
+        Arguments
+        ---------
+
+        wrt : str, object, or sequence
+            The variables (or tags of variables) to differentiate with respect
+            to. If None, all of the function's arguments are used.
+
+        reduction : str or callable
+            A reduction applied to non-scalar outputs (for example 'sum').
+
+        per_example : bool
+            If True, the function returns a vector of per-example losses and
+            the gradient of each example is computed in a single call. The
+            gradient with respect to each wrt variable w has shape
+            (n_examples,) + w.shape. A reduction, if provided, is applied over
+            the trailing axes of the outputs.
+
+        jacobian_method : 'scan' or 'rop'
+            The strategy used to compute per-example gradients (and the
+            matrices returned by `Jacobian` and `Hessian`): 'scan'
+            backpropagates each example's loss (efficient for few examples),
+            while 'rop' uses forward-mode derivatives with respect to each
+            parameter (efficient for few parameters). See
+            `Symbolic.get_jacobian`.
+
+        See `Function` for the remaining arguments.
+
+        """
         super(Gradient, self).__init__(pyfn=pyfn,
                                        force_floatX=force_floatX,
                                        borrowable=borrowable,
@@ -418,16 +1242,33 @@ class Gradient(Function):
                                        infer_updates=infer_updates,
                                        context=context,
                                        escape_on_error=escape_on_error,
-                                       use_cache=use_cache)
+                                       use_cache=use_cache,
+                                       disk_cache=disk_cache,
+                                       specialize=specialize,
+                                       cache_size=cache_size,
+                                       cache_bytes=cache_bytes,
+                                       zero_copy=zero_copy,
+                                       batch_axis=batch_axis,
+                                       chunk_args=chunk_args,
+                                       chunk_size=chunk_size,
+                                       chunk_reduction=chunk_reduction,
+                                       stats=stats)
+        if jacobian_method not in ('scan', 'rop'):
+            raise ValueError('Unrecognized Jacobian method: {0} (must be '
+                             '\'scan\' or \'rop\').'.format(jacobian_method))
         self.wrt = utils.as_seq(wrt, tuple)
         self.reduction = reduction
+        self.per_example = per_example
+        self.jacobian_method = jacobian_method
 
-    def get_theano_function(self, inputs, outputs):
-        fn = self.compile_gradient(inputs=inputs,
-                                   outputs=outputs,
-                                   wrt=self.wrt,
-                                   reduction=self.reduction)
-        return fn
+    def get_compile_options(self):
+        if self.per_example:
+            return dict(gradient=True,
+                        wrt=self.wrt,
+                        reduction=self.reduction,
+                        per_example=True,
+                        jacobian_method=self.jacobian_method)
+        return dict(gradient=True, wrt=self.wrt, reduction=self.reduction)
 
 
 class HessianVector(Gradient):
@@ -440,39 +1281,188 @@ class HessianVector(Gradient):
                 'HessianVector must be called with the keyword \'vectors\'.')
         vectors = utils.as_seq(vectors, tuple)
 
-        all_args = utils.expandedcallargs(self.symfn, *args, **kwargs)
+        all_args = self.bind_args(args, kwargs)
 
-        key = tuple(np.asarray(a).ndim for a in all_args)
-        if key not in self.cache or not self.use_cache:
-            self.context.reset()
-            inputs, outputs = self.trace(*args, **kwargs)
-            self.cache[key] = self.get_theano_function(inputs, outputs)
-        fn = self.cache[key]
+        key = self.get_cache_key(all_args)
+        fn = self.get_cached_function(key, *args, **kwargs)
 
         if len(self.wrt) > 0 and len(vectors) != len(self.wrt):
             raise ValueError('Expected {0} items in `vectors`; received '
                              '{1}.'.format(len(self.wrt), len(vectors)))
-        elif len(self.wrt) == 0 and len(vectors) != len(inputs):
+        elif len(self.wrt) == 0 and len(vectors) != len(all_args):
             raise ValueError('Expected {0} items in `vectors`; received '
-                             '{1}.'.format(len(inputs), len(vectors)))
+                             '{1}.'.format(len(all_args), len(vectors)))
 
         return fn(*(all_args + vectors))
 
-    def get_theano_function(self, inputs, outputs):
-        fn = self.compile(hessian_vector=True,
-                          inputs=inputs,
-                          outputs=outputs,
-                          wrt=self.wrt,
-                          reduction=self.reduction)
-        return fn
+    def bind(self, *args, **kwargs):
+        if 'vectors' in kwargs:
+            vectors = kwargs.pop('vectors')
+        else:
+            raise ValueError(
+                'HessianVector must be called with the keyword \'vectors\'.')
+        return BoundFunction(self,
+                             *args,
+                             _extra_inputs=utils.as_seq(vectors, tuple),
+                             **kwargs)
+
+    def get_compile_options(self):
+        return dict(hessian_vector=True, wrt=self.wrt, reduction=self.reduction)
+
+
+class Jacobian(Gradient):
+    """
+    A Function that returns the Jacobian of each output of the function with
+    respect to each wrt variable w, with shape output.shape + w.shape. The
+    full matrix is built in a single compiled graph; `jacobian_method`
+    selects reverse mode ('scan') or forward mode ('rop').
+    """
+
+    def get_compile_options(self):
+        return dict(jacobian=True,
+                    wrt=self.wrt,
+                    jacobian_method=self.jacobian_method)
+
+
+class Hessian(Gradient):
+    """
+    A Function that returns the dense Hessian of the (scalar) function with
+    respect to the wrt variables, as a block of shape v.shape + w.shape for
+    each pair of wrt variables (v, w), including the cross-derivatives. The
+    full matrix is built in a single compiled graph; `jacobian_method`
+    selects a loop over the rows of the gradient ('scan') or
+    forward-over-reverse products with each basis vector ('rop').
+    """
+
+    def get_compile_options(self):
+        return dict(hessian=True,
+                    wrt=self.wrt,
+                    reduction=self.reduction,
+                    jacobian_method=self.jacobian_method)
+
+
+class BoundFunction(object):
+    """
+    A compiled version of a Function (or Gradient/HessianVector) whose inputs
+    are bound to shared storage, so that it can be called without arguments.
+
+    Calling a BoundFunction with an integer n evaluates the function n times
+    in a loop that runs inside Theano (using the `n_calls` interface of
+    Theano's C virtual machine, where available), and returns the outputs of
+    each evaluation stacked along a new leading axis. This is useful when
+    repeated evaluations differ, for example because the function draws
+    random numbers or has inferred updates.
+
+    The outputs are written to preallocated buffers, which are reused (and
+    overwritten) by the next call with the same n, unless the inputs have
+    been set in between.
+    """
+
+    def __init__(self, function, *args, **kwargs):
+        extra_inputs = kwargs.pop('_extra_inputs', ())
+        self.function = function
+
+        context = function.context
+        context.reset()
+        inputs, outputs = function.trace(*args, **kwargs)
+        fn_inputs, fn_outputs = function.get_compile_graph(
+            inputs=inputs,
+            outputs=outputs,
+            **function.get_compile_options())
+
+        # traced inputs are already shared variables holding the arguments;
+        # any other inputs (like Hessian-vector products' vectors) are given
+        # shared storage here
+        self.inputs = inputs
+        givens = dict()
+        for i, value in zip(fn_inputs[len(inputs):], extra_inputs):
+            shared = theano.shared(np.asarray(value, dtype=i.dtype))
+            self.inputs += (shared,)
+            givens[i] = shared
+
+        self.index = theano.shared(np.asarray(0, dtype='int64'))
+        self.buffers = tuple(
+            theano.shared(np.zeros((0,) * (o.ndim + 1), dtype=o.dtype))
+            for o in fn_outputs)
+
+        updates = function.get_compile_updates(fn_inputs, fn_outputs)
+        updates = collections.OrderedDict(updates)
+        for b, o in zip(self.buffers, fn_outputs):
+            updates[b] = T.set_subtensor(b[self.index], o)
+        updates[self.index] = self.index + 1
+
+        self.fn = theano.function(inputs=[],
+                                  outputs=[],
+                                  givens=givens,
+                                  updates=updates)
+        self.shape_fn = theano.function(inputs=[],
+                                        outputs=[o.shape for o in fn_outputs],
+                                        givens=givens,
+                                        on_unused_input='ignore')
+        self.n_outputs = len(fn_outputs)
+        self._n = None
+
+        context.release()
+
+    def __call__(self, n=1):
+        if n != self._n:
+            shapes = self.shape_fn()
+            for b, shp in zip(self.buffers, shapes):
+                b.set_value(np.empty((n,) + tuple(shp), dtype=b.dtype),
+                            borrow=True)
+            self._n = n
+        self.index.set_value(np.asarray(0, dtype='int64'))
+
+        # all inputs are shared, so the function can be called in the CVM's
+        # internal loop
+        utils.call_repeatedly(self.fn, n)
+
+        results = tuple(b.get_value(borrow=True) for b in self.buffers)
+        if self.n_outputs == 1:
+            return results[0]
+        return results
+
+    def set_inputs(self, *args, **kwargs):
+        """
+        Sets the values of the bound inputs. For HessianVector instances, the
+        vectors must be passed with the keyword 'vectors'.
+        """
+        vectors = utils.as_seq(kwargs.pop('vectors', None), tuple)
+        all_args = self.function.bind_args(args, kwargs) + vectors
+        if len(all_args) != len(self.inputs):
+            raise ValueError('Expected {0} inputs; received {1}.'.format(
+                len(self.inputs), len(all_args)))
+        for i, a in zip(self.inputs, all_args):
+            i.set_value(np.asarray(a, dtype=i.dtype))
+        # the shapes of the outputs may have changed
+        self._n = None
 
 
 class VectorArg(object):
+    """
+    Compiles a function of the arguments `init_args` and `init_kwargs` into a
+    function of a single flat parameter vector (as expected by SciPy's
+    optimizers).
+
+    The layout of the vector -- the shape, size and offset of each argument --
+    is computed once from the initial arguments. `vector` is a persistent
+    float64 buffer holding the parameters, and `arg_views` are views of it
+    with the shapes of the arguments.
+
+    `data` is an optional dictionary of arrays that are passed to pyfn as
+    keyword arguments but are not part of the parameter vector (for example,
+    the training examples of a loss function). They must follow the
+    parameters in pyfn's signature. The data become additional inputs of the
+    compiled function, which is called as fn(vector, *data), with the data in
+    the order of `data_names`; this way the same compiled function can be
+    evaluated on different data, or on a subset of its rows.
+    """
 
     def __init__(self,
                  pyfn,
                  init_args=None,
                  init_kwargs=None,
+                 data=None,
                  context=None,
                  force_floatX=False,
                  borrowable=None,
@@ -490,16 +1480,35 @@ class VectorArg(object):
         init_args = utils.as_seq(init_args, tuple)
         init_kwargs = utils.as_seq(init_kwargs, dict)
 
-        self.init_args = utils.expandedcallargs(
-            pyfn, *init_args, **init_kwargs)
+        self.data = utils.as_seq(data, dict)
+        self.data_names = tuple(sorted(self.data))
+
+        self.init_args = self.expand_args(init_args, init_kwargs)
+
+        self.shapes = tuple(np.shape(a) for a in self.init_args)
+        self.sizes = tuple(int(np.prod(shape)) for shape in self.shapes)
+        self.offsets = tuple(int(o) for o in np.cumsum((0,) + self.sizes))
+        self.size = sum(self.sizes)
+        self.vector = np.empty(self.size, dtype='float64')
+        self.arg_views = self.args_from_vector(self.vector)
+        self.vector_from_args(init_args, init_kwargs)
 
         def wrapped_function(vector):
             return pyfn(*escaped_call(self.args_from_vector, vector))
 
-        def wrapper(*args, **kwargs):
+        def wrapper(data, *args, **kwargs):
             vector = self.vector_from_args(args, kwargs)
             v_args = self.args_from_vector(vector)
-            return vector, pyfn(*v_args)
+            return vector, pyfn(*v_args, **data)
+
+        # the packing functions handle symbolic arguments themselves
+        ignore = utils.as_seq(ignore, tuple) + (self.vector_from_args,
+                                                self.args_from_vector)
+
+        # the data are inputs of the compiled function, so they can be
+        # borrowed rather than copied into shared variables
+        borrowable = (utils.as_seq(borrowable, tuple)
+                      + tuple(self.data.values()))
 
         symbolic = Symbolic(pyfn=wrapper,
                             context=context,
@@ -509,47 +1518,107 @@ class VectorArg(object):
                             ignore=ignore,
                             escape_on_error=escape_on_error)
 
-        _, (sym_vector, result) = symbolic.trace(*init_args, **init_kwargs)
-
-        fn = symbolic.compile(function=function,
-                              gradient=gradient,
-                              hessian_vector=hessian_vector,
-                              inputs=sym_vector,
-                              outputs=result)
-        self.fn = fn
+        _, (sym_vector, result) = symbolic.trace(
+            self.data, *init_args, **init_kwargs)
+        self.symbolic = symbolic
+        self.sym_vector = sym_vector
+        self.sym_data = [symbolic.get_symbolic(self.data[k])
+                         for k in self.data_names]
+        self.result = result
+
+        if function or gradient or hessian_vector:
+            self.fn = self.compile(function=function,
+                                   gradient=gradient,
+                                   hessian_vector=hessian_vector)
+        else:
+            self.fn = None
 
     def __call__(self, *args, **kwargs):
         return self.fn(*args, **kwargs)
 
+    def compile(self, function=False, gradient=False, hessian_vector=False):
+        """
+        Compiles a Theano function of the parameter vector from the traced
+        function, without tracing it again. This allows several functions
+        (for example, the function and gradient, and the Hessian-vector
+        product) to share a single trace.
+        """
+        return self.symbolic.compile(function=function,
+                                     gradient=gradient,
+                                     hessian_vector=hessian_vector,
+                                     inputs=[self.sym_vector] + self.sym_data,
+                                     outputs=self.result,
+                                     wrt=self.sym_vector)
+
+    def release(self):
+        """
+        Drops the tracing state and the references to the data once the
+        functions have been compiled (see `Context.release`). The traced graph
+        is kept, so `compile` can still be called.
+        """
+        self.symbolic.context.release(self.sym_data)
+        # the symbolic data stand in for the data when arguments are expanded
+        self.data = dict(zip(self.data_names, self.sym_data))
+
+    def expand_args(self, args, kwargs):
+        """
+        Returns a tuple of the parameter arguments of pyfn (excluding the
+        data), ordered by their position in its signature.
+        """
+        if not self.data:
+            return utils.expandedcallargs(self.pyfn, *args, **kwargs)
+        callargs = utils.orderedcallargs(self.pyfn,
+                                         *args,
+                                         **dict(kwargs, **self.data))
+        for name in self.data_names:
+            del callargs[name]
+        return tuple(utils.flatten(callargs))
+
     def vector_from_args(self, args, kwargs):
+        """
+        Packs the arguments into the parameter vector. Numeric arguments are
+        copied into the persistent buffer `vector`, which is returned itself
+        (not a copy), so it is overwritten by the next call; symbolic
+        arguments are concatenated into a symbolic vector. The arguments must
+        have the sizes of the initial arguments.
+        """
         if len(args) + len(kwargs) > 1:
-            all_args = utils.expandedcallargs(self.pyfn, *args, **kwargs)
-            return np.concatenate([np.asarray(a).flatten() for a in all_args])
+            all_args = self.expand_args(args, kwargs)
         elif len(args) > 0:
-            return np.asarray(args[0]).flatten()
+            all_args = tuple(args)
         elif len(kwargs) > 0:
-            return np.asarray(list(kwargs.values())[0]).flatten()
+            all_args = tuple(kwargs.values())
         else:
             return None
 
+        if any(utils.isvar(a) for a in all_args):
+            return T.concatenate(
+                [T.as_tensor_variable(a).flatten() for a in all_args])
+
+        if len(all_args) != len(self.sizes):
+            raise ValueError('Expected {0} arguments; received {1}.'.format(
+                len(self.sizes), len(all_args)))
+        for i, (a, size) in enumerate(zip(all_args, self.sizes)):
+            if np.size(a) != size:
+                raise ValueError(
+                    'Argument {0} has size {1}, but the parameter vector was '
+                    'laid out for size {2} (shape {3}).'.format(
+                        i, np.size(a), size, self.shapes[i]))
+
+        for a, offset, size in zip(all_args, self.offsets, self.sizes):
+            self.vector[offset: offset + size] = np.ravel(a)
+        return self.vector
+
     def args_from_vector(self, vector):
-        new_args = []
-        idx = 0
-        for arg in escape(self.init_args):
-            # new_args.append(vector[idx: idx + arg.size].reshape(*arg.shape))
-            # avoid using arg.size or prod(arg.shape) because Theano's prod
-            # doesn't support R-op
-            new_args.append(
-                vector[idx: idx + safesize(arg)].reshape(arg.shape))
-            idx += safesize(arg)
-        return new_args
-
-
-def safesize(arg):
-    if arg.ndim == 0:
-        size = 1
-    else:
-        size = arg.shape[0]
-        for i in list(range(1, arg.ndim)):
-            size *= arg.shape[i]
-    return size
+        """
+        Unpacks the parameter vector into a list of arguments. For arrays,
+        the arguments are views of the vector.
+        """
+        if not utils.isvar(vector):
+            vector = np.asarray(vector)
+        # use the precomputed shapes rather than the symbolic size of each
+        # argument, because Theano's prod doesn't support R-op
+        return [vector[offset: offset + size].reshape(shape)
+                for offset, size, shape in zip(self.offsets,
+                                               self.sizes,
+                                               self.shapes)]
@@ -0,0 +1,216 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from autodiff.cache import DiskCache, FunctionCache, LRUCache, source_hash
+from autodiff.symbolic import Function, Gradient
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def entries(self):
+        return [f for f in os.listdir(self.path) if f.endswith('.pkl')]
+
+    def test_store_load(self):
+        def fn(x):
+            return x ** 2
+
+        f = Function(fn, disk_cache=self.path)
+        self.assertTrue(np.allclose(f(3.0), 9.0))
+        self.assertTrue(len(self.entries()) == 1)
+
+        # a new Function loads the compiled function instead of tracing
+        f2 = Function(fn, disk_cache=self.path)
+        f2.trace = None
+        self.assertTrue(np.allclose(f2(4.0), 16.0))
+        self.assertTrue(len(self.entries()) == 1)
+
+    def test_options_in_key(self):
+        def fn(x, y):
+            return x * y
+
+        Function(fn, disk_cache=self.path)(3.0, 5.0)
+        g = Gradient(fn, wrt='x', disk_cache=self.path)
+        self.assertTrue(np.allclose(g(3.0, 5.0), 5.0))
+        g = Gradient(fn, wrt='y', disk_cache=self.path)
+        self.assertTrue(np.allclose(g(3.0, 5.0), 3.0))
+        self.assertTrue(len(self.entries()) == 3)
+
+    def test_context_options_in_key(self):
+        def fn(x):
+            return x * 2
+
+        Function(fn, disk_cache=self.path)(3.0)
+        Function(fn, disk_cache=self.path, zero_copy=True)(3.0)
+        Function(fn, disk_cache=self.path, specialize='shape')(3.0)
+        self.assertTrue(len(self.entries()) == 3)
+
+        # a loaded function would not alias borrowed objects
+        y = np.ones(3)
+
+        def fn2(x):
+            return x * y
+        f = Function(fn2, disk_cache=self.path, borrowable=(y,))
+        self.assertTrue(np.allclose(f(2.0), 2.0))
+        self.assertTrue(len(self.entries()) == 3)
+
+    def test_wrt_object_not_stored(self):
+        def fn(x, y):
+            return x * y
+        a = np.array(3.0)
+        g = Gradient(fn, wrt=a, disk_cache=self.path)
+        self.assertTrue(np.allclose(g(a, 5.0), 5.0))
+        self.assertTrue(len(self.entries()) == 0)
+
+    def test_invalidate_on_source_change(self):
+        def fn(x):
+            return x + 1
+        Function(fn, disk_cache=self.path)(1.0)
+        old_entries = self.entries()
+
+        def fn(x):
+            return x + 2
+        self.assertTrue(np.allclose(
+            Function(fn, disk_cache=self.path)(1.0), 3.0))
+        new_entries = self.entries()
+        self.assertTrue(len(new_entries) == 1)
+        self.assertTrue(new_entries != old_entries)
+
+    def test_closures_of_one_factory(self):
+        def make(y):
+            def fn(x):
+                return x * y
+            return fn
+
+        f2, f3 = make(2.0), make(3.0)
+        self.assertTrue(np.allclose(Function(f2, disk_cache=self.path)(1.0),
+                                    2.0))
+        self.assertTrue(np.allclose(Function(f3, disk_cache=self.path)(1.0),
+                                    3.0))
+        # both entries are kept, and each closure loads its own
+        self.assertTrue(len(self.entries()) == 2)
+        for f, y in [(f2, 2.0), (f3, 3.0)]:
+            g = Function(f, disk_cache=self.path)
+            g.trace = None
+            self.assertTrue(np.allclose(g(1.0), y))
+
+    def test_hash_reused(self):
+        y = np.ones(3)
+
+        def fn(x):
+            return x * y
+        digest = source_hash(fn)
+        # arrays are only hashed again if a different array is referenced
+        y[:] = 0.0
+        self.assertTrue(source_hash(fn) == digest)
+        y = np.zeros(3)
+        self.assertTrue(source_hash(fn) != digest)
+
+    def test_closure_values_in_hash(self):
+        def make(y):
+            def fn(x):
+                return x * y
+            return fn
+        self.assertTrue(
+            source_hash(make(np.ones(3))) != source_hash(make(np.zeros(3))))
+        self.assertTrue(
+            source_hash(make(np.ones(3))) == source_hash(make(np.ones(3))))
+
+    def test_memmap_in_hash(self):
+        filename = os.path.join(self.path, 'x.dat')
+        mm = np.memmap(filename, dtype='float64', mode='w+', shape=(10, 3))
+        mm[:] = 1.0
+
+        def make(y):
+            def fn(x):
+                return x * y
+            return fn
+
+        # memmaps are identified by their position in the file
+        self.assertTrue(
+            source_hash(make(mm[:5])) == source_hash(make(mm[:5])))
+        self.assertTrue(
+            source_hash(make(mm[:5])) != source_hash(make(mm[5:])))
+        del mm
+
+    def test_referenced_values_in_hash(self):
+        class Model(object):
+            def __init__(self, w):
+                self.w = w
+                self.model = self
+
+        def scale(x, model):
+            return x * model.w
+
+        def make(w):
+            model = Model(w)
+
+            def fn(x):
+                return scale(x, model)
+            return fn
+
+        # the state of objects and the code of helper functions are hashed
+        self.assertTrue(
+            source_hash(make(np.ones(3))) != source_hash(make(np.zeros(3))))
+        self.assertTrue(
+            source_hash(make(np.ones(3))) == source_hash(make(np.ones(3))))
+
+    def test_eviction(self):
+        def fn(x):
+            return x + 1
+        f = Function(fn, disk_cache=DiskCache(self.path, max_bytes=0))
+        self.assertTrue(np.allclose(f(1.0), 2.0))
+        self.assertTrue(len(self.entries()) == 0)
+
+
+class TestFunctionCache(unittest.TestCase):
+    def test_lru(self):
+        c = LRUCache(maxsize=2)
+        c['a'] = 1
+        c['b'] = 2
+        c['a']
+        c['c'] = 3
+        self.assertTrue(list(c.keys()) == ['a', 'c'])
+
+    def test_info(self):
+        def fn(x):
+            return x * 2
+
+        f = Function(fn)
+        f(1.0)
+        f(2.0)
+        f(np.ones(3))
+        f(np.ones(4))
+        info = f.cache_info()
+        self.assertTrue(info['hits'] == 2)
+        self.assertTrue(info['misses'] == 2)
+        self.assertTrue(info['evictions'] == 0)
+        self.assertTrue(info['size'] == 2)
+        self.assertTrue(info['nbytes'] > 0)
+        for entry in info['entries']:
+            self.assertTrue(entry['compile_time'] > 0)
+            self.assertTrue(entry['hits'] == 1)
+            self.assertTrue(entry['source'] == 'compiled')
+
+    def test_max_bytes(self):
+        def fn(x):
+            return x * 2
+
+        f = Function(fn, cache_bytes=0)
+        self.assertTrue(np.allclose(f(1.0), 2.0))
+        self.assertTrue(np.allclose(f(np.ones(3)), 2.0))
+        self.assertTrue(np.allclose(f(np.ones((3, 3))), 2.0))
+        info = f.cache_info()
+        self.assertTrue(info['size'] == 1)
+        self.assertTrue(info['evictions'] == 2)
+        # the running total tracks the entries
+        self.assertTrue(info['nbytes'] == sum(e['nbytes']
+                                              for e in info['entries']))
+        self.assertTrue(isinstance(f.cache, FunctionCache))
@@ -10,6 +10,8 @@ import autodiff.context as c
 from autodiff.functions import escape
 
 
+DEFAULT_SCALE = 3.0
+
 context = autodiff.context.Context(force_floatX=False)
 context_floatX = autodiff.context.Context(force_floatX=True)
 
@@ -1191,3 +1193,183 @@ class InferUpdates(unittest.TestCase):
         self.assertTrue(np.allclose(compiled(), 5.0))
         self.assertTrue(np.allclose(compiled_upd(), 5.0))
         self.assertTrue(np.allclose(compiled_upd(), 10.0))
+
+
+class DispatchCache(unittest.TestCase):
+    def test_cached(self):
+        ctx = c.Context()
+
+        def helper(x):
+            return np.tanh(x) * 2
+
+        def f(x):
+            y = x
+            for i in range(20):
+                y = helper(y) + np.sum(y)
+            return y
+
+        F = ctx.recompile(f)
+        x = np.ones(3)
+        self.assertTrue(np.allclose(F(x).eval(), f(x)))
+
+        dispatch_cache = ctx._dispatch_cache
+        self.assertTrue(dispatch_cache[id(np.tanh)][0] is np.tanh)
+        self.assertTrue(dispatch_cache[id(np.sum)][0] is np.sum)
+        self.assertTrue(id(range) in dispatch_cache)
+
+        # user functions are recompiled once per trace
+        self.assertTrue(id(helper) not in dispatch_cache)
+        new_helper = ctx._recompiled[c.recompile_key(helper)][1]
+        transformer = c.TheanoTransformer(context=ctx)
+        self.assertTrue(transformer.handle_functions(helper) is new_helper)
+        ctx.reset()
+        self.assertTrue(len(ctx._recompiled) == 0)
+        self.assertTrue(id(np.tanh) in ctx._dispatch_cache)
+
+    def test_closure_rebound(self):
+        ctx = c.Context()
+
+        def f(x):
+            k = 1.0
+
+            def helper(y):
+                return y * k
+            y = helper(x)
+            k = 2.0
+            y = y + helper(x)
+            for k in [3.0, 4.0]:
+                y = y + helper(x)
+            return y
+
+        F = ctx.recompile(f)
+        x = np.ones(3)
+        self.assertTrue(np.allclose(F(x).eval(), f(x)))
+        self.assertTrue(np.allclose(F(x).eval(), 10.0))
+
+    def test_methods_not_cached(self):
+        ctx = c.Context()
+
+        def f(x):
+            lst = []
+            lst.append(x)
+            return x.sum() + lst[0]
+
+        F = ctx.recompile(f)
+        x = np.ones(3)
+        self.assertTrue(np.allclose(F(x).eval(), f(x)))
+        for func, result in ctx._dispatch_cache.values():
+            self.assertTrue(getattr(func, '__self__', None) is None
+                            or not isinstance(func.__self__, list))
+
+    def test_numpy_table(self):
+        self.assertTrue(c._NUMPY_TO_THEANO[id(np.tanh)][1] is T.tanh)
+        self.assertTrue(id(len) in c._BUILTIN_IDS)
+
+
+class CodeCache(unittest.TestCase):
+    def test_reuse_across_traces(self):
+        ctx = c.Context()
+
+        def make_layer(scale):
+            def layer(x):
+                return np.tanh(x) * scale
+            return layer
+
+        layers = [make_layer(float(i)) for i in range(1, 4)]
+
+        def f(x):
+            for layer in layers:
+                x = layer(x)
+            return x
+
+        x = np.ones(3)
+        for i in range(2):
+            ctx.reset()
+            F = ctx.recompile(f)
+            self.assertTrue(np.allclose(F(x).eval(), f(x)))
+
+        # one entry for f and one shared by the three layer closures
+        codes = [key[0] for key in c._code_cache]
+        self.assertTrue(codes.count(f.__code__) == 1)
+        self.assertTrue(codes.count(layers[0].__code__) == 1)
+
+        # each closure is bound to its own values
+        self.assertTrue(len(ctx._recompiled) == 3)
+
+    def test_invalidate(self):
+        ctx = c.Context()
+
+        def f(x):
+            return x + 1
+
+        ctx.recompile(f)
+        key = (f.__code__, False, False)
+        code, mtime = c._code_cache[key]
+        c._code_cache[key] = (code, -1)
+        ctx.recompile(f)
+        self.assertTrue(c._code_cache[key][0] is not code)
+        self.assertTrue(c._code_cache[key][1] == mtime)
+
+    def test_global_defaults(self):
+        ctx = c.Context()
+
+        def helper(x, scale=DEFAULT_SCALE, dtype: np.dtype = np.float64):
+            return x * scale
+
+        def f(x):
+            return helper(x)
+
+        F = ctx.recompile(f)
+        self.assertTrue(np.allclose(F(np.ones(2)).eval(), 3.0))
+
+    def test_kwonly_defaults(self):
+        ctx = c.Context()
+
+        def helper(x, *, scale=2.0):
+            return x * scale
+
+        def f(x):
+            return helper(x) + helper(x, scale=1.0)
+
+        F = ctx.recompile(f)
+        self.assertTrue(np.allclose(F(np.ones(2)).eval(), 3.0))
+        G = ctx.recompile(helper)
+        self.assertTrue(G.__kwdefaults__ == {'scale': 2.0})
+
+    def test_shared_by_contexts(self):
+        def f(x):
+            return x * 2
+
+        c.clear_code_cache()
+        c.Context().recompile(f)
+        code = c._code_cache[(f.__code__, False, False)][0]
+
+        # a new context only binds the cached code
+        ctx = c.Context()
+        F = ctx.recompile(f)
+        self.assertTrue(F.__code__ is code)
+        self.assertTrue(np.allclose(F(np.ones(2)).eval(), 2.0))
+
+        # the transformation depends on infer_updates
+        c.Context(infer_updates=True).recompile(f)
+        self.assertTrue((f.__code__, False, True) in c._code_cache)
+
+    def test_bound_method(self):
+        class Model(object):
+            def __init__(self, w):
+                self.w = w
+
+            @autodiff.function
+            def predict(self, x):
+                return x * self.w
+
+        c.clear_code_cache()
+        a = Model(2.0)
+        self.assertTrue(np.allclose(a.predict(np.ones(2)), 2.0))
+        code = a.predict.symfn.__code__
+
+        # every access of a bound method recompiles it, reusing the code
+        n_entries = len(c._code_cache)
+        for model in [a, Model(3.0)]:
+            self.assertTrue(model.predict.symfn.__code__ is code)
+        self.assertTrue(len(c._code_cache) == n_entries)
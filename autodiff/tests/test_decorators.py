@@ -5,6 +5,7 @@ import theano.tensor as T
 
 import autodiff
 from autodiff.decorators import function, gradient, hessian_vector
+from autodiff.decorators import jacobian, hessian
 from autodiff.decorators import symbolic, theanify
 from autodiff.functions import tag
 
@@ -118,6 +119,22 @@ class TestHV(unittest.TestCase):
         self.assertTrue(np.allclose(x * 2, fn(x[0], vectors=x[0])))
 
 
+class TestJacobianHessian(unittest.TestCase):
+    def test_jacobian(self):
+        @jacobian
+        def fn(x):
+            return x ** 2
+        x = np.arange(3.0)
+        self.assertTrue(np.allclose(fn(x), np.diag(2 * x)))
+
+    def test_hessian(self):
+        @hessian(jacobian_method='rop')
+        def fn(x):
+            return (x ** 3).sum()
+        x = np.arange(3.0)
+        self.assertTrue(np.allclose(fn(x), np.diag(6 * x)))
+
+
 class TestClass(unittest.TestCase):
     def setUp(self):
         class AutoDiff(object):
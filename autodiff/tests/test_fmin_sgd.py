@@ -0,0 +1,152 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from autodiff.fmin_sgd import FMinSGD, fmin_sgd, StreamFeeder
+
+
+def linear_loss(w, b, x, y):
+    return ((np.dot(x, w) + b - y) ** 2).mean()
+
+
+class TestFMinSGD(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.true_w = np.array([1.0, -2.0, 0.5])
+        self.x = rng.randn(200, 3)
+        self.y = np.dot(self.x, self.true_w) + 0.3
+
+    def test_methods(self):
+        for method, step_size in [('sgd', 0.05),
+                                  ('momentum', 0.02),
+                                  ('adagrad', 0.5),
+                                  ('adam', 0.05)]:
+            w, b = fmin_sgd(linear_loss,
+                            (np.zeros(3), np.zeros(())),
+                            dict(x=self.x, y=self.y),
+                            step_size=step_size,
+                            batch_size=10,
+                            method=method,
+                            loops=50)
+            self.assertTrue(np.allclose(w, self.true_w, atol=5e-2), method)
+            self.assertTrue(np.allclose(b, 0.3, atol=5e-2), method)
+
+    def test_iterator(self):
+        def loss(w, x, y):
+            return (np.dot(x, w) - y) ** 2
+
+        obj = FMinSGD(loss,
+                      [np.zeros(3)],
+                      dict(x=self.x, y=np.dot(self.x, self.true_w)),
+                      step_size=0.05,
+                      loops=2)
+        self.assertTrue(obj.n_batches == 200)
+        costs = obj.nextN(150)
+        self.assertTrue(len(costs) == 150)
+        costs = obj.nextN(500)
+        self.assertTrue(len(costs) == 250)
+        self.assertTrue(len(obj.nextN(10)) == 0)
+        self.assertRaises(StopIteration, next, obj)
+        self.assertTrue(np.allclose(obj.current_args, self.true_w,
+                                    atol=1e-3))
+
+    def test_backoff(self):
+        obj = FMinSGD(linear_loss,
+                      (np.zeros(3), np.zeros(())),
+                      dict(x=self.x, y=self.y),
+                      step_size=1e20,
+                      batch_size=10,
+                      loops=100)
+        costs = obj.nextN(50)
+        self.assertTrue(len(costs) == 50)
+        self.assertTrue(obj.s_skipped.get_value() > 0)
+        self.assertTrue(np.allclose(obj.step_size, 1e20 * 0.25))
+        # the steps that diverged were not applied
+        self.assertTrue(np.all(np.isfinite(obj.current_args[0])))
+        self.assertTrue(np.isfinite(obj.current_args[1]))
+
+    def test_bad_method(self):
+        self.assertRaises(ValueError, FMinSGD, linear_loss,
+                          (np.zeros(3), np.zeros(())),
+                          dict(x=self.x, y=self.y),
+                          step_size=0.1,
+                          method='foo')
+
+
+class TestStreamFeeder(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.true_w = np.array([1.0, -2.0, 0.5])
+        self.x = rng.randn(200, 3)
+        self.y = np.dot(self.x, self.true_w) + 0.3
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_chunks(self):
+        def source():
+            # chunks of uneven length
+            for start in range(0, 200, 30):
+                yield dict(x=self.x[start: start + 30],
+                           y=self.y[start: start + 30])
+
+        feeder = StreamFeeder(source, batch_size=8, chunk_batches=5, loops=2)
+        self.assertTrue(np.allclose(feeder.sample()['x'], self.x[:8]))
+        rows = []
+        buffers = set()
+        while True:
+            chunk, n_batches = feeder.next_chunk()
+            if chunk is None:
+                break
+            buffers.add(id(chunk['x']))
+            rows.append(chunk['x'][:n_batches * 8].copy())
+        rows = np.concatenate(rows)
+        # 400 rows, split into minibatches of 8
+        self.assertTrue(len(rows) == 400)
+        self.assertTrue(np.allclose(rows, np.concatenate([self.x, self.x])))
+        # only the two preallocated buffers are used
+        self.assertTrue(len(buffers) == 2)
+        self.assertTrue(feeder.next_chunk() == (None, 0))
+
+    def test_fmin_sgd(self):
+        np.save(os.path.join(self.path, 'x.npy'), self.x)
+        np.save(os.path.join(self.path, 'y.npy'), self.y)
+        feeder = StreamFeeder(dict(x=os.path.join(self.path, 'x.npy'),
+                                   y=os.path.join(self.path, 'y.npy')),
+                              batch_size=10,
+                              chunk_batches=4,
+                              loops=50)
+        w, b = fmin_sgd(linear_loss,
+                        (np.zeros(3), np.zeros(())),
+                        feeder,
+                        step_size=0.05)
+        self.assertTrue(np.allclose(w, self.true_w, atol=5e-2))
+        self.assertTrue(np.allclose(b, 0.3, atol=5e-2))
+
+        # the feeder's thread stops once its data is exhausted
+        feeder._thread.join(5.0)
+        self.assertFalse(feeder._thread.is_alive())
+
+    def test_close(self):
+        feeder = StreamFeeder(dict(x=self.x, y=self.y),
+                              batch_size=10,
+                              chunk_batches=2,
+                              loops=50)
+        self.assertRaises(ValueError, FMinSGD, linear_loss,
+                          (np.zeros(3), np.zeros(())),
+                          feeder,
+                          step_size=0.05,
+                          loops=2)
+
+        with FMinSGD(linear_loss,
+                     (np.zeros(3), np.zeros(())),
+                     feeder,
+                     step_size=0.05) as obj:
+            self.assertTrue(len(obj.nextN(3)) == 3)
+            self.assertRaises(ValueError, obj.nextN, 3, force=True)
+        feeder._thread.join(5.0)
+        self.assertFalse(feeder._thread.is_alive())
+        self.assertTrue(len(obj.nextN(3)) == 0)
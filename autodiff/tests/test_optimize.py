@@ -1,6 +1,11 @@
+import os
+import shutil
+import tempfile
 import unittest
 import numpy as np
-from autodiff.optimize import fmin_l_bfgs_b, fmin_cg, fmin_ncg
+from autodiff.optimize import fmin_l_bfgs_b, fmin_cg, fmin_ncg, Objective
+from autodiff.optimize import get_objective, fmin_l_bfgs_b_multistart
+from autodiff.optimize import DataParallelObjective
 
 
 def L2(x, y):
@@ -121,3 +126,199 @@ class TestSVM(unittest.TestCase):
         w, b = fmin_l_bfgs_b(loss_fn, (np.zeros(5), np.zeros(())))
         final_loss = loss_fn(w, b)
         assert np.allclose(final_loss, 0.7229)
+
+
+def double_well(x):
+    return ((x ** 2 - 1) ** 2 + 0.3 * x).sum()
+
+
+class TestMultistart(unittest.TestCase):
+    def check(self, processes):
+        x, info = fmin_l_bfgs_b_multistart(double_well,
+                                           np.ones(1),
+                                           n_starts=6,
+                                           scale=2.0,
+                                           seed=0,
+                                           processes=processes)
+        # the warm start converges to the local minimum near x = 1
+        self.assertTrue(len(info['starts']) == 6)
+        self.assertTrue(np.allclose(info['starts'][0]['x0'], 1.0))
+        self.assertTrue(info['starts'][0]['f_opt'] > 0)
+        self.assertTrue(info['starts'][0]['info']['warnflag'] == 0)
+
+        # the best start finds the global minimum near x = -1
+        self.assertTrue(x[0] < -1)
+        self.assertTrue(np.allclose(info['f_opt'], double_well(x)))
+        self.assertTrue(info['f_opt'] == min(
+            r['f_opt'] for r in info['starts']))
+
+    def test_serial(self):
+        self.check(processes=1)
+
+    def test_parallel(self):
+        self.check(processes=2)
+
+    def test_starts(self):
+        x, info = fmin_l_bfgs_b_multistart(double_well,
+                                           np.ones(1),
+                                           n_starts=2,
+                                           starts=[np.array([-2.0])],
+                                           processes=1)
+        self.assertTrue(len(info['starts']) == 2)
+        self.assertTrue(info['best'] == 1)
+        self.assertTrue(x[0] < -1)
+
+        # n_starts includes the initial guess and the given starts
+        self.assertRaises(ValueError, fmin_l_bfgs_b_multistart, double_well,
+                          np.ones(1), n_starts=1, starts=[np.array([-2.0])])
+
+
+class TestObjective(unittest.TestCase):
+    def test_cache(self):
+        x0 = np.zeros(2)
+        obj = Objective(subtensor_loss, x0, hessian_vector=True)
+
+        calls = []
+        f_df = obj.f_df.fn
+
+        def counted(*args):
+            calls.append(args)
+            return f_df(*args)
+        obj.f_df.fn = counted
+
+        x = np.ones(2)
+        self.assertTrue(np.allclose(obj.f(x), 26.3))
+        self.assertTrue(np.allclose(obj.fprime(x), [8.0, -6.0]))
+        self.assertTrue(len(calls) == 1)
+
+        # modifying x inplace is a new point
+        x[0] = 2.0
+        self.assertTrue(np.allclose(obj.fprime(x), [10.0, -6.0]))
+        self.assertTrue(len(calls) == 2)
+
+        self.assertTrue(np.allclose(obj.fhess_p(x, np.ones(2)), [2.0, 2.0]))
+
+    def test_reuse(self):
+        def loss(x, y):
+            return ((x - 1.0) ** 2).sum() + ((y + 2.0) ** 2).sum()
+
+        obj = get_objective(loss, (np.zeros(3), np.zeros(2)))
+        self.assertTrue(get_objective(loss, (np.ones(3), np.ones(2))) is obj)
+        self.assertTrue(
+            get_objective(loss, (np.ones(4), np.ones(2))) is not obj)
+        self.assertTrue(
+            get_objective(loss, (np.ones(3), np.ones(2)), use_cache=False)
+            is not obj)
+
+        # a Hessian-vector product is compiled for the cached objective
+        self.assertTrue(obj.hv is None)
+        self.assertTrue(get_objective(loss, (np.ones(3), np.ones(2)),
+                                      hessian_vector=True) is obj)
+        self.assertTrue(obj.hv is not None)
+
+        for x0 in [np.zeros(3), np.ones(3)]:
+            x, y = fmin_l_bfgs_b(loss, (x0, np.zeros(2)))
+            self.assertTrue(np.allclose(x, 1.0) and np.allclose(y, -2.0))
+
+    def test_reuse_closure_change(self):
+        target = np.zeros(3)
+
+        def loss(x):
+            return ((x - target) ** 2).sum()
+
+        obj = get_objective(loss, np.ones(3))
+        # the tracing state is released
+        sym_vars = obj.f_df.symbolic.context.sym_vars
+        self.assertTrue(all(isinstance(k, str) for k in sym_vars))
+        self.assertTrue(np.allclose(fmin_l_bfgs_b(loss, np.ones(3)), 0.0))
+
+        # rebinding the closure compiles a new objective
+        target = np.ones(3)
+        self.assertTrue(get_objective(loss, np.ones(3)) is not obj)
+        self.assertTrue(np.allclose(fmin_l_bfgs_b(loss, np.zeros(3)), 1.0))
+
+        # inplace changes are not detected without use_cache=False
+        obj = get_objective(loss, np.ones(3))
+        target[:] = 2.0
+        self.assertTrue(get_objective(loss, np.ones(3)) is obj)
+        self.assertTrue(np.allclose(
+            fmin_l_bfgs_b(loss, np.zeros(3), use_cache=False), 2.0))
+
+
+def least_squares(w, x, y):
+    return ((np.dot(x, w) - y) ** 2).sum()
+
+
+class TestDataParallel(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.randn(101, 4)
+        self.w = np.arange(4.)
+        self.y = np.dot(self.x, self.w)
+
+    def test_data_inputs(self):
+        data = dict(x=self.x, y=self.y)
+        obj = get_objective(least_squares, np.zeros(4), data=data)
+        self.assertTrue(obj.f_df.data_names == ('x', 'y'))
+        self.assertTrue(np.allclose(obj.f(self.w), 0.0))
+
+        # new data is evaluated without recompiling
+        data2 = dict(x=self.x[:50], y=self.y[:50] + 1.0)
+        self.assertTrue(get_objective(least_squares, np.zeros(4),
+                                      data=data2) is obj)
+        self.assertTrue(np.allclose(obj.f(self.w), 50.0))
+
+        # the traced VectorArg does not keep the data
+        self.assertFalse(any(v is self.x or v is self.y
+                             for v in obj.f_df.data.values()))
+
+    def test_shards(self):
+        obj = get_objective(least_squares,
+                            np.zeros(4),
+                            data=dict(x=self.x, y=self.y))
+        x0 = np.ones(4)
+        value, grad = obj.evaluate(x0)
+        with DataParallelObjective(obj.f_df.fn,
+                                   data=[self.x, self.y],
+                                   processes=3) as parallel:
+            self.assertTrue(len(parallel.workers) == 3)
+            p_value, p_grad = parallel(x0)
+        self.assertTrue(np.allclose(value, p_value))
+        self.assertTrue(np.allclose(grad, p_grad))
+
+        with DataParallelObjective(obj.f_df.fn,
+                                   data=[self.x, self.y],
+                                   processes=3,
+                                   reduction='mean') as parallel:
+            p_value, p_grad = parallel(x0)
+        self.assertTrue(np.allclose(value / 101.0, p_value))
+
+    def test_memmap_shards(self):
+        path = tempfile.mkdtemp()
+        try:
+            x = np.memmap(os.path.join(path, 'x.dat'), dtype='float64',
+                          mode='w+', shape=self.x.shape)
+            x[:] = self.x
+            x.flush()
+            obj = get_objective(least_squares,
+                                np.zeros(4),
+                                data=dict(x=self.x, y=self.y))
+            x0 = np.ones(4)
+            with DataParallelObjective(obj.f_df.fn,
+                                       data=[x, self.y],
+                                       processes=3) as parallel:
+                p_value, p_grad = parallel(x0)
+            value, grad = obj.evaluate(x0)
+            self.assertTrue(np.allclose(value, p_value))
+            self.assertTrue(np.allclose(grad, p_grad))
+            del x
+        finally:
+            shutil.rmtree(path)
+
+    def test_fmin_l_bfgs_b(self):
+        for processes in [1, 2]:
+            w = fmin_l_bfgs_b(least_squares,
+                              np.zeros(4),
+                              data=dict(x=self.x, y=self.y),
+                              processes=processes)
+            self.assertTrue(np.allclose(w, self.w, atol=1e-4))
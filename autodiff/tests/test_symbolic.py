@@ -1,10 +1,16 @@
+import os
+import shutil
+import tempfile
 import unittest
 import numpy as np
+import theano
 import theano.tensor
 
 from autodiff.symbolic import Symbolic, Tracer, Function, Gradient
-from autodiff.symbolic import HessianVector, VectorArg
+from autodiff.symbolic import HessianVector, Jacobian, Hessian, VectorArg
+import autodiff.utils
 from autodiff import tag
+from autodiff.stats import Stats
 
 
 def checkfn(symF, *args, **kwargs):
@@ -56,6 +62,30 @@ class TestSymbolic(unittest.TestCase):
         F2 = s2.compile_function(x, o2)
         self.assertTrue(np.allclose(F2(x), f(x).astype(theano.config.floatX)))
 
+    def test_zero_copy(self):
+        y = np.random.random((3, 4))
+
+        def f(x):
+            return x * y
+
+        s = Symbolic(f, zero_copy=True)
+        x = np.random.random((3, 4))
+        o = s.trace(x)[1]
+        self.assertTrue(np.shares_memory(
+            s.get_symbolic(x).get_value(borrow=True), x))
+        self.assertTrue(np.shares_memory(
+            s.get_symbolic(y).get_value(borrow=True), y))
+
+        # the compiled function keeps a copy of y, but not of x
+        F = s.compile_function(x, o)
+        self.assertTrue(np.shares_memory(
+            s.get_symbolic(x).get_value(borrow=True), x))
+        self.assertFalse(np.shares_memory(
+            s.get_symbolic(y).get_value(borrow=True), y))
+        expected = f(x)
+        y[:] = 0
+        self.assertTrue(np.allclose(F(x), expected))
+
     def test_compile_gradient(self):
         def f(x):
             return x ** 2
@@ -405,6 +435,80 @@ class TestFunction(unittest.TestCase):
         self.assertTrue(np.allclose(uc_result_1, 1))
         self.assertTrue(np.allclose(uc_result_2, 0))
 
+    def test_specialize(self):
+        def fn(x):
+            return x * 2
+
+        x1 = np.ones((1, 3))
+        x2 = np.ones((2, 3))
+        x3 = np.ones((4, 3))
+
+        f = Function(fn)
+        for x in (x1, x2, x3):
+            self.assertTrue(checkfn(f, x))
+        self.assertTrue(len(f.cache) == 1)
+
+        f = Function(fn, specialize='broadcast')
+        for x in (x1, x2, x3):
+            self.assertTrue(checkfn(f, x))
+        self.assertTrue(len(f.cache) == 2)
+
+        f = Function(fn, specialize='shape')
+        for x in (x1, x2, x3):
+            self.assertTrue(checkfn(f, x))
+        self.assertTrue(len(f.cache) == 3)
+
+        self.assertRaises(ValueError, Function, fn, specialize='dims')
+
+    def test_cache_size(self):
+        def fn(x):
+            return x * 2
+
+        f = Function(fn, specialize='shape', cache_size=2)
+        for n in range(1, 5):
+            self.assertTrue(checkfn(f, np.ones(n)))
+        self.assertTrue(len(f.cache) == 2)
+        self.assertTrue(list(f.cache)[-1][0][2] == (4,))
+
+    def test_release_trace(self):
+        y = np.random.random(10)
+
+        def fn(x):
+            z = tag(x * y, 'z')
+            return z + 1
+
+        f = Function(fn)
+        x = np.random.random(10)
+        self.assertTrue(checkfn(f, x))
+
+        # only tags are retained once the function is compiled
+        self.assertTrue(len(f.context._nogc) == 0)
+        self.assertTrue(all(isinstance(k, str) for k in f.sym_vars))
+        self.assertTrue('z' in f.tags)
+        self.assertTrue(f.sym_vars['x'].get_value(borrow=True).size == 0)
+        self.assertTrue(checkfn(f, x))
+
+    def test_bind_args(self):
+        def check(fn, *args, **kwargs):
+            f = Function(fn)
+            expected = autodiff.utils.expandedcallargs(
+                f.symfn, *args, **kwargs)
+            bound = f.bind_args(args, kwargs)
+            self.assertTrue(len(bound) == len(expected))
+            self.assertTrue(all(b is e for b, e in zip(bound, expected)))
+
+        x, y, z = np.ones(3), 2.0, np.zeros(2)
+        check(lambda x: x, x)
+        check(lambda x, y=2.0: x * y, x)
+        check(lambda x, y=2.0: x * y, x, y)
+        check(lambda x, y=2.0: x * y, x, y=y)
+        check(lambda x, y=3, z=None: x * y, x, y)
+        check(lambda x, *y: x, x, y, z)
+
+        f = Function(lambda x, y: x * y)
+        self.assertRaises(TypeError, f.bind_args, (x,), {})
+        self.assertRaises(TypeError, f.bind_args, (x, y, z), {})
+
     def test_function_of_function(self):
         # single arg, no default
         def fn():
@@ -442,6 +546,216 @@ class TestFunction(unittest.TestCase):
         F = Function(g)
         self.assertTrue(checkfn(F, {1.0: 5.0}))
 
+    def test_container_args(self):
+        def f(xy, d, z=2.0):
+            return xy[0] * xy[1] + d['a'] - d['b'] * z
+
+        F = Function(f)
+        xy = (np.ones(3), 2 * np.ones(3))
+        d = {'a': 1.0, 'b': np.arange(3.)}
+        self.assertTrue(checkfn(F, xy, d))
+        self.assertTrue(checkfn(F, xy, d, 3.0))
+        # the fast path binds like the general one
+        self.assertTrue(len(F.bind_args((xy, d), {})) == 5)
+        self.assertTrue(len(F.bind_args((xy, d), {'z': 2.0})) == 5)
+
+
+class TestMemmap(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        filename = os.path.join(self.path, 'x.dat')
+        self.x = np.random.random((50, 3))
+        self.mm = np.memmap(filename, dtype='float64', mode='w+',
+                            shape=self.x.shape)
+        self.mm[:] = self.x
+        self.mm.flush()
+
+    def tearDown(self):
+        del self.mm
+        shutil.rmtree(self.path)
+
+    def test_traced_without_copy(self):
+        mm = self.mm
+
+        def fn(w):
+            return np.dot(mm, w).sum()
+
+        s = Symbolic(fn, force_floatX=True)
+        w = np.ones(3)
+        _, out = s.trace(w)
+        # the memmap is shadowed by a shared variable, and cast in the graph
+        sym_mm = s.get_symbolic(mm)
+        self.assertTrue(isinstance(sym_mm, theano.compile.SharedVariable))
+        self.assertTrue(np.shares_memory(sym_mm.get_value(borrow=True), mm))
+        self.assertTrue(out.dtype == theano.config.floatX)
+
+        f = Function(fn, zero_copy=True)
+        self.assertTrue(np.allclose(f(w), self.x.sum()))
+
+    def test_cache_key(self):
+        f = Function(lambda x: x.sum(axis=0))
+        self.assertTrue(f.get_cache_key((self.mm,))
+                        == f.get_cache_key((self.x,)))
+        self.assertTrue(np.allclose(f(self.mm), self.x.sum(axis=0)))
+
+    def test_reduce_chunks(self):
+        def loss(x, w):
+            return (np.dot(x, w) ** 2).mean()
+
+        w = np.random.random(3)
+        f = Function(loss)
+        result = f.reduce_chunks((self.mm, w), chunk_args='x', chunk_size=16,
+                                 reduction='mean')
+        self.assertTrue(np.allclose(result, loss(self.x, w)))
+        # the chunks share a compiled function
+        self.assertTrue(len(f.cache) == 1)
+
+        g = Gradient(loss, wrt='w')
+        result = g.reduce_chunks((self.mm,), dict(w=w), chunk_args='x',
+                                 chunk_size=16, reduction='mean')
+        self.assertTrue(np.allclose(result, g(self.x, w)))
+
+        def total(x, w):
+            return np.dot(x, w).sum()
+
+        g = Gradient(total, wrt='w')
+        result = g.reduce_chunks((self.mm, w), chunk_args=['x'],
+                                 chunk_size=7)
+        self.assertTrue(np.allclose(result, self.x.sum(axis=0)))
+
+    def test_chunk_args(self):
+        def loss(x, w):
+            return ((np.dot(x, w) - 1) ** 2).mean()
+
+        w = np.random.random(3)
+        f = Function(loss, chunk_args='x', chunk_size=16)
+        g = Gradient(loss, wrt='w', chunk_args='x', chunk_size=16)
+        self.assertTrue(np.allclose(f(self.mm, w), loss(self.x, w)))
+        self.assertTrue(np.allclose(
+            g(self.mm, w), Gradient(loss, wrt='w')(self.x, w)))
+        self.assertTrue(np.allclose(
+            g(w=w, x=self.mm), Gradient(loss, wrt='w')(self.x, w)))
+
+        g = Gradient(lambda x, w: np.dot(x, w).sum(), wrt='w',
+                     chunk_args='x', chunk_size=16, chunk_reduction='sum')
+        self.assertTrue(np.allclose(g(self.mm, w), self.x.sum(axis=0)))
+        self.assertRaises(ValueError, Function, loss, chunk_args='x',
+                          chunk_reduction='max')
+
+
+class TestBatched(unittest.TestCase):
+    def test_batch_axis(self):
+        def fn(x):
+            return (x ** 2).sum()
+
+        x = np.random.random((5, 3))
+        f = Function(fn, batch_axis=0)
+        self.assertTrue(np.allclose(f(x), (x ** 2).sum(axis=1)))
+
+        f = Function(fn, batch_axis=1)
+        self.assertTrue(np.allclose(f(x), (x ** 2).sum(axis=0)))
+
+    def test_batch_axis_dict(self):
+        def fn(x, w):
+            return np.dot(x, w)
+
+        x = np.random.random((5, 3))
+        w = np.random.random(3)
+        f = Function(fn, batch_axis={'x': 0})
+        self.assertTrue(np.allclose(f(x, w), np.dot(x, w)))
+        self.assertTrue(np.allclose(f(w=w, x=x), np.dot(x, w)))
+
+    def test_batched_gradient(self):
+        def fn(x, w):
+            return np.dot(x, w) ** 2
+
+        x = np.random.random((5, 3))
+        w = np.random.random(3)
+        g = Gradient(fn, wrt='w', batch_axis={'x': 0})
+        expected = 2 * np.dot(x, w)[:, None] * x
+        self.assertTrue(np.allclose(g(x, w), expected))
+
+    def test_batched_updates(self):
+        class Accumulator(object):
+            def __init__(self):
+                self.total = 0.0
+
+        acc = Accumulator()
+
+        def fn(x):
+            acc.total = acc.total + x.sum()
+            return acc.total
+
+        f = Function(fn, batch_axis=0, infer_updates=True)
+        x = np.ones((4, 3))
+        self.assertTrue(np.allclose(f(x), [3.0, 6.0, 9.0, 12.0]))
+        self.assertTrue(np.allclose(f(x), [15.0, 18.0, 21.0, 24.0]))
+
+    def test_empty_batch(self):
+        f = Function(lambda x: x.sum(), batch_axis=0)
+        self.assertRaises(ValueError, f, np.ones((0, 3)))
+        self.assertTrue(np.allclose(f(np.ones((2, 3))), [3.0, 3.0]))
+        self.assertRaises(ValueError, f, np.ones((0, 3)))
+
+
+class TestBoundFunction(unittest.TestCase):
+    def test_bind(self):
+        def fn(x):
+            return x * 2
+
+        x = np.random.random(3)
+        f = Function(fn).bind(x)
+        result = f(5)
+        self.assertTrue(result.shape == (5, 3))
+        self.assertTrue(np.allclose(result, 2 * x))
+
+        x2 = np.random.random(3)
+        f.set_inputs(x2)
+        self.assertTrue(np.allclose(f(4), 2 * x2))
+
+        # the buffers are reallocated for inputs of a different shape
+        x3 = np.random.random(5)
+        f.set_inputs(x3)
+        result = f(4)
+        self.assertTrue(result.shape == (4, 5))
+        self.assertTrue(np.allclose(result, 2 * x3))
+
+    def test_call_repeatedly(self):
+        # updates are applied with and without the CVM's internal loop
+        counter = theano.shared(np.asarray(0, dtype='int64'))
+        for mode in [None, theano.compile.Mode(linker='py')]:
+            counter.set_value(np.asarray(0, dtype='int64'))
+            fn = theano.function([], [],
+                                 updates={counter: counter + 1},
+                                 mode=mode)
+            autodiff.utils.call_repeatedly(fn, 5)
+            self.assertTrue(counter.get_value() == 5)
+
+    def test_bind_random(self):
+        def fn():
+            return np.random.random(10).mean()
+
+        result = Function(fn).bind()(200)
+        self.assertTrue(result.shape == (200,))
+        self.assertTrue(len(np.unique(result)) > 1)
+        self.assertTrue(abs(result.mean() - 0.5) < 0.1)
+
+    def test_bind_gradient(self):
+        def fn(x, y):
+            return (x * y).sum()
+
+        x, y = np.random.random(3), np.random.random(3)
+        g = Gradient(fn, wrt='x').bind(x, y)
+        self.assertTrue(np.allclose(g(3), y))
+
+    def test_bind_hv(self):
+        def fn(x):
+            return np.dot(x, x).sum()
+
+        x = np.ones((3, 3))
+        hv = HessianVector(fn).bind(x, vectors=x)
+        self.assertTrue(np.allclose(hv(2), x * 6))
+
 
 class TestGradient(unittest.TestCase):
 
@@ -486,6 +800,35 @@ class TestGradient(unittest.TestCase):
         g = Gradient(fn, wrt=b)
         self.assertTrue(np.allclose(g(a, b), a))
 
+    def test_per_example(self):
+        def loss(x, y, w, b):
+            return (np.dot(x, w) + b - y) ** 2
+
+        x = np.random.random((6, 3))
+        y = np.random.random(6)
+        w = np.random.random(3)
+        b = 0.5
+        err = np.dot(x, w) + b - y
+        for method in ['scan', 'rop']:
+            g = Gradient(loss, wrt=['w', 'b'], per_example=True,
+                         jacobian_method=method)
+            g_w, g_b = g(x, y, w, b)
+            self.assertTrue(g_w.shape == (6, 3))
+            self.assertTrue(np.allclose(g_w, 2 * err[:, None] * x))
+            self.assertTrue(np.allclose(g_b, 2 * err))
+
+        # reduction over trailing axes
+        g = Gradient(lambda x, w: x * w, wrt='w', reduction='sum',
+                     per_example=True)
+        self.assertTrue(np.allclose(g(x, w), x))
+
+        # per-example losses must be vectors
+        g = Gradient(lambda x, w: np.dot(x, w).sum(), wrt='w',
+                     per_example=True)
+        self.assertRaises(TypeError, g, x, w)
+        self.assertRaises(ValueError, Gradient, loss, per_example=True,
+                          jacobian_method='foo')
+
 
 class TestHV(unittest.TestCase):
     def test_hv_missing_vectors(self):
@@ -510,6 +853,117 @@ class TestHV(unittest.TestCase):
         self.assertTrue(np.allclose(x * 2, F(x[0], vectors=x[0])))
 
 
+class TestJacobianHessian(unittest.TestCase):
+    def test_jacobian(self):
+        def fn(x, A):
+            return np.tanh(np.dot(A, x))
+
+        x = np.random.random(3)
+        A = np.random.random((4, 3))
+        expected = (1 - np.tanh(np.dot(A, x)) ** 2)[:, None] * A
+        for method in ['scan', 'rop']:
+            J = Jacobian(fn, wrt='x', jacobian_method=method)
+            self.assertTrue(np.allclose(J(x, A), expected))
+
+        # Jacobians have shape output.shape + wrt.shape
+        J = Jacobian(lambda x: x * 2)
+        self.assertTrue(np.allclose(J(np.ones((2, 3))),
+                                    2 * np.eye(6).reshape(2, 3, 2, 3)))
+
+    def test_hessian(self):
+        def fn(x, A):
+            return 0.5 * np.dot(x, np.dot(A, x)) + (x ** 4).sum()
+
+        x = np.random.random(4)
+        A = np.random.random((4, 4))
+        expected = 0.5 * (A + A.T) + np.diag(12 * x ** 2)
+        for method in ['scan', 'rop']:
+            H = Hessian(fn, wrt='x', jacobian_method=method)
+            self.assertTrue(np.allclose(H(x, A), expected))
+
+        H = Hessian(lambda x: x ** 2, reduction='sum')
+        self.assertTrue(np.allclose(H(np.ones(3)), 2 * np.eye(3)))
+
+    def test_hessian_cross_derivatives(self):
+        def fn(x, y):
+            return (x * y).sum() + (x ** 2).sum()
+
+        x = np.random.random(3)
+        y = np.random.random(3)
+        for method in ['scan', 'rop']:
+            H = Hessian(fn, wrt=['x', 'y'], jacobian_method=method)
+            hxx, hxy, hyx, hyy = H(x, y)
+            self.assertTrue(np.allclose(hxx, 2 * np.eye(3)))
+            self.assertTrue(np.allclose(hxy, np.eye(3)))
+            self.assertTrue(np.allclose(hyx, np.eye(3)))
+            self.assertTrue(np.allclose(hyy, np.zeros((3, 3))))
+
+    def test_compile(self):
+        def fn(x):
+            return (x ** 2).sum()
+
+        s = Symbolic(fn)
+        x = np.arange(3.0)
+        inputs, outputs = s.trace(x)
+        f = s.compile(function=True, gradient=True, hessian=True,
+                      inputs=inputs, outputs=outputs)
+        value, grad, hess = f(x)
+        self.assertTrue(np.allclose(value, 5.0))
+        self.assertTrue(np.allclose(grad, 2 * x))
+        self.assertTrue(np.allclose(hess, 2 * np.eye(3)))
+
+
+class TestStats(unittest.TestCase):
+    def test_phases(self):
+        def helper(x):
+            return x * 2
+
+        def fn(x):
+            return np.sum(helper(x) + np.ones(3))
+
+        records = []
+        stats = Stats(callbacks=records.append)
+        f = Gradient(fn, stats=stats)
+        self.assertTrue(f.stats is stats)
+        self.assertTrue(np.allclose(f(np.ones(3)), 2.0))
+        self.assertTrue(np.allclose(f(np.zeros(3)), 2.0))
+
+        for phase in ['get_ast', 'transform', 'compile_func', 'trace',
+                      'theano_function']:
+            self.assertTrue(stats.phases[phase]['calls'] > 0)
+            self.assertTrue(stats.phases[phase]['seconds'] >= 0)
+        self.assertTrue(stats.phases['trace']['calls'] == 1)
+
+        self.assertTrue(stats.counts['recompile'] == 1)
+        self.assertTrue(stats.counts['recompile_nested'] == 1)
+        self.assertTrue(stats.counts['shadowed'] > 0)
+        self.assertTrue(stats.counts['dispatch.numpy'] >= 2)
+        self.assertTrue(stats.counts['dispatch.python'] == 1)
+        self.assertTrue(stats.counts['cache.miss'] == 1)
+        self.assertTrue(stats.counts['cache.hit'] == 1)
+
+        self.assertTrue(len(stats.graphs) == 1)
+        graph = stats.graphs[0]
+        self.assertTrue(graph['function'].endswith('fn'))
+        self.assertTrue(graph['nodes_before'] > 0)
+        self.assertTrue(graph['nodes_after'] > 0)
+
+        # callbacks receive phase and graph records as they happen
+        self.assertTrue(set(r['type'] for r in records) == {'phase', 'graph'})
+        types = set(r['type'] for r in stats.records())
+        self.assertTrue(types == {'phase', 'count', 'graph'})
+
+        stats.reset()
+        self.assertTrue(stats.records() == [])
+
+    def test_disabled(self):
+        def fn(x):
+            return x + 1
+        f = Function(fn)
+        self.assertTrue(f.stats is None)
+        self.assertTrue(np.allclose(f(1.0), 2.0))
+
+
 class TestVectorArg(unittest.TestCase):
     def test_vectorarg(self):
         def f(x):
@@ -526,3 +980,31 @@ class TestVectorArg(unittest.TestCase):
         expected_grad = np.ones(x.size) * 3
         expected_grad[6] = 0
         self.assertTrue =(np.allclose(result[1], expected_grad))
+
+    def test_vector_layout(self):
+        def f(x, y):
+            return (x ** 2).sum() + y
+
+        x = np.arange(6.0).reshape(2, 3)
+        y = 4.0
+        v = VectorArg(f, [x, y], function=True)
+        self.assertTrue(v.shapes == ((2, 3), ()))
+        self.assertTrue(v.offsets[:2] == (0, 6))
+        self.assertTrue(np.allclose(v.vector, np.append(x.ravel(), y)))
+        self.assertTrue(np.allclose(v(v.vector), 59.0))
+
+        # arguments are views of the parameter buffer
+        self.assertTrue(np.shares_memory(v.arg_views[0], v.vector))
+        vector = v.vector_from_args((x + 1, 5.0), {})
+        self.assertTrue(vector is v.vector)
+        self.assertTrue(np.allclose(v.arg_views[0], x + 1))
+
+        # arguments must match the layout of the vector
+        self.assertRaises(ValueError, v.vector_from_args,
+                          (np.ones(5), 5.0), {})
+        self.assertRaises(ValueError, v.vector_from_args,
+                          (np.ones((2, 3)), np.ones(2)), {})
+
+        new_x, new_y = v.args_from_vector(np.arange(7.0))
+        self.assertTrue(np.shares_memory(new_x, new_y))
+        self.assertTrue(new_x.shape == (2, 3) and new_y.shape == ())
@@ -1,7 +1,9 @@
 import gc
+import mmap
 import opcode
 import inspect
 import theano
+import theano.gof.vm
 import numpy as np
 
 from collections import OrderedDict
@@ -183,6 +185,48 @@ def isvar(x):
     return isinstance(x, vartypes)
 
 
+def is_memmap(x):
+    """
+    Type test for arrays that are memory-mapped from a file.
+    """
+    return isinstance(x, np.memmap) and getattr(x, 'filename', None) is not None
+
+
+def memmap_position(x):
+    """
+    Returns the position (in bytes) of the first element of the memmap x in
+    its file, or None if it can not be determined.
+    """
+    if not is_memmap(x) or x.offset is None:
+        return None
+    # the mapping of the file is the first base that is not an array; it
+    # starts at the offset rounded down to the allocation granularity
+    mapping = x
+    while isinstance(mapping, np.ndarray):
+        mapping = mapping.base
+    try:
+        start = np.frombuffer(mapping, dtype=np.uint8).ctypes.data
+    except (TypeError, ValueError):
+        return None
+    aligned = x.offset - x.offset % mmap.ALLOCATIONGRANULARITY
+    return aligned + x.ctypes.data - start
+
+
+def call_repeatedly(fn, n):
+    """
+    Calls the compiled Theano function fn, which must not have any inputs, n
+    times. Theano's C virtual machine (CVM) has a low-overhead call interface
+    with an internal loop (`n_calls`); other linkers are called through fn,
+    which also applies its updates.
+    """
+    cvm = getattr(theano.gof.vm, 'CVM', None)
+    if cvm is not None and isinstance(fn.fn, cvm):
+        fn.fn(n_calls=n)
+    else:
+        for i in range(n):
+            fn()
+
+
 def clean_int_args(*args, **kwargs):
     """
     Given args and kwargs, replaces small integers with numpy int16 objects, to